@@ -1 +1,5 @@
+from .benchmark_entity_nlm import BenchmarkEntityNlm
+from .build_alias_database import BuildAliasDatabase
+from .build_entity_index import BuildEntityIndex
 from .evaluate_perplexity import EvaluatePerplexity
+from .serve import Serve
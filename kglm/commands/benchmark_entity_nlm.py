@@ -0,0 +1,135 @@
+import argparse
+import json
+import logging
+import time
+from typing import Any, Dict
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common.checks import check_for_gpu, ConfigurationError
+from allennlp.common.util import prepare_environment
+from allennlp.data.dataset_readers.dataset_reader import DatasetReader
+from allennlp.data.iterators import BasicIterator
+from allennlp.models.archival import load_archive
+from allennlp.nn import util
+import torch
+
+from kglm.models.entity_nlm import EntityNLM
+
+logger = logging.getLogger(__name__)
+
+
+class BenchmarkEntityNlm(Subcommand):
+    def add_subparser(self, name: str, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        # pylint: disable=protected-access
+        description = '''Compare the throughput of EntityNLM's default loop and fused step'''
+        subparser = parser.add_parser(name, description=description,
+                                      help='Benchmark the fused EntityNLM step')
+
+        subparser.add_argument('archive_file', type=str, help='path to an archived trained EntityNLM')
+
+        subparser.add_argument('input_file', type=str, help='path to the file containing the benchmark data')
+
+        subparser.add_argument('--output-file', type=str, help='path to output file')
+
+        subparser.add_argument('--batch-size',
+                               type=int,
+                               default=16,
+                               help='number of documents in the benchmark batch')
+
+        subparser.add_argument('--num-repeats',
+                               type=int,
+                               default=5,
+                               help='number of forward passes timed for each implementation')
+
+        subparser.add_argument('--cuda-device',
+                               type=int,
+                               default=-1,
+                               help='id of GPU to use (if any)')
+
+        subparser.add_argument('-o', '--overrides',
+                               type=str,
+                               default="",
+                               help='a JSON structure used to override the experiment configuration')
+
+        subparser.set_defaults(func=benchmark_from_args)
+
+        return subparser
+
+
+def benchmark_fused_step(model: EntityNLM,
+                         batch: Dict[str, torch.Tensor],
+                         num_repeats: int = 5) -> Dict[str, float]:
+    """
+    Measures the throughput of the default loop and the fused step on the same batch.
+
+    Parameters
+    ----------
+    model : ``EntityNLM``
+        The model to benchmark. Its ``fused_step`` setting is restored afterwards.
+    batch : ``Dict[str, torch.Tensor]``
+        The arguments to the model's forward pass (e.g. a tensorized batch of instances).
+    num_repeats : ``int``, optional (default=5)
+        The number of forward passes timed for each implementation.
+
+    Returns
+    -------
+    A dictionary containing the tokens processed per second by each implementation, along with
+    the resulting speedup.
+    """
+    batch = {key: value for key, value in batch.items() if key != 'reset'}
+    num_tokens = batch['tokens']['tokens'].numel()
+    fused_step = model._fused_step  # pylint: disable=protected-access
+    training = model.training
+    model.eval()
+
+    tokens_per_sec = {}
+    try:
+        with torch.no_grad():
+            for name, use_fused_step in (('loop', False), ('fused', True)):
+                model._fused_step = use_fused_step  # pylint: disable=protected-access
+                model(**batch, reset=True)  # Warm up
+                start = time.perf_counter()
+                for _ in range(num_repeats):
+                    model(**batch, reset=True)
+                elapsed = time.perf_counter() - start
+                tokens_per_sec[name] = num_repeats * num_tokens / elapsed
+    finally:
+        model._fused_step = fused_step  # pylint: disable=protected-access
+        model.train(training)
+
+    return {
+            'loop_tokens_per_sec': tokens_per_sec['loop'],
+            'fused_tokens_per_sec': tokens_per_sec['fused'],
+            'speedup': tokens_per_sec['fused'] / tokens_per_sec['loop']
+    }
+
+
+def benchmark_from_args(args: argparse.Namespace) -> Dict[str, Any]:
+    check_for_gpu(args.cuda_device)
+    archive = load_archive(args.archive_file, args.cuda_device, args.overrides)
+    config = archive.config
+    prepare_environment(config)
+    model = archive.model
+    if not isinstance(model, EntityNLM):
+        raise ConfigurationError('Expected an EntityNLM, got: %s' % type(model).__name__)
+
+    # The benchmark is run on a single batch of entire documents.
+    dataset_reader = DatasetReader.from_params(config.pop('dataset_reader'))
+    logger.info('Reading benchmark data from: %s', args.input_file)
+    instances = dataset_reader.read(args.input_file)
+    iterator = BasicIterator(batch_size=args.batch_size)
+    iterator.index_with(model.vocab)
+    batch = next(iterator(instances, num_epochs=1, shuffle=False))
+    batch = util.move_to_device(batch, args.cuda_device)
+
+    metrics = benchmark_fused_step(model, batch, num_repeats=args.num_repeats)
+
+    logger.info('Metrics:')
+    for key, metric in metrics.items():
+        logger.info('%s: %s', key, metric)
+
+    output_file = args.output_file
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(metrics, f, indent=4)
+    return metrics
@@ -0,0 +1,32 @@
+import argparse
+import logging
+
+from allennlp.commands.subcommand import Subcommand
+
+from kglm.data import AliasDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class BuildAliasDatabase(Subcommand):
+    def add_subparser(self, name: str, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        # pylint: disable=protected-access
+        description = '''Pre-tokenize an alias database so that it can be memory-mapped at load time'''
+        subparser = parser.add_parser(name, description=description,
+                                      help='Pre-tokenize an alias database')
+
+        subparser.add_argument('alias_database_path', type=str,
+                               help='path to the pickled alias database')
+
+        subparser.add_argument('output_path', type=str,
+                               help='path to the directory the pre-tokenized database is written to')
+
+        subparser.set_defaults(func=build_alias_database_from_args)
+
+        return subparser
+
+
+def build_alias_database_from_args(args: argparse.Namespace) -> None:
+    alias_database = AliasDatabase.load(args.alias_database_path)
+    logger.info('Writing pre-tokenized alias database to: %s', args.output_path)
+    alias_database.save(args.output_path)
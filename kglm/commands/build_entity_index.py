@@ -0,0 +1,102 @@
+import argparse
+import json
+import logging
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common.checks import check_for_gpu, ConfigurationError
+from allennlp.models.archival import load_archive
+import torch
+
+from kglm.modules import EntityIndex
+from kglm.modules.entity_index import benchmark_entity_index, entity_logit_vectors
+
+logger = logging.getLogger(__name__)
+
+
+class BuildEntityIndex(Subcommand):
+    def add_subparser(self, name: str, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        # pylint: disable=protected-access
+        description = '''Build an approximate nearest neighbour index over a model's entity embeddings'''
+        subparser = parser.add_parser(name, description=description,
+                                      help='Build an entity index')
+
+        subparser.add_argument('archive_file', type=str, help='path to an archived trained model')
+
+        subparser.add_argument('output_path', type=str,
+                               help='path to the file the index is written to')
+
+        subparser.add_argument('--output-file', type=str, help='path to which benchmark metrics are written')
+
+        subparser.add_argument('--num-clusters',
+                               type=int,
+                               default=1024,
+                               help='number of clusters in the index')
+
+        subparser.add_argument('--num-iterations',
+                               type=int,
+                               default=10,
+                               help='number of k-means iterations')
+
+        subparser.add_argument('--benchmark-queries',
+                               type=int,
+                               default=0,
+                               help='if positive, benchmark recall and latency using this many '
+                                    'entity embeddings as queries')
+
+        subparser.add_argument('--k',
+                               type=int,
+                               default=10,
+                               help='number of candidates retrieved when benchmarking')
+
+        subparser.add_argument('--num-probes',
+                               type=int,
+                               default=8,
+                               help='number of clusters searched when benchmarking')
+
+        subparser.add_argument('--cuda-device',
+                               type=int,
+                               default=-1,
+                               help='id of GPU to benchmark on (if any)')
+
+        subparser.set_defaults(func=build_entity_index_from_args)
+
+        return subparser
+
+
+def build_entity_index_from_args(args: argparse.Namespace) -> None:
+    check_for_gpu(args.cuda_device)
+    archive = load_archive(args.archive_file)
+    model = archive.model
+    if not hasattr(model, '_fc_new_entity') or not model._tie_weights:  # pylint: disable=protected-access
+        raise ConfigurationError('An entity index requires a model with tie_weights and no shortlist')
+    # The index is built over the (tied) entity embeddings, augmented with the bias of the new entity
+    # logits so that candidates are retrieved by their exact logits.
+    # pylint: disable=protected-access
+    embeddings = model._entity_embedder.weight.detach().cpu()
+    vectors = entity_logit_vectors(embeddings, model._fc_new_entity.bias.detach().cpu())
+
+    logger.info('Clustering %i entity embeddings', embeddings.shape[0])
+    index = EntityIndex.build(vectors,
+                              num_clusters=args.num_clusters,
+                              num_iterations=args.num_iterations)
+    logger.info('Writing entity index to: %s', args.output_path)
+    index.save(args.output_path)
+
+    if args.benchmark_queries > 0:
+        device = torch.device('cpu' if args.cuda_device < 0 else 'cuda:%i' % args.cuda_device)
+        generator = torch.Generator()
+        generator.manual_seed(13370)
+        query_ids = torch.randint(1, embeddings.shape[0], (args.benchmark_queries,),
+                                  generator=generator, dtype=torch.int64)
+        queries = embeddings[query_ids]
+        queries = torch.cat((queries, queries.new_ones(queries.shape[0], 1)), dim=-1).to(device)
+        metrics = benchmark_entity_index(index, vectors, queries, args.k, args.num_probes)
+
+        logger.info('Metrics:')
+        for key, metric in metrics.items():
+            logger.info('%s: %s', key, metric)
+
+        output_file = args.output_file
+        if output_file:
+            with open(output_file, 'w') as f:
+                json.dump(metrics, f, indent=4)
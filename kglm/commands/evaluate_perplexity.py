@@ -2,7 +2,7 @@ import argparse
 import json
 import logging
 import math
-from typing import Any, Dict, Iterator
+from typing import Any, Dict, Iterator, Optional, Union
 
 from allennlp.commands.subcommand import Subcommand
 from allennlp.common.util import prepare_environment
@@ -16,6 +16,8 @@ from allennlp.models.archival import load_archive
 from allennlp.nn import util
 import torch
 
+from kglm.sampling import CachedSampler, Sampler, SampleCache
+
 logger = logging.getLogger(__name__)
 
 
@@ -50,6 +52,52 @@ class EvaluatePerplexity(Subcommand):
                                default="",
                                help='a JSON structure used to override the experiment configuration')
 
+        subparser.add_argument('--batch-size',
+                               type=int,
+                               default=1,
+                               help='number of documents evaluated at once')
+
+        subparser.add_argument('--num-samples',
+                               type=int,
+                               default=100,
+                               help='number of importance samples drawn for each document')
+
+        subparser.add_argument('--samples-per-batch',
+                               type=int,
+                               default=None,
+                               help='number of samples drawn at a time for each document '
+                                    '(defaults to all of them)')
+
+        subparser.add_argument('--max-std',
+                               type=float,
+                               default=None,
+                               help='if given, stop drawing samples for a document once the estimated '
+                                    'standard deviation of its log-likelihood falls below this value')
+
+        subparser.add_argument('--min-effective-sample-size',
+                               type=float,
+                               default=None,
+                               help='if given, stop drawing samples for a document once the effective '
+                                    'sample size of its importance weights reaches this value')
+
+        subparser.add_argument('--min-samples',
+                               type=int,
+                               default=10,
+                               help='the minimum number of samples drawn for each document when '
+                                    'stopping early')
+
+        subparser.add_argument('--sample-cache',
+                               type=str,
+                               default=None,
+                               help='directory in which drawn samples are stored, and from which '
+                                    'previously drawn samples are reused')
+
+        subparser.add_argument('--sample-seed',
+                               type=int,
+                               default=0,
+                               help='random seed used to draw samples when using a sample cache '
+                                    '(samples are stored separately for each seed)')
+
         subparser.add_argument('--batch-weight-key',
                                type=str,
                                default="",
@@ -59,58 +107,209 @@ class EvaluatePerplexity(Subcommand):
         return subparser
 
 
+def _logaddexp(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return torch.logsumexp(torch.stack((x, y), dim=0), dim=0)
+
+
+def _encode(model: Model, batch: Dict[str, Any]) -> Optional[torch.Tensor]:
+    # Models which can encode tokens independently of the annotations expose an ``encode``
+    # method, whose output is accepted (as ``encoded``) in place of re-encoding the tokens.
+    if hasattr(model, 'encode'):
+        return model.encode(batch['source'] if 'source' in batch else batch['tokens'])
+    return None
+
+
+def _converged(log_weight_sum: torch.Tensor,
+               log_squared_weight_sum: torch.Tensor,
+               num_drawn: torch.Tensor,
+               min_samples: int,
+               max_std: Optional[float],
+               min_effective_sample_size: Optional[float]) -> torch.Tensor:
+    effective_sample_size = torch.exp(2 * log_weight_sum - log_squared_weight_sum)
+    converged = num_drawn.ge(min_samples)
+    if max_std is not None:
+        variance = (1 / effective_sample_size - 1 / num_drawn).clamp(min=0)
+        converged = converged & variance.le(max_std ** 2)
+    if min_effective_sample_size is not None:
+        converged = converged & effective_sample_size.ge(min_effective_sample_size)
+    return converged
+
+
 def evaluate_perplexity(model: Model,
-                        sampler: Model,
+                        sampler: Union[Model, Sampler],
                         instances: Iterator[Instance],
                         data_iterator: DataIterator,
-                        cuda_device: int) -> Dict[str, Any]:
+                        cuda_device: int,
+                        num_samples: int = 100,
+                        samples_per_batch: int = None,
+                        sample_cache: str = None,
+                        sample_seed: int = 0,
+                        max_std: float = None,
+                        min_effective_sample_size: float = None,
+                        min_samples: int = 10) -> Dict[str, Any]:
+    """
+    Estimates the perplexity of ``model`` using importance sampling, with ``sampler`` as the
+    proposal distribution.
+
+    The log-likelihood of each document is estimated as:
+
+        log p(x) ~= log (1/N) sum_i p(x, z_i) / q(z_i | x),    z_i ~ q(z | x)
+
+    The samples for a batch of documents are drawn ``samples_per_batch`` at a time (to bound
+    memory usage), and the importance weights are accumulated in log-space as they are drawn.
+    If ``max_std`` or ``min_effective_sample_size`` are given, then samples are drawn in rounds of
+    ``samples_per_batch`` and a document's estimate is no longer updated once the criteria are
+    met, and sampling for a batch stops once every document has converged (so at most
+    ``num_samples`` samples are drawn). The standard deviation of the log-likelihood estimate is
+    estimated from the effective sample size (see below).
+
+    Each document is only encoded once by the sampler, and (if the model implements an
+    ``encode`` method) once by the model, with the hidden states repeated for every sample.
+
+    Parameters
+    ----------
+    model : ``Model``
+        The model being evaluated.
+    sampler : ``Union[Model, Sampler]``
+        Used to draw samples. If a ``Model`` is given, the ``Sampler`` registered for its type
+        is used.
+    instances : ``Iterator[Instance]``
+        The evaluation data.
+    data_iterator : ``DataIterator``
+        Iterator used to batch the data. Each batch must contain entire documents.
+    cuda_device : ``int``
+        The GPU to use (if any).
+    num_samples : ``int``, optional (default=100)
+        The number of samples drawn for each document (the maximum, when stopping early).
+    samples_per_batch : ``int``, optional (default=None)
+        The number of samples drawn at a time for each document. If ``None`` then all of the
+        samples are drawn at once (or ``min_samples`` at a time, when stopping early).
+    sample_cache : ``str``, optional (default=None)
+        If given, a directory where the samples (and their log-probabilities) are stored using a
+        ``SampleCache``. Documents whose samples (drawn by the same sampler) are already stored
+        are not sampled again, so several models can be evaluated using a single sampling pass.
+    sample_seed : ``int``, optional (default=0)
+        When using a sample cache, the random seed used to draw samples, which the stored
+        samples are keyed by. Note that every sample of a document without stored samples is
+        drawn (and stored) up front, even when stopping early.
+    max_std : ``float``, optional (default=None)
+        If given, the maximum standard deviation of the estimated log-likelihood of a document
+        for it to be considered converged.
+    min_effective_sample_size : ``float``, optional (default=None)
+        If given, the minimum effective sample size of the importance weights of a document for
+        it to be considered converged.
+    min_samples : ``int``, optional (default=10)
+        The minimum number of samples drawn for each document before it can be considered
+        converged (the variance and effective sample size of a handful of samples are
+        unreliable).
+
+    Returns
+    -------
+    A dictionary of metrics containing:
+        perplexity : The token-weighted perplexity.
+        cross_entropy : The average per-token cross entropy.
+        cross_entropy_std : An estimate of the standard deviation of ``cross_entropy`` due to
+            sampling.
+        effective_sample_size : The average effective sample size of the importance weights.
+        num_samples : The average number of samples used for each document.
+    """
     check_for_gpu(cuda_device)
 
-    num_samples = 100 # TODO: Make this something you can specify
+    if not isinstance(sampler, Sampler):
+        sampler = Sampler.from_model(sampler)
+    adaptive = max_std is not None or min_effective_sample_size is not None
+    if adaptive and samples_per_batch is None:
+        samples_per_batch = min_samples
+    if sample_cache is not None:
+        sampler = CachedSampler(sampler, SampleCache(sample_cache), sample_seed)
 
     with torch.no_grad():
         model.eval()
-        sampler.eval()
+        sampler.model.eval()
 
         iterator = data_iterator(instances, num_epochs=1, shuffle=False)
         logger.info('Iterating over dataset')
         generator_tqdm = Tqdm.tqdm(iterator, total=data_iterator.get_num_batches(instances))
 
-        total_cross_entropy = 0.0
-        batch_count = 0
+        total_logp = 0.0
+        total_variance = 0.0
+        total_effective_sample_size = 0.0
+        total_num_samples = 0.0
+        total_tokens = 0
+        document_count = 0
 
         for batch in generator_tqdm:
-            batch_count += 1
-            tokens = batch['tokens']
-            tokens['tokens'] = tokens['tokens'].repeat(num_samples, 1)
             batch = util.move_to_device(batch, cuda_device)
-            sequence_length = batch['tokens']['tokens'].shape[1]
-
-            # Draw a sample
-            sampler_output = sampler.sample(batch['tokens'])
-            sample_logp = sampler_output['logp']
-            sample = sampler_output['sample']
-            sample['reset'] = True
-            sample['tokens'] = batch['tokens']  # Add tokens to batch
-
-            # logp of the model is the loss; we multiply by sequence length to go from token-level
-            # to sequence-level probabilities.
-            model_logp = model(**sample).get('logp')
-            log_summands = model_logp - sample_logp
-
-            # This is the log probability of the entire sentence
-            logp = torch.logsumexp(log_summands, dim=0) - math.log(num_samples)
-
-            # We care about per-token cross entropy
-            per_word_cross_entropy = -logp / sequence_length
-            print(math.exp(per_word_cross_entropy))
-            total_cross_entropy += per_word_cross_entropy
-
-        # Aggregate metrics
-        avg_per_word_cross_entropy = total_cross_entropy / batch_count
-        perplexity = torch.exp(avg_per_word_cross_entropy)
-
-    metrics = {'perplexity': perplexity}
+            # Models which condition on the previous token are scored on the target tokens.
+            text_field = batch['target'] if 'target' in batch else batch['tokens']
+            batch_size = text_field['tokens'].shape[0]
+            num_tokens = util.get_text_field_mask(text_field).float().sum(dim=-1)
+
+            model_encoded = _encode(model, batch)
+
+            # Running log-sums of the importance weights, and of their squares.
+            log_weight_sum = num_tokens.new_full((batch_size,), -math.inf)
+            log_squared_weight_sum = num_tokens.new_full((batch_size,), -math.inf)
+            # The number of samples used for each document, and whether more are needed.
+            num_drawn = torch.zeros_like(num_tokens)
+            active = torch.ones_like(num_tokens, dtype=torch.uint8)
+
+            for chunk in sampler.sample(batch, num_samples, samples_per_batch):
+                num_chunk_samples = chunk['num_samples']
+                sample = chunk['sample']
+                if model_encoded is not None:
+                    sample['encoded'] = model_encoded.repeat(num_chunk_samples, 1, 1)
+
+                # Compute the log importance weights
+                model_logp = model(**sample).get('logp')
+                # shape: (num_chunk_samples, batch_size)
+                log_weights = (model_logp - chunk['logp']).view(num_chunk_samples, batch_size)
+
+                log_weight_sum = torch.where(
+                    active,
+                    _logaddexp(log_weight_sum, torch.logsumexp(log_weights, dim=0)),
+                    log_weight_sum)
+                log_squared_weight_sum = torch.where(
+                    active,
+                    _logaddexp(log_squared_weight_sum, torch.logsumexp(2 * log_weights, dim=0)),
+                    log_squared_weight_sum)
+                num_drawn = num_drawn + active.float() * num_chunk_samples
+
+                if adaptive:
+                    active = active & ~_converged(log_weight_sum, log_squared_weight_sum, num_drawn,
+                                                  min_samples, max_std, min_effective_sample_size)
+                    if not active.any():
+                        break
+
+            # This is the log probability of each entire document
+            logp = log_weight_sum - num_drawn.log()
+
+            # The effective sample size of the weights. Using the delta method, the variance of the
+            # log probability estimate is approximately 1 / ESS - 1 / N.
+            effective_sample_size = torch.exp(2 * log_weight_sum - log_squared_weight_sum)
+            variance = (1 / effective_sample_size - 1 / num_drawn).clamp(min=0)
+
+            total_logp += logp.sum().item()
+            total_variance += variance.sum().item()
+            total_effective_sample_size += effective_sample_size.sum().item()
+            total_num_samples += num_drawn.sum().item()
+            total_tokens += int(num_tokens.sum().item())
+            document_count += batch_size
+
+            cross_entropy = -total_logp / total_tokens
+            generator_tqdm.set_description('ppl: %.4f' % math.exp(cross_entropy), refresh=False)
+
+    # Aggregate metrics
+    cross_entropy = -total_logp / total_tokens
+    metrics = {
+            'perplexity': math.exp(cross_entropy),
+            'cross_entropy': cross_entropy,
+            'cross_entropy_std': math.sqrt(total_variance) / total_tokens,
+            'effective_sample_size': total_effective_sample_size / document_count,
+            'num_samples': total_num_samples / document_count,
+            'num_tokens': total_tokens,
+            'num_documents': document_count
+    }
     return metrics
 
 
@@ -144,9 +343,20 @@ def evaluate_from_args(args: argparse.Namespace) -> Dict[str, Any]:
 
     # To avoid hairy issues with splitting, we opt to use a basic iterator so that we can
     # generate samples for entire sequences.
-    iterator = BasicIterator(batch_size=1)
+    iterator = BasicIterator(batch_size=args.batch_size)
     iterator.index_with(model.vocab)
-    metrics = evaluate_perplexity(model, sampler, instances, iterator, args.cuda_device)
+    metrics = evaluate_perplexity(model,
+                                  sampler,
+                                  instances,
+                                  iterator,
+                                  args.cuda_device,
+                                  num_samples=args.num_samples,
+                                  samples_per_batch=args.samples_per_batch,
+                                  sample_cache=args.sample_cache,
+                                  sample_seed=args.sample_seed,
+                                  max_std=args.max_std,
+                                  min_effective_sample_size=args.min_effective_sample_size,
+                                  min_samples=args.min_samples)
 
     logger.info('Finished evaluating.')
     logger.info('Metrics:')
@@ -0,0 +1,77 @@
+import argparse
+import logging
+
+from allennlp.commands.subcommand import Subcommand
+from allennlp.common.checks import check_for_gpu
+from allennlp.models.archival import load_archive
+from allennlp.predictors.predictor import Predictor
+
+from kglm.service import make_server
+
+logger = logging.getLogger(__name__)
+
+
+class Serve(Subcommand):
+    def add_subparser(self, name: str, parser: argparse._SubParsersAction) -> argparse.ArgumentParser:
+        # pylint: disable=protected-access
+        description = '''Serve predictions from an archived model over HTTP, batching concurrent requests'''
+        subparser = parser.add_parser(name, description=description,
+                                      help='Serve predictions from a model')
+
+        subparser.add_argument('archive_file', type=str, help='path to an archived trained model')
+
+        subparser.add_argument('--predictor',
+                               type=str,
+                               default='kglm',
+                               help='name of the predictor to use')
+
+        subparser.add_argument('--host', type=str, default='127.0.0.1', help='interface to serve on')
+
+        subparser.add_argument('--port', type=int, default=8000, help='port to serve on')
+
+        subparser.add_argument('--max-batch-size',
+                               type=int,
+                               default=32,
+                               help='maximum number of requests in a batch')
+
+        subparser.add_argument('--max-tokens',
+                               type=int,
+                               default=None,
+                               help='maximum number of (padded) tokens in a batch')
+
+        subparser.add_argument('--max-latency-ms',
+                               type=float,
+                               default=50,
+                               help='maximum time a request waits to be batched with others')
+
+        subparser.add_argument('--cuda-device',
+                               type=int,
+                               default=-1,
+                               help='id of GPU to use (if any)')
+
+        subparser.add_argument('-o', '--overrides',
+                               type=str,
+                               default="",
+                               help='a JSON structure used to override the experiment configuration')
+
+        subparser.set_defaults(func=serve_from_args)
+
+        return subparser
+
+
+def serve_from_args(args: argparse.Namespace) -> None:
+    check_for_gpu(args.cuda_device)
+    archive = load_archive(args.archive_file, args.cuda_device, args.overrides)
+    predictor = Predictor.from_archive(archive, args.predictor)
+    server = make_server(predictor,
+                         host=args.host,
+                         port=args.port,
+                         max_batch_size=args.max_batch_size,
+                         max_tokens=args.max_tokens,
+                         max_latency=args.max_latency_ms / 1000)
+    logger.info('Serving on http://%s:%i/predict', args.host, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        server.batcher.close()
+        server.server_close()
@@ -1,4 +1,5 @@
 import logging
+import os
 import pickle
 from typing import Dict, List, Tuple
 
@@ -15,6 +16,9 @@ AliasList = List[List[str]]
 MAX_ALIASES = 4
 MAX_TOKENS = 8
 
+# Names of the arrays making up a pre-tokenized alias database (see ``AliasDatabase.save``).
+PRETOKENIZED_ARRAYS = ('entities', 'token_bytes', 'token_offsets', 'alias_tokens', 'local_ids')
+
 
 def tokenize_to_string(text: str, tokenizer: Tokenizer) -> List[str]:
     """Sigh"""
@@ -22,21 +26,46 @@ def tokenize_to_string(text: str, tokenizer: Tokenizer) -> List[str]:
 
 
 class AliasDatabase:
-    """A Database of Aliases"""
+    """
+    A Database of Aliases
+
+    Parameters
+    ----------
+    token_lookup : ``Dict[str, AliasList]``
+        Maps entities to their tokenized aliases.
+    id_map_lookup : ``Dict[str, Dict[str, int]]``
+        Maps entities to a dictionary mapping alias tokens to their entity-local ids.
+    id_array_lookup : ``Dict[str, np.ndarray]``
+        Maps entities to an array of shape ``(num_aliases, max_alias_length)`` containing the
+        local ids of the alias tokens.
+    pretokenized_arrays : ``Dict[str, np.ndarray]``, optional
+        The (typically memory-mapped) arrays of a pre-tokenized alias database. If given, entries
+        missing from the above lookups are decoded from these arrays on demand.
+    """
     def __init__(self,
                  token_lookup: Dict[str, AliasList],
                  id_map_lookup: Dict[str, Dict[str, int]],
-                 id_array_lookup: Dict[str, np.ndarray]) -> None:
+                 id_array_lookup: Dict[str, np.ndarray],
+                 pretokenized_arrays: Dict[str, np.ndarray] = None) -> None:
         self._token_lookup = token_lookup or {}
         self._id_map_lookup = id_map_lookup or {}
         self._id_array_lookup = id_array_lookup or {}
+        self._pretokenized_arrays = pretokenized_arrays
 
         self.is_tensorized = False
-        self._global_id_lookup: List[torch.Tensor] = []
-        self._local_id_lookup: List[torch.Tensor] = []
+        self._global_id_lookup: torch.Tensor = None
+        self._local_id_lookup: torch.Tensor = None
 
     @classmethod
     def load(cls, path: str):
+        """
+        Loads an alias database. ``path`` is either a pickled dictionary mapping entities to
+        lists of aliases, or a directory containing a pre-tokenized database written by
+        ``AliasDatabase.save`` (see the ``build-alias-database`` command). The latter is much
+        faster to load, since nothing needs to be tokenized and the arrays are memory-mapped.
+        """
+        if os.path.isdir(path):
+            return cls._load_pretokenized(path)
 
         logger.info('Loading alias database from "%s". This will probably take a second.', path)
         # TODO: Pretokenize the database to match the tokenization of the data itself. This
@@ -78,7 +107,119 @@ class AliasDatabase:
                    id_map_lookup=id_map_lookup,
                    id_array_lookup=id_array_lookup)
 
+    @classmethod
+    def _load_pretokenized(cls, path: str):
+        logger.info('Loading pre-tokenized alias database from "%s".', path)
+        # Memory-mapping the arrays means that only the pages which are actually used get read,
+        # and that they are shared between processes loading the same database.
+        pretokenized_arrays = {
+                name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                for name in PRETOKENIZED_ARRAYS
+        }
+        return cls(token_lookup=None,
+                   id_map_lookup=None,
+                   id_array_lookup=None,
+                   pretokenized_arrays=pretokenized_arrays)
+
+    def save(self, path: str) -> None:
+        """
+        Saves the alias database in a pre-tokenized binary format, which can be memory-mapped by
+        ``AliasDatabase.load``. The format is a directory containing the following arrays:
+
+            - ``entities``: The sorted entity ids.
+            - ``token_bytes``, ``token_offsets``: The UTF-8 encoded alias tokens, concatenated
+              together. Token ``i`` is given by the slice ``token_offsets[i]:token_offsets[i+1]``.
+              Token ``0`` is the empty string, and is used for padding.
+            - ``alias_tokens``: An array of shape ``(num_entities, MAX_ALIASES, MAX_TOKENS)``
+              containing the index of each alias token.
+            - ``local_ids``: An array of the same shape containing the local id of each alias
+              token.
+        """
+        entities = sorted(self._entities())
+        num_entities = len(entities)
+
+        token_index: Dict[str, int] = {'': 0}
+        alias_tokens = np.zeros((num_entities, MAX_ALIASES, MAX_TOKENS), dtype=np.int32)
+        local_ids = np.zeros((num_entities, MAX_ALIASES, MAX_TOKENS), dtype=np.int32)
+        for i, entity in enumerate(Tqdm.tqdm(entities)):
+            self._maybe_decode(entity)
+            for j, tokenized_alias in enumerate(self._token_lookup[entity]):
+                for k, token in enumerate(tokenized_alias):
+                    if token not in token_index:
+                        token_index[token] = len(token_index)
+                    alias_tokens[i, j, k] = token_index[token]
+            id_array = self._id_array_lookup[entity]
+            num_aliases, alias_length = id_array.shape
+            local_ids[i, :num_aliases, :alias_length] = id_array
+
+        encoded_tokens = [token.encode('utf-8') for token in token_index]
+        token_offsets = np.zeros(len(encoded_tokens) + 1, dtype=np.int64)
+        token_offsets[1:] = np.cumsum([len(encoded) for encoded in encoded_tokens])
+        token_bytes = np.frombuffer(b''.join(encoded_tokens), dtype=np.uint8)
+
+        arrays = {
+                'entities': np.array(entities, dtype=str),
+                'token_bytes': token_bytes,
+                'token_offsets': token_offsets,
+                'alias_tokens': alias_tokens,
+                'local_ids': local_ids
+        }
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+    def _entities(self) -> List[str]:
+        if self._pretokenized_arrays is not None:
+            return self._pretokenized_arrays['entities'].tolist()
+        return list(self._token_lookup.keys())
+
+    def _token_string(self, index: int) -> str:
+        token_bytes = self._pretokenized_arrays['token_bytes']
+        token_offsets = self._pretokenized_arrays['token_offsets']
+        start, end = token_offsets[index], token_offsets[index + 1]
+        return token_bytes[start:end].tobytes().decode('utf-8')
+
+    def _entity_rows(self, entities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the rows of the pre-tokenized arrays corresponding to the given entities. Returns
+        the rows along with a boolean array indicating which entities are in the database.
+        """
+        sorted_entities = self._pretokenized_arrays['entities']
+        rows = np.searchsorted(sorted_entities, entities)
+        rows = np.minimum(rows, len(sorted_entities) - 1)
+        found = sorted_entities[rows] == entities
+        return rows, found
+
+    def _maybe_decode(self, entity: str) -> None:
+        """
+        Decodes the entries of the given entity from the pre-tokenized arrays (if needed), and
+        adds them to the lookups.
+        """
+        if self._pretokenized_arrays is None or entity in self._token_lookup:
+            return
+        rows, found = self._entity_rows(np.array([entity]))
+        if not found[0]:
+            return
+        alias_tokens = self._pretokenized_arrays['alias_tokens'][rows[0]]
+        local_ids = self._pretokenized_arrays['local_ids'][rows[0]]
+
+        tokenized_aliases: AliasList = []
+        id_map: Dict[str, int] = {}
+        for alias_indices, alias_ids in zip(alias_tokens, local_ids):
+            tokenized_alias = [self._token_string(index) for index in alias_indices if index != 0]
+            if not tokenized_alias:
+                break
+            tokenized_aliases.append(tokenized_alias)
+            id_map.update(zip(tokenized_alias, alias_ids.tolist()))
+        num_aliases = len(tokenized_aliases)
+        max_alias_length = max((len(tokenized_alias) for tokenized_alias in tokenized_aliases), default=0)
+
+        self._token_lookup[entity] = tokenized_aliases
+        self._id_map_lookup[entity] = id_map
+        self._id_array_lookup[entity] = np.array(local_ids[:num_aliases, :max_alias_length], dtype=int)
+
     def token_to_uid(self, entity: str, token: str) -> int:
+        self._maybe_decode(entity)
         if entity in self._id_map_lookup:
             id_map = self._id_map_lookup[entity]
             if token in id_map:
@@ -87,62 +228,104 @@ class AliasDatabase:
 
     def tensorize(self, vocab: Vocabulary):
         """
-        Creates a list of tensors from the alias lookup.
+        Creates a pair of lookup tensors from the alias lookup.
+
+        After dataset creation, we'll mainly want to work with alias lists as padded tensors.
+        This needs to be done **after** the vocabulary has been created. Accordingly, in our
+        current approach, this method must be called in the forward pass of the model (since the
+        operation is rather expensive we'll make sure that it doesn't anything after the first
+        time it is called).
 
-        After dataset creation, we'll mainly want to work with alias lists as lists of padded
-        tensors and their associated masks. This needs to be done **after** the vocabulary has
-        been created. Accordingly, in our current approach, this method must be called in the
-        forward pass of the model (since the operation is rather expensive we'll make sure that
-        it doesn't anything after the first time it is called).
+        The aliases of every entity in the ``raw_entity_ids`` namespace are packed into two
+        tensors of shape ``(num_entities, MAX_ALIASES, MAX_TOKENS)``: one containing the ids of
+        the alias tokens in the global vocabulary, and one containing their entity-local ids.
+        This allows ``lookup`` to be performed using a single gather.
         """
         # This operation is expensive, only do it once.
         if self.is_tensorized:
             return
 
+        if self._pretokenized_arrays is not None:
+            self._tensorize_pretokenized(vocab)
+            return
+
         entity_idx_to_token = vocab.get_index_to_token_vocabulary('raw_entity_ids')
-        for i in range(len(entity_idx_to_token)):  # pylint: disable=C0200
+        num_entities = len(entity_idx_to_token)
+        global_id_array = np.zeros((num_entities, MAX_ALIASES, MAX_TOKENS), dtype=np.int64)
+        local_id_array = np.zeros((num_entities, MAX_ALIASES, MAX_TOKENS), dtype=np.int64)
+        for i in range(num_entities):
             entity = entity_idx_to_token[i]
             try:
                 tokenized_aliases = self._token_lookup[entity]
             except KeyError:
-                # If we encounter non-entity tokens (e.g. padding and null) then just add
-                # a blank placeholder - these should not be encountered during training.
-                self._global_id_lookup.append(None)
-                self._local_id_lookup.append(None)
+                # If we encounter non-entity tokens (e.g. padding and null) then just leave the
+                # rows blank - these should not be encountered during training.
                 continue
 
-            # Construct tensor of alias token indices from the global vocabulary.
-            num_aliases = len(tokenized_aliases)
-            max_alias_length = max(len(tokenized_alias) for tokenized_alias in tokenized_aliases)
-            global_id_tensor = torch.zeros(num_aliases, max_alias_length, dtype=torch.int64,
-                                           requires_grad=False)
+            # Fill in alias token indices from the global vocabulary.
             for j, tokenized_alias in enumerate(tokenized_aliases):
                 for k, token in enumerate(tokenized_alias):
                     # WARNING: Extremely janky cast to string
-                    global_id_tensor[j, k] = vocab.get_token_index(str(token), 'tokens')
-            self._global_id_lookup.append(global_id_tensor)
+                    global_id_array[i, j, k] = vocab.get_token_index(str(token), 'tokens')
 
-            # Convert array of local alias token indices into a tensor
-            local_id_tensor = torch.tensor(self._id_array_lookup[entity], requires_grad=False)  # pylint: disable=not-callable
-            self._local_id_lookup.append(local_id_tensor)
+            # Copy over the array of local alias token indices
+            id_array = self._id_array_lookup[entity]
+            num_aliases, alias_length = id_array.shape
+            local_id_array[i, :num_aliases, :alias_length] = id_array
+
+        self._global_id_lookup = torch.from_numpy(global_id_array)
+        self._local_id_lookup = torch.from_numpy(local_id_array)
+
+        self.is_tensorized = True
+
+    def _tensorize_pretokenized(self, vocab: Vocabulary) -> None:
+        # Same as ``tensorize``, except we can directly gather the rows of the pre-tokenized
+        # arrays, and only need to look up the vocabulary ids of their unique tokens.
+        entity_idx_to_token = vocab.get_index_to_token_vocabulary('raw_entity_ids')
+        num_entities = len(entity_idx_to_token)
+        entities = np.array([entity_idx_to_token[i] for i in range(num_entities)], dtype=str)
+        rows, found = self._entity_rows(entities)
+        found = found.reshape(-1, 1, 1)
+
+        alias_tokens = np.where(found, self._pretokenized_arrays['alias_tokens'][rows], 0)
+        unique_tokens, inverse = np.unique(alias_tokens, return_inverse=True)
+        vocab_ids = np.array([vocab.get_token_index(self._token_string(index), 'tokens')
+                              if index != 0 else 0 for index in unique_tokens], dtype=np.int64)
+        global_id_array = vocab_ids[inverse].reshape(alias_tokens.shape)
+        local_id_array = np.where(found, self._pretokenized_arrays['local_ids'][rows], 0)
+
+        self._global_id_lookup = torch.from_numpy(global_id_array)
+        self._local_id_lookup = torch.from_numpy(local_id_array.astype(np.int64))
 
         self.is_tensorized = True
 
     def lookup(self, entity_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        # Initialize empty tensors and fill them using the lookup
+        """
+        Looks up the aliases of the given entities.
+
+        Parameters
+        ----------
+        entity_ids : ``torch.Tensor``
+            A tensor of shape ``(batch_size, sequence_length)`` whose elements are ids in the
+            ``raw_entity_ids`` namespace.
+
+        Returns
+        -------
+        A tuple ``(global_tensor, local_tensor)`` of tensors with shape ``(batch_size,
+        sequence_length, MAX_ALIASES, MAX_TOKENS)`` containing the global and local ids of the
+        alias tokens, respectively.
+        """
+        # The lookup tables are moved to the device of the inputs the first time they are used
+        # there, and kept there afterwards to avoid copying them on every call.
+        if self._global_id_lookup.device != entity_ids.device:
+            self._global_id_lookup = self._global_id_lookup.to(entity_ids.device)
+            self._local_id_lookup = self._local_id_lookup.to(entity_ids.device)
+
         batch_size, sequence_length = entity_ids.shape
-        global_tensor = entity_ids.new_zeros(batch_size, sequence_length, MAX_ALIASES, MAX_TOKENS,
-                                             requires_grad=False)
-        local_tensor = entity_ids.new_zeros(batch_size, sequence_length, MAX_ALIASES, MAX_TOKENS,
-                                            requires_grad=False)
-        for i in range(batch_size):
-            for j in range(sequence_length):
-                entity_id = entity_ids[i, j]
-                local_indices = self._local_id_lookup[entity_id]
-                global_indices = self._global_id_lookup[entity_id]
-                if local_indices is not None:
-                    num_aliases, alias_length = local_indices.shape
-                    local_tensor[i, j, :num_aliases, :alias_length] = local_indices
-                    global_tensor[i, j, :num_aliases, :alias_length] = global_indices
+        flattened = entity_ids.contiguous().view(-1)
+        global_tensor = self._global_id_lookup.index_select(0, flattened)
+        global_tensor = global_tensor.view(batch_size, sequence_length, MAX_ALIASES, MAX_TOKENS)
+        local_tensor = self._local_id_lookup.index_select(0, flattened)
+        local_tensor = local_tensor.view(batch_size, sequence_length, MAX_ALIASES, MAX_TOKENS)
 
         return global_tensor, local_tensor
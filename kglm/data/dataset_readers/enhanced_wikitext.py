@@ -1,9 +1,13 @@
 """
 Readers for the enhanced Wikitext dataset.
 """
-from typing import Any, Dict, Iterable, List, Set
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
+import pickle
 
 from allennlp.common.checks import ConfigurationError
 from allennlp.common.file_utils import cached_path
@@ -12,7 +16,7 @@ from allennlp.data.fields import ListField, MetadataField, TextField
 from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer
 from allennlp.data.tokenizers import Token
-from allennlp.data.vocabulary import DEFAULT_PADDING_TOKEN
+from allennlp.data.vocabulary import DEFAULT_PADDING_TOKEN, Vocabulary
 import numpy as np
 from overrides import overrides
 
@@ -28,6 +32,47 @@ def _flatten(nested: Iterable[str]):
     return [x for seq in nested for x in seq]
 
 
+def _shard_offsets(file_path: str, num_shards: int) -> List[Tuple[int, int]]:
+    """
+    Splits a file into (approximately) equally sized shards. Shards are given as ``(start, end)``
+    byte offsets, aligned to the start of lines.
+    """
+    file_size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, num_shards):
+            f.seek(max(file_size * i // num_shards, boundaries[-1]))
+            if f.tell() > 0:
+                f.readline()
+            boundaries.append(min(f.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+
+# The reader used by worker processes. Set by ``_init_worker`` when the worker is started, so that
+# the reader (and its alias database) is not pickled for every shard.
+_WORKER_READER: 'EnhancedWikitextKglmReader' = None
+
+
+def _init_worker(reader: 'EnhancedWikitextKglmReader') -> None:
+    global _WORKER_READER  # pylint: disable=global-statement
+    _WORKER_READER = reader
+
+
+def _process_shard(args: Tuple[str, int, int]) -> List[Dict[str, Any]]:
+    file_path, start, end = args
+    processed = []
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            data = json.loads(line.decode('utf-8'))
+            processed.append(_WORKER_READER._process(data))  # pylint: disable=protected-access
+    return processed
+
+
 @DatasetReader.register('enhanced-wikitext')
 class EnhancedWikitextReader(DatasetReader):
     def __init__(self,
@@ -125,6 +170,25 @@ def normalize_entity_id(raw_entity_id: str) -> str:
     return entity_id
 
 
+def entity_namespace_maps(vocab: Vocabulary) -> Tuple[List[int], List[int]]:
+    """
+    Entities are predicted in the ``entity_ids`` namespace, but their aliases and the tails of
+    knowledge graph edges are in the ``raw_entity_ids`` namespace. Returns a pair of lists mapping
+    the indices of each namespace to the other (entities without a counterpart are mapped to 0).
+    """
+    entity_tokens = vocab.get_index_to_token_vocabulary('entity_ids')
+    raw_entity_tokens = vocab.get_index_to_token_vocabulary('raw_entity_ids')
+    entity_to_raw = [vocab.get_token_index(entity_tokens[i], 'raw_entity_ids')
+                     for i in range(len(entity_tokens))]
+    raw_to_entity = []
+    for i in range(len(raw_entity_tokens)):
+        entity = normalize_entity_id(raw_entity_tokens[i])
+        raw_to_entity.append(0 if entity is None else vocab.get_token_index(entity, 'entity_ids'))
+    entity_to_raw[0] = 0
+    raw_to_entity[0] = 0
+    return entity_to_raw, raw_to_entity
+
+
 @DatasetReader.register('enhanced-wikitext-kglm')
 class EnhancedWikitextKglmReader(DatasetReader):
 
@@ -135,16 +199,26 @@ class EnhancedWikitextKglmReader(DatasetReader):
                  entity_indexers: Dict[str, TokenIndexer] = None,
                  raw_entity_indexers: Dict[str, TokenIndexer] = None,
                  relation_indexers: Dict[str, TokenIndexer] = None,
+                 num_workers: int = 0,
+                 cache_directory: str = None,
                  lazy: bool = False) -> None:
         """
         Parameters
         ----------
         alias_database_path : str
-            Path to the alias database.
+            Path to the alias database. Either a pickle file, or a directory containing a
+            pre-tokenized database (see the ``build-alias-database`` command).
         mode : str, optional (default="generative")
             One of "discriminative" or "generative", indicating whether generated
             instances are suitable for the discriminative or generative version of
             the model.
+        num_workers : int, optional (default=0)
+            If greater than 0, the input file is split into shards which are processed by this
+            many worker processes. Instances are still produced in the order of the input file.
+        cache_directory : str, optional (default=None)
+            If given, the processed annotations (e.g. entity ids and alias copy indices) of each
+            input file are cached in this directory, and subsequent reads of the same file (using
+            the same alias database and mode) load them from the cache.
         """
         super().__init__(lazy)
         if mode not in {"discriminative", "generative"}:
@@ -172,34 +246,96 @@ class EnhancedWikitextKglmReader(DatasetReader):
                 not isinstance(self._relation_indexers['relations'], SingleIdTokenIndexer):
             raise ConfigurationError("EnhancedWikitextReader expects 'relation_indexers' to contain "
                                      "a 'single_id' token indexer called 'relations'.")
+        self._alias_database_path = alias_database_path
         self._alias_database = AliasDatabase.load(path=alias_database_path)
+        self._num_workers = num_workers
+        self._cache_directory = cache_directory
 
     @overrides
     def _read(self, file_path: str) -> Iterable[Instance]:
-        with open(file_path, 'r') as f:
-            for line in f:
-                data = json.loads(line)
-                yield self.text_to_instance(data)
+        if self._cache_directory is None:
+            processed_data = self._read_processed(file_path)
+        else:
+            cache_path = self._cache_path(file_path)
+            if os.path.exists(cache_path):
+                logger.info('Loading processed data from cache: %s', cache_path)
+                processed_data = self._read_cache(cache_path)
+            else:
+                processed_data = self._write_cache(self._read_processed(file_path), cache_path)
+
+        for processed in processed_data:
+            yield self._build_instance(processed)
+
+    def _read_processed(self, file_path: str) -> Iterator[Dict[str, Any]]:
+        if self._num_workers <= 0:
+            with open(file_path, 'r') as f:
+                for line in f:
+                    data = json.loads(line)
+                    yield self._process(data)
+            return
+
+        # Use a few shards per worker, so that the work is balanced and each worker only needs to
+        # send back a small part of the data at a time.
+        shards = [(file_path, start, end) for start, end in
+                  _shard_offsets(file_path, 4 * self._num_workers)]
+        # Workers are forked so that they share the alias database with the parent process.
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self._num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            for processed_shard in pool.imap(_process_shard, shards):
+                yield from processed_shard
+
+    def _cache_path(self, file_path: str) -> str:
+        md5 = hashlib.md5()
+        for key in (os.path.abspath(file_path),
+                    os.path.getmtime(file_path),
+                    os.path.abspath(self._alias_database_path),
+                    os.path.getmtime(self._alias_database_path),
+                    self._mode):
+            md5.update(str(key).encode('utf-8') + b'\0')
+        return os.path.join(self._cache_directory, md5.hexdigest() + '.pkl')
+
+    @staticmethod
+    def _read_cache(cache_path: str) -> Iterator[Dict[str, Any]]:
+        with open(cache_path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    @staticmethod
+    def _write_cache(processed_data: Iterable[Dict[str, Any]],
+                     cache_path: str) -> Iterator[Dict[str, Any]]:
+        # The cache is written to a temporary file while the data is being read, and only moved
+        # into place once all of the data has been read.
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '%s.%i.tmp' % (cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                for processed in processed_data:
+                    pickle.dump(processed, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield processed
+            os.replace(temp_path, cache_path)
+            logger.info('Cached processed data to: %s', cache_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
     @overrides
     def text_to_instance(self, data: Dict[str, Any]) -> Instance:  # pylint: disable=arguments-differ
+        return self._build_instance(self._process(data))
+
+    def _process(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Processes the tokens and annotations of a document into plain lists and arrays (which are
+        cheap to send between processes and to cache), from which ``_build_instance`` creates the
+        ``Instance``.
+        """
         # Flatten and pad tokens
         tokens = _flatten(data['tokens'])
         tokens = ['@@START@@', *tokens, '@@END@@']
-        source = [Token(x) for x in tokens[:-1]]
-        target = [Token(x) for x in tokens[1:]]
-        assert len(source) == len(target)
-        fields = {
-            'source': TextField(source, self._token_indexers)
-        }
-
-        if self._mode == "generative":
-            fields["target"] = TextField(target, self._token_indexers)
-
-        meta_fields = {
-            'tokens': tokens,
-            'alias_database': self._alias_database
-        }
+        processed: Dict[str, Any] = {'tokens': tokens}
+        target = tokens[1:]
 
         # Process annotations
         if 'annotations' in data:
@@ -260,28 +396,59 @@ class EnhancedWikitextKglmReader(DatasetReader):
                         alias_copy_inds[i+offset] = self._alias_database.token_to_uid(raw_entity_id,
                                                                                       tokens[i+1])
 
-            # Convert to fields
+            processed['raw_entity_ids'] = raw_entity_ids
+            processed['entity_ids'] = entity_ids
+            processed['parent_ids'] = parent_ids
+            processed['relations'] = relations
+            processed['mention_type'] = mention_type
+            processed['shortlist'] = shortlist
+            processed['shortlist_inds'] = shortlist_inds
+            if self._mode == "generative":
+                processed['alias_copy_inds'] = alias_copy_inds
+
+        return processed
+
+    def _build_instance(self, processed: Dict[str, Any]) -> Instance:
+        tokens = processed['tokens']
+        source = [Token(x) for x in tokens[:-1]]
+        target = [Token(x) for x in tokens[1:]]
+        assert len(source) == len(target)
+        fields = {
+            'source': TextField(source, self._token_indexers)
+        }
+
+        if self._mode == "generative":
+            fields["target"] = TextField(target, self._token_indexers)
+
+        meta_fields = {
+            'tokens': tokens,
+            'alias_database': self._alias_database
+        }
+
+        # Convert annotations to fields
+        if 'raw_entity_ids' in processed:
             fields['raw_entity_ids'] = TextField(
-                [Token(x) for x in raw_entity_ids],
+                [Token(x) for x in processed['raw_entity_ids']],
                 token_indexers=self._raw_entity_indexers)
             fields['entity_ids'] = TextField(
-                [Token(x) for x in entity_ids],
+                [Token(x) for x in processed['entity_ids']],
                 token_indexers=self._entity_indexers)
             fields['parent_ids'] = ListField([
                 TextField([Token(x) for x in sublist],
                           token_indexers=self._entity_indexers)
-                for sublist in parent_ids])
+                for sublist in processed['parent_ids']])
             fields['relations'] = ListField([
                 TextField([Token(x) for x in sublist],
                           token_indexers=self._relation_indexers)
-                for sublist in relations])
-            fields['mention_type'] = SequentialArrayField(mention_type, dtype=np.int64)
+                for sublist in processed['relations']])
+            fields['mention_type'] = SequentialArrayField(processed['mention_type'], dtype=np.int64)
             fields['shortlist'] = TextField(
-                [Token(x) for x in shortlist],
+                [Token(x) for x in processed['shortlist']],
                 token_indexers=self._entity_indexers)
-            fields['shortlist_inds'] = SequentialArrayField(shortlist_inds, dtype=np.int64)
+            fields['shortlist_inds'] = SequentialArrayField(processed['shortlist_inds'], dtype=np.int64)
             if self._mode == "generative":
-                fields['alias_copy_inds'] = SequentialArrayField(alias_copy_inds, dtype=np.int64)
+                fields['alias_copy_inds'] = SequentialArrayField(processed['alias_copy_inds'],
+                                                                 dtype=np.int64)
 
         fields['metadata'] = MetadataField(meta_fields)
 
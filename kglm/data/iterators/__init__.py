@@ -1,3 +1,4 @@
 from .awd_iterator import AwdIterator
 from .fancy_iterator import FancyIterator
 from .split_iterator import Splitter, SplitIterator
+from .streaming_fancy_iterator import StreamingFancyIterator
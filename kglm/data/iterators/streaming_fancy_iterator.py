@@ -0,0 +1,166 @@
+import logging
+import itertools
+import random
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Type, Union
+
+from allennlp.data.fields import Field
+from allennlp.data.instance import Instance
+from allennlp.data.iterators.data_iterator import DataIterator
+import torch
+
+logger = logging.getLogger(__name__)
+
+TensorDict = Dict[str, Union[torch.Tensor, Dict[str, torch.Tensor]]]  # pylint: disable=invalid-name
+
+
+class _Document(NamedTuple):
+    length: int
+    split_tensors: Dict[str, Any]
+    constant_tensors: Dict[str, Any]
+
+
+def _pad_and_stack(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """Stacks a list of tensors, zero-padding every dimension to the largest size in the list."""
+    max_shape = [max(sizes) for sizes in zip(*(tensor.shape for tensor in tensors))]
+    output = tensors[0].new_zeros((len(tensors), *max_shape))
+    for i, tensor in enumerate(tensors):
+        output[(i, *(slice(0, size) for size in tensor.shape))] = tensor
+    return output
+
+
+def _is_tensor_dict(value: Any) -> bool:
+    """Whether a value is a (possibly nested) dictionary of tensors, e.g. from a ``TextField``."""
+    if isinstance(value, torch.Tensor):
+        return True
+    return isinstance(value, dict) and all(_is_tensor_dict(x) for x in value.values())
+
+
+def _collate(values: List[Any], field_class: Type[Field] = None) -> Any:
+    if isinstance(values[0], torch.Tensor):
+        return _pad_and_stack(values)
+    elif _is_tensor_dict(values[0]):
+        return {key: _collate([value[key] for value in values]) for key in values[0]}
+    else:
+        # Non-tensor fields (e.g. ``MetadataField``s, whose values are usually dictionaries) are
+        # batched the same way that ``Batch`` would batch them.
+        return field_class.batch_tensors(values)
+
+
+def _slice(tensors: Any, start: int, end: int) -> Any:
+    if isinstance(tensors, dict):
+        return {key: _slice(value, start, end) for key, value in tensors.items()}
+    return tensors[start:end]
+
+
+@DataIterator.register('streaming-fancy')
+class StreamingFancyIterator(DataIterator):
+    """
+    A streaming version of the ``FancyIterator``. Produces the same batches of split-size
+    chunks, except that:
+
+        - Each document is indexed and tensorized exactly once (instead of once per chunk), and
+          chunks are slices (i.e. views) of these tensors.
+        - Instead of being distributed across the ``batch_size`` lanes up front, a document is
+          only read once a lane has finished its previous document. Accordingly, only
+          ``batch_size`` documents need to be kept in memory (or ``max_instances_in_memory`` when
+          shuffling).
+
+    Iteration stops once the input is exhausted and a lane has no document to continue with.
+
+    Parameters
+    ----------
+    splitting_keys : ``List[str]``
+        The fields which are split into chunks. All must share the same sequence dimension.
+    split_size : ``int``
+        The (maximum) length of each chunk.
+    """
+    def __init__(self,
+                 splitting_keys: List[str],
+                 split_size: int,
+                 batch_size: int = 32,
+                 instances_per_epoch: int = None,
+                 max_instances_in_memory: int = None,
+                 cache_instances: bool = False,
+                 track_epoch: bool = False,
+                 maximum_samples_per_batch: Tuple[str, int] = None) -> None:
+        super(StreamingFancyIterator, self).__init__(
+                batch_size=batch_size,
+                instances_per_epoch=instances_per_epoch,
+                max_instances_in_memory=max_instances_in_memory,
+                cache_instances=cache_instances,
+                track_epoch=track_epoch,
+                maximum_samples_per_batch=maximum_samples_per_batch)
+        self._splitting_keys = splitting_keys
+        self._split_size = split_size
+        self._field_classes: Dict[str, Type[Field]] = {}
+
+    def __call__(self,
+                 instances: Iterable[Instance],
+                 num_epochs: int = None,
+                 shuffle: bool = False) -> Iterator[Tuple[TensorDict, float]]:
+        key = id(instances)
+        starting_epoch = self._epochs[key]
+
+        if num_epochs is None:
+            epochs: Iterable[int] = itertools.count(starting_epoch)
+        else:
+            epochs = range(starting_epoch, starting_epoch + num_epochs)
+
+        for epoch in epochs:
+            documents = (self._tensorize(instance) for instance in self._stream(instances, shuffle))
+            for tensor_dict in self._generate_batches(documents):
+                if self._track_epoch:
+                    tensor_dict['epoch_num'] = [epoch] * self._batch_size
+                yield tensor_dict, 1
+
+            self._epochs[key] = epoch + 1
+
+    def _stream(self, instances: Iterable[Instance], shuffle: bool) -> Iterator[Instance]:
+        if not shuffle:
+            yield from instances
+            return
+        # When shuffling we can only shuffle the instances we have in memory.
+        for instance_list in self._memory_sized_lists(instances):
+            instance_list = list(instance_list)
+            random.shuffle(instance_list)
+            yield from instance_list
+
+    def _tensorize(self, instance: Instance) -> _Document:
+        if self.vocab is not None:
+            instance.index_fields(self.vocab)
+        for name, field in instance.fields.items():
+            self._field_classes.setdefault(name, type(field))
+        tensor_dict = instance.as_tensor_dict()
+        split_tensors = {key: tensor_dict.pop(key) for key in self._splitting_keys}
+        length = len(instance[self._splitting_keys[0]])
+        return _Document(length, split_tensors, tensor_dict)
+
+    def _generate_batches(self, documents: Iterator[_Document]) -> Iterator[TensorDict]:
+        lanes: List[Optional[_Document]] = [None] * self._batch_size
+        positions = [0] * self._batch_size
+        while True:
+            # Move any lanes which have reached the end of their document on to the next one.
+            for i, document in enumerate(lanes):
+                while document is None or positions[i] >= document.length:
+                    document = next(documents, None)
+                    if document is None:
+                        return
+                    positions[i] = 0
+                lanes[i] = document
+
+            # Signal the model to reset the lanes which start a new document.
+            reset = torch.tensor([position == 0 for position in positions], dtype=torch.uint8)
+            tensor_dict: TensorDict = {'reset': reset}
+            for key in self._splitting_keys:
+                chunks = [_slice(document.split_tensors[key], position, position + self._split_size)
+                          for document, position in zip(lanes, positions)]
+                tensor_dict[key] = _collate(chunks)
+            for key in lanes[0].constant_tensors:
+                values = [document.constant_tensors[key] for document in lanes]
+                tensor_dict[key] = _collate(values, self._field_classes[key])
+
+            positions = [position + self._split_size for position in positions]
+            yield tensor_dict
+
+    def get_num_batches(self, instances: Iterable[Instance]) -> float:
+        return 1
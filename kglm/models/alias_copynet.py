@@ -13,7 +13,8 @@ import torch
 import torch.nn.functional as F
 
 from kglm.data import AliasDatabase
-from kglm.modules import embedded_dropout, LockedDropout, WeightDrop
+from kglm.modules import (
+    embedded_dropout, AliasEncodingCache, LockedDropout, SplitCrossEntropyLoss, WeightDrop)
 from kglm.training.metrics import Ppl
 
 logger = logging.getLogger(__name__)
@@ -34,6 +35,12 @@ class AliasCopynet(Model):
         Used to encode the sequence of token embeddings.
     embedding_dim : ``int``
         The dimension of entity / length embeddings. Should match the encoder output size.
+    splits : ``List[int]``, optional (default=``[]``)
+        Splits to use in an adaptive softmax over the vocabulary when generating tokens. The copy
+        scores are normalized jointly with the head of the adaptive softmax. If empty, then a full
+        softmax is used.
+    alias_cache_size : ``int``, optional (default=4096)
+        The number of alias encodings cached during evaluation (0 disables the cache).
     """
     def __init__(self,
                  vocab: Vocabulary,
@@ -50,6 +57,8 @@ class AliasCopynet(Model):
                  alpha: float = 2.0,
                  beta: float = 1.0,
                  tie_weights: bool = False,
+                 splits: List[int] = [],
+                 alias_cache_size: int = 4096,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(AliasCopynet, self).__init__(vocab)
 
@@ -59,6 +68,7 @@ class AliasCopynet(Model):
         self._token_embedder = token_embedder._token_embedders['tokens']
         # self._entity_embedder = entity_embedder._token_embedders['entity_ids']
         self._alias_encoder = alias_encoder
+        self._alias_encoding_cache = AliasEncodingCache(max_size=alias_cache_size)
         self._hidden_size = hidden_size
         self._num_layers = num_layers
         self._tie_weights = tie_weights
@@ -119,6 +129,11 @@ class AliasCopynet(Model):
         if tie_weights:
             self._fc_generate.weight = self._token_embedder.weight
 
+        if splits:
+            self._split_cross_entropy = SplitCrossEntropyLoss(embedding_dim, splits)
+        else:
+            self._split_cross_entropy = None
+
         self._state: Optional[Dict[str, Any]]= None
 
         # Metrics
@@ -215,6 +230,14 @@ class AliasCopynet(Model):
         entity_loss = entity_loss / (mask.float().sum() + 1e-13)
         return entity_loss
 
+    def _encode_aliases(self, aliases: torch.Tensor) -> torch.Tensor:
+        embedded = self._token_embedder(aliases)
+        mask = aliases.gt(0)
+        encoded_aliases = self._alias_encoder(embedded, mask)
+
+        # Equation 8 in the CopyNet paper recommends applying the additional step.
+        return torch.tanh(self._fc_copy(encoded_aliases))
+
     def _copy_scores(self,
                      encoded: torch.Tensor,
                      alias_tokens: torch.Tensor) -> torch.Tensor:
@@ -227,13 +250,12 @@ class AliasCopynet(Model):
             return encoded.new_zeros((batch_size, sequence_length, num_aliases * alias_length),
                                      dtype=torch.float32)
 
-        # Embed and encode the alias tokens.
-        embedded = self._token_embedder(flattened)
-        mask = flattened.gt(0)
-        encoded_aliases = self._alias_encoder(embedded, mask)
-
-        # Equation 8 in the CopyNet paper recommends applying the additional step.
-        projected = torch.tanh(self._fc_copy(encoded_aliases))
+        # Embed and encode the alias tokens. Most positions share the same few aliases (or are
+        # padding), so we only encode each unique alias once and then scatter the results back to
+        # their original positions. During evaluation, encodings are also reused across batches.
+        unique_aliases, inverse = torch.unique(flattened, sorted=True, return_inverse=True, dim=0)
+        projected = self._alias_encoding_cache(unique_aliases, self._encode_aliases)
+        projected = projected.index_select(0, inverse.view(-1))
         projected = self._locked_dropout(projected, self._dropout)
 
         # This part gets a little funky - we need to make sure that the first dimension in
@@ -246,7 +268,7 @@ class AliasCopynet(Model):
         return copy_scores
 
     def _vocab_loss(self,
-                    generate_scores: torch.Tensor,
+                    encoded: torch.Tensor,
                     copy_scores: torch.Tensor,
                     target_tokens: torch.Tensor,
                     target_alias_indices: torch.Tensor,
@@ -254,30 +276,44 @@ class AliasCopynet(Model):
                     alias_indices: torch.Tensor,
                     alias_tokens: torch.Tensor,
                     mention_mask: torch.Tensor):
-        batch_size, sequence_length, vocab_size = generate_scores.shape
-        copy_sequence_length = copy_scores.shape[-1]
+        batch_size, sequence_length = target_tokens.shape
 
         # Flat sequences make life **much** easier.
+        flattened_encoded = encoded.contiguous().view(batch_size * sequence_length, -1)
+        flattened_copy_scores = copy_scores.view(batch_size * sequence_length, -1)
         flattened_targets = target_tokens.view(batch_size * sequence_length, 1)
         flattened_mask = mask.view(-1, 1).byte()
 
         # In order to obtain proper log probabilities we create a mask to omit padding alias tokens
         # from the calculation.
-        alias_mask = alias_indices.view(batch_size, sequence_length, -1).gt(0)
-        score_mask = mask.new_ones(batch_size, sequence_length, vocab_size + copy_sequence_length)
-        score_mask[:, :, vocab_size:] = alias_mask
-
-        # The log-probability distribution is then given by taking the masked log softmax.
-        concatenated_scores = torch.cat((generate_scores, copy_scores), dim=-1)
-        log_probs = masked_log_softmax(concatenated_scores, score_mask)
+        alias_mask = alias_indices.view(batch_size * sequence_length, -1).gt(0)
+
+        if self._split_cross_entropy is None:
+            # The log-probability distribution is given by taking the masked log softmax over the
+            # generate and copy scores.
+            generate_scores = self._fc_generate(flattened_encoded)
+            vocab_size = generate_scores.shape[-1]
+            score_mask = torch.cat((alias_mask.new_ones(generate_scores.shape), alias_mask), dim=-1)
+            concatenated_scores = torch.cat((generate_scores, flattened_copy_scores), dim=-1)
+            flattened_log_probs = masked_log_softmax(concatenated_scores, score_mask)
+            # The generated token log probabilities are simply gathered.
+            generate_log_probs_source_vocab = flattened_log_probs.gather(1, flattened_targets)
+            copy_log_probs = flattened_log_probs[:, vocab_size:]
+        else:
+            # When using an adaptive softmax the copy scores are normalized together with the head
+            # (and tombstones), and the tails are only computed for the tokens that need them.
+            generate_log_probs_source_vocab, copy_log_probs = self._split_cross_entropy.mixture_log_probs(
+                self._fc_generate.weight,
+                self._fc_generate.bias,
+                flattened_encoded,
+                flattened_targets.view(-1),
+                flattened_copy_scores,
+                alias_mask)
+            generate_log_probs_source_vocab = generate_log_probs_source_vocab.unsqueeze(1)
 
         # GENERATE LOSS ###
-        # The generated token loss is a simple cross-entropy calculation, we can just gather
-        # the log probabilties...
-        flattened_log_probs = log_probs.view(batch_size * sequence_length, -1)
-        generate_log_probs_source_vocab = flattened_log_probs.gather(1, flattened_targets)
-        # ...except we need to ignore the contribution of UNK tokens that are copied (only when
-        # computing the loss). To do that we create a mask which is 1 only if the token is not a
+        # We need to ignore the contribution of UNK tokens that are copied (only when computing the
+        # loss). To do that we create a mask which is 1 only if the token is not a
         # copied UNK (or padding).
         unks = target_tokens.eq(self._unk_index).view(-1, 1)
         copied = target_alias_indices.gt(0).view(-1, 1)
@@ -286,7 +322,6 @@ class AliasCopynet(Model):
         generate_log_probs_extended_vocab = generate_log_probs_source_vocab + (generate_mask.float() + 1e-45).log()
 
         # COPY LOSS ###
-        copy_log_probs = flattened_log_probs[:, vocab_size:]
         # When computing the loss we need to get the log probability of **only** the copied tokens.
         alias_indices = alias_indices.view(batch_size * sequence_length, -1)
         target_alias_indices = target_alias_indices.view(-1, 1)
@@ -410,14 +445,13 @@ class AliasCopynet(Model):
         # the encoder output - then feed through a linear layer.
         # concatenated = torch.cat((encoded, entity_embeddings), dim=-1)
         # condensed = self._fc_condense(concatenated)
-        generate_scores = self._fc_generate(encoded)
 
         # Predict copy-mode scores.
         alias_tokens, alias_inds = alias_database.lookup(entity_ids)
         copy_scores = self._copy_scores(encoded, alias_tokens)
 
         # Combine scores to get vocab loss
-        vocab_loss = self._vocab_loss(generate_scores,
+        vocab_loss = self._vocab_loss(encoded,
                                       copy_scores,
                                       target,
                                       alias_copy_inds,
@@ -458,6 +492,7 @@ class AliasCopynet(Model):
             'ppl': self._ppl.get_metric(reset),
             'upp': self._upp.get_metric(reset),
             'kg_ppl': self._kg_ppl.get_metric(reset),
-            'bg_ppl': self._bg_ppl.get_metric(reset)
+            'bg_ppl': self._bg_ppl.get_metric(reset),
+            'alias_cache_hit_rate': self._alias_encoding_cache.get_metric(reset)
         }
 
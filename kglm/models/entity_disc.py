@@ -146,8 +146,31 @@ class EntityNLMDiscriminator(Model):
 
         return output_dict
 
+    def encode(self, tokens: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes entire (unsplit) sequences of tokens, starting from a fresh encoder state. The
+        output can be repeated and passed to ``sample`` to draw multiple samples for the same
+        sequences while only encoding them once.
+
+        Parameters
+        ----------
+        tokens : ``Dict[str, torch.Tensor]``
+            A tensor of shape ``(batch_size, sequence_length)`` containing the sequence of
+            tokens.
+
+        Returns
+        -------
+        A tensor of shape ``(batch_size, sequence_length, embedding_dim)`` containing the hidden
+        states.
+        """
+        self._encoder.reset_states()
+        mask = get_text_field_mask(tokens)
+        embeddings = self._text_field_embedder(tokens)
+        return self._encoder(embeddings, mask)
+
     def sample(self,
-               tokens: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+               tokens: Dict[str, torch.Tensor],
+               encoded: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
         """
         Generates a sample from the discriminative model.
 
@@ -159,6 +182,8 @@ class EntityNLMDiscriminator(Model):
         tokens : ``Dict[str, torch.Tensor]``
             A tensor of shape ``(batch_size, sequence_length)`` containing the sequence of
             tokens.
+        encoded : ``torch.Tensor``, optional
+            The output of ``encode`` on ``tokens``. If given, the tokens are not re-encoded.
 
         Returns
         -------
@@ -184,8 +209,11 @@ class EntityNLMDiscriminator(Model):
 
         # Embed tokens and get RNN hidden state.
         mask = get_text_field_mask(tokens)
-        embeddings = self._text_field_embedder(tokens)
-        hidden = self._encoder(embeddings, mask)
+        if encoded is not None:
+            hidden = encoded
+        else:
+            embeddings = self._text_field_embedder(tokens)
+            hidden = self._encoder(embeddings, mask)
         prev_mention_lengths = tokens['tokens'].new_ones(batch_size)
 
         # Initialize outputs
@@ -231,7 +259,9 @@ class EntityNLMDiscriminator(Model):
                     mention_length_logp = F.log_softmax(mention_length_logits, dim=-1)
                     mention_length_prediction_logp, mention_length_predictions = sample_from_logp(mention_length_logp)
 
-                    # Write predictions
+                    # Write predictions. The predictions are embedding slots, which need to be
+                    # mapped back to entity ids.
+                    entity_id_predictions = self._dynamic_embeddings.slot_ids[predict_em, entity_id_predictions]
                     new_entity_mask = entity_id_predictions == 0
                     new_entity_labels = self._dynamic_embeddings.num_embeddings[predict_em]
                     entity_id_predictions[new_entity_mask] = new_entity_labels[new_entity_mask]
@@ -360,15 +390,16 @@ class EntityNLMDiscriminator(Model):
                     # time.
                     modified_entity_ids = current_entity_ids.clone()
                     modified_entity_ids[modified_entity_ids == self._dynamic_embeddings.num_embeddings] = 0
+                    modified_entity_slots = self._dynamic_embeddings.slots(modified_entity_ids)
                     entity_id_prediction_outputs = self._dynamic_embeddings(hidden=current_hidden,
                                                                             target=modified_entity_ids,
                                                                             mask=predict_em)
                     entity_id_loss = entity_id_loss + entity_id_prediction_outputs['loss'].sum()
                     self._entity_id_accuracy(predictions=entity_id_prediction_outputs['logits'],
-                                             gold_labels=modified_entity_ids[predict_em])
+                                             gold_labels=modified_entity_slots[predict_em])
 
                     # Equation 5 in the paper.
-                    predicted_entity_embeddings = self._dynamic_embeddings.embeddings[predict_em, modified_entity_ids[predict_em]]
+                    predicted_entity_embeddings = self._dynamic_embeddings.embeddings[predict_em, modified_entity_slots[predict_em]]
                     predicted_entity_embeddings = self._dropout(predicted_entity_embeddings)
                     concatenated = torch.cat((current_hidden[predict_em], predicted_entity_embeddings), dim=-1)
                     mention_length_logits = self._mention_length_projection(concatenated)
@@ -2,7 +2,7 @@
 Implementation of the EntityNLM from: https://arxiv.org/abs/1708.00781
 """
 import logging
-from typing import Dict, Optional, Union
+from typing import Dict, Optional, Tuple, Union
 
 from allennlp.nn.util import get_text_field_mask
 from allennlp.data.vocabulary import Vocabulary
@@ -18,6 +18,7 @@ from torch.nn import Parameter
 import torch.nn.functional as F
 
 from kglm.modules import DynamicEmbedding
+from kglm.modules.dynamic_embeddings import fused_add_and_update, fused_entity_logits
 # from kglm.training.metrics import Perplexity, UnknownPenalizedPerplexity
 
 logger = logging.getLogger(__name__)
@@ -26,6 +27,88 @@ logger = logging.getLogger(__name__)
 StateDict = Dict[str, Union[torch.Tensor]]  # pylint: disable=invalid-name
 
 
+def fused_entity_step(embeddings: torch.Tensor,
+                      num_embeddings: torch.Tensor,
+                      last_seen: torch.Tensor,
+                      slot_ids: torch.Tensor,
+                      last_used: torch.Tensor,
+                      hidden: torch.Tensor,
+                      projected_hidden: torch.Tensor,
+                      noise: torch.Tensor,
+                      initial_embedding: torch.Tensor,
+                      delta_weight: torch.Tensor,
+                      distance_scalar: torch.Tensor,
+                      current_entity_types: torch.Tensor,
+                      current_entity_ids: torch.Tensor,
+                      next_entity_ids: torch.Tensor,
+                      timestep: torch.Tensor,
+                      clock: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+    """
+    Performs a single timestep of the dynamic entity updates (see ``fused_add_and_update``) and
+    scores the entities which can be mentioned next. Like ``fused_add_and_update`` there is no
+    masked indexing or branching on the values of tensors, and every argument is a tensor, so the
+    function can be compiled using ``torch.jit.trace`` (the trace can be reused at every timestep
+    of batches with the same shapes).
+
+    Parameters
+    ----------
+    embeddings, num_embeddings, last_seen, slot_ids, last_used : ``torch.Tensor``
+        The state of the ``DynamicEmbedding`` module.
+    hidden : ``torch.Tensor``
+        A tensor of shape ``(batch_size, embedding_dim)`` containing the current hidden states.
+    projected_hidden : ``torch.Tensor``
+        The hidden states, projected by the transpose of the bilinear entity scoring weights.
+    noise : ``torch.Tensor``
+        A tensor of shape ``(batch_size, embedding_dim)`` added to the initial embedding of new
+        entities.
+    initial_embedding, delta_weight, distance_scalar : ``torch.Tensor``
+        The parameters of the ``DynamicEmbedding`` module.
+    current_entity_types, current_entity_ids, next_entity_ids : ``torch.Tensor``
+        Tensors of shape ``(batch_size,)``.
+    timestep : ``torch.Tensor``
+        A 0-dimensional tensor containing the current timestep.
+    clock : ``torch.Tensor``
+        A 0-dimensional tensor containing the current value of the ``DynamicEmbedding`` module's
+        eviction counter.
+
+    Returns
+    -------
+    A tuple ``(embeddings, num_embeddings, last_seen, slot_ids, last_used, next_entity_slots,
+    entity_id_logits, next_entity_embeddings)``, where the first five are the updated state,
+    ``next_entity_slots`` contains the slots of the next entities (unseen entities are mapped to
+    the null entity), ``entity_id_logits`` has shape ``(batch_size, max_embeddings)`` and
+    ``next_entity_embeddings`` has shape ``(batch_size, embedding_dim)``.
+    """
+    embeddings, num_embeddings, last_seen, slot_ids, last_used = fused_add_and_update(
+        embeddings=embeddings,
+        num_embeddings=num_embeddings,
+        last_seen=last_seen,
+        slot_ids=slot_ids,
+        last_used=last_used,
+        hidden=hidden,
+        noise=noise,
+        initial_embedding=initial_embedding,
+        delta_weight=delta_weight,
+        entity_types=current_entity_types,
+        entity_ids=current_entity_ids,
+        timestep=timestep,
+        clock=clock)
+
+    # Unseen next entities use the null embedding as a proxy (see ``EntityNLM._loop``).
+    next_entity_ids = next_entity_ids.masked_fill(next_entity_ids.eq(num_embeddings), 0)
+    next_entity_slots = DynamicEmbedding._find_slots(slot_ids, next_entity_ids)  # pylint: disable=protected-access
+
+    # Score the entities (see ``DynamicEmbedding.forward``).
+    entity_id_logits = fused_entity_logits(embeddings, last_seen, slot_ids, projected_hidden, distance_scalar)
+
+    batch_size, _, embedding_dim = embeddings.shape
+    gather_index = next_entity_slots.view(batch_size, 1, 1).expand(batch_size, 1, embedding_dim)
+    next_entity_embeddings = embeddings.gather(1, gather_index).squeeze(1)
+
+    return (embeddings, num_embeddings, last_seen, slot_ids, last_used, next_entity_slots,
+            entity_id_logits, next_entity_embeddings)
+
+
 @Model.register('entitynlm')
 class EntityNLM(Model):
     """
@@ -52,6 +135,11 @@ class EntityNLM(Model):
         Dropout rate of variational dropout applied to input embeddings. Default: 0.0
     dropout_rate : ``float``, optional
         Dropout rate applied to hidden states. Default: 0.0
+    fused_step : ``bool``, optional
+        Whether to process each chunk using ``fused_entity_step``, which only performs the
+        dynamic entity updates one timestep at a time and computes all of the remaining
+        predictions for the chunk at once. Computes the same quantities as the default loop,
+        but runs considerably faster. Default: False
     initializer : ``InitializerApplicator``, optional
         Used to initialize model parameters.
     """
@@ -67,6 +155,7 @@ class EntityNLM(Model):
                  tie_weights: bool,
                  variational_dropout_rate: float = 0.0,
                  dropout_rate: float = 0.0,
+                 fused_step: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(EntityNLM, self).__init__(vocab)
 
@@ -78,6 +167,7 @@ class EntityNLM(Model):
         self._tie_weights = tie_weights
         self._variational_dropout_rate = variational_dropout_rate
         self._dropout_rate = dropout_rate
+        self._fused_step = fused_step
 
         self._state: Optional[StateDict] = None
 
@@ -126,7 +216,8 @@ class EntityNLM(Model):
                 entity_types: Optional[torch.Tensor] = None,
                 entity_ids: Optional[torch.Tensor] = None,
                 mention_lengths: Optional[torch.Tensor] = None,
-                reset: bool = False)-> Dict[str, torch.Tensor]:
+                reset: bool = False,
+                encoded: Optional[torch.Tensor] = None)-> Dict[str, torch.Tensor]:
         """
         Computes the loss during training / validation.
 
@@ -147,6 +238,11 @@ class EntityNLM(Model):
         reset : ``bool``
             Whether or not to reset the model's state. This should be done at the start of each
             new sequence.
+        encoded : ``torch.Tensor``, optional
+            The output of ``encode`` on ``tokens``, with shape ``(batch_size, sequence_length,
+            embedding_dim)``. If given, the tokens are not re-encoded. Since the hidden states do
+            not depend on the annotations, this allows scoring many annotations of the same
+            tokens while only encoding them once. Requires ``reset``.
 
         Returns
         -------
@@ -156,6 +252,9 @@ class EntityNLM(Model):
         """
         batch_size = tokens['tokens'].shape[0]
 
+        if encoded is not None and not reset:
+            raise ValueError('Encoded inputs can only be used at the start of a sequence.')
+
         if reset:
             self.reset_states(batch_size)
         else:
@@ -165,7 +264,8 @@ class EntityNLM(Model):
             output_dict = self._forward_loop(tokens=tokens,
                                              entity_types=entity_types,
                                              entity_ids=entity_ids,
-                                             mention_lengths=mention_lengths)
+                                             mention_lengths=mention_lengths,
+                                             encoded=encoded)
         else:
             output_dict = {}
 
@@ -179,7 +279,8 @@ class EntityNLM(Model):
                       tokens: Dict[str, torch.Tensor],
                       entity_types: torch.Tensor,
                       entity_ids: torch.Tensor,
-                      mention_lengths: torch.Tensor) -> Dict[str, torch.Tensor]:
+                      mention_lengths: torch.Tensor,
+                      encoded: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
         """
         Performs the forward pass to calculate the loss on a chunk of training data.
 
@@ -197,6 +298,8 @@ class EntityNLM(Model):
         mention_lengths : ``torch.Tensor``
             A tensor of shape ``(batch_size, sequence_length)`` tracking how many remaining
             tokens (including the current one) there are in the mention.
+        encoded : ``torch.Tensor``, optional
+            Precomputed hidden states (see ``forward``).
 
         Returns
         -------
@@ -231,9 +334,60 @@ class EntityNLM(Model):
 
         # Embed tokens and get RNN hidden state.
         mask = get_text_field_mask(tokens)
-        embeddings = self._text_field_embedder(tokens)
-        embeddings = self._variational_dropout(embeddings)
-        hidden = self._encoder(embeddings, mask)
+        if encoded is not None:
+            hidden = encoded
+        else:
+            hidden = self._encode(tokens, mask)
+
+        if self._fused_step:
+            step_outputs = self._fused_loop(hidden, mask, tokens['tokens'], entity_types, entity_ids,
+                                            mention_lengths, contexts)
+        else:
+            step_outputs = self._loop(hidden, mask, tokens['tokens'], entity_types, entity_ids,
+                                      mention_lengths, contexts)
+        entity_type_loss, entity_id_loss, mention_length_loss, vocab_loss, logp, contexts = step_outputs
+
+        # Normalize the losses
+        entity_type_loss /= mask.sum()
+        entity_id_loss /= mask.sum()
+        mention_length_loss /= mask.sum()
+        vocab_loss /= mask.sum()
+        total_loss = entity_type_loss + entity_id_loss + mention_length_loss + vocab_loss
+
+        output_dict = {
+                'entity_type_loss': entity_type_loss,
+                'entity_id_loss': entity_id_loss,
+                'mention_length_loss': mention_length_loss,
+                'vocab_loss': vocab_loss,
+                'loss': total_loss,
+                'logp': logp
+        }
+
+        # Update the model state
+        self._state = {
+                'prev_tokens': {field: tokens[field][:, -1].unsqueeze(1).detach() for field in tokens},
+                'prev_entity_types': entity_types[:, -1].unsqueeze(1).detach(),
+                'prev_entity_ids': entity_ids[:, -1].unsqueeze(1).detach(),
+                'prev_mention_lengths': mention_lengths[:, -1].unsqueeze(1).detach(),
+                'prev_contexts': contexts.detach()
+        }
+
+        return output_dict
+
+    def _loop(self,
+              hidden: torch.Tensor,
+              mask: torch.Tensor,
+              tokens: torch.Tensor,
+              entity_types: torch.Tensor,
+              entity_ids: torch.Tensor,
+              mention_lengths: torch.Tensor,
+              contexts: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        """
+        Computes the (unnormalized) losses and log-probabilities of a chunk, one timestep at a
+        time. Returns a tuple ``(entity_type_loss, entity_id_loss, mention_length_loss,
+        vocab_loss, logp, contexts)``.
+        """
+        batch_size, sequence_length = tokens.shape
 
         # Initialize losses
         entity_type_loss = 0.0
@@ -257,7 +411,7 @@ class EntityNLM(Model):
             next_entity_ids = entity_ids[:, timestep + 1]
             next_mention_lengths = mention_lengths[:, timestep + 1]
             next_mask = mask[:, timestep + 1]
-            next_tokens = tokens['tokens'][:, timestep + 1]
+            next_tokens = tokens[:, timestep + 1]
 
             # We add new entities to any sequence where the current entity id matches the number of
             # embeddings that currently exist for that sequence (this means we need a new one since
@@ -281,6 +435,7 @@ class EntityNLM(Model):
             # require access to the **next** hidden state, which does not exist during generation).
             next_entity_ids = next_entity_ids.clone()  # This prevents mutating the source data.
             next_entity_ids[next_entity_ids == self._dynamic_embeddings.num_embeddings] = 0
+            next_entity_slots = self._dynamic_embeddings.slots(next_entity_ids)
 
             # We only predict the types / ids / lengths of the next mention if we are not currently
             # in the process of generating it (e.g. if the current remaining mention length is 1).
@@ -317,10 +472,10 @@ class EntityNLM(Model):
                     logp += entity_id_logp
 
                     self._entity_id_accuracy(predictions=entity_id_prediction_outputs['logits'],
-                                             gold_labels=next_entity_ids[predict_em])
+                                             gold_labels=next_entity_slots[predict_em])
 
                     # Equation 5 in the paper.
-                    next_entity_embeddings = self._dynamic_embeddings.embeddings[predict_em, next_entity_ids[predict_em]]
+                    next_entity_embeddings = self._dynamic_embeddings.embeddings[predict_em, next_entity_slots[predict_em]]
                     next_entity_embeddings = self._dropout(next_entity_embeddings)
                     concatenated = torch.cat((current_hidden[predict_em], next_entity_embeddings), dim=-1)
                     mention_length_logits = self._mention_length_projection(concatenated)
@@ -337,7 +492,7 @@ class EntityNLM(Model):
                                                   gold_labels=next_mention_lengths[predict_em])
 
             # Always predict the next word. This is done using the hidden state and contextual bias.
-            entity_embeddings = self._dynamic_embeddings.embeddings[next_entity_types, next_entity_ids[next_entity_types]]
+            entity_embeddings = self._dynamic_embeddings.embeddings[next_entity_types, next_entity_slots[next_entity_types]]
             entity_embeddings = self._entity_output_projection(entity_embeddings)
             context_embeddings = contexts[1 - next_entity_types]
             context_embeddings = self._context_output_projection(context_embeddings)
@@ -366,32 +521,163 @@ class EntityNLM(Model):
             # Lastly update contexts
             contexts = current_hidden
 
-        # Normalize the losses
-        entity_type_loss /= mask.sum()
-        entity_id_loss /= mask.sum()
-        mention_length_loss /= mask.sum()
-        vocab_loss /= mask.sum()
-        total_loss = entity_type_loss + entity_id_loss + mention_length_loss + vocab_loss
+        return entity_type_loss, entity_id_loss, mention_length_loss, vocab_loss, logp, contexts
 
-        output_dict = {
-                'entity_type_loss': entity_type_loss,
-                'entity_id_loss': entity_id_loss,
-                'mention_length_loss': mention_length_loss,
-                'vocab_loss': vocab_loss,
-                'loss': total_loss,
-                'logp': logp
-        }
+    def _fused_loop(self,
+                    hidden: torch.Tensor,
+                    mask: torch.Tensor,
+                    tokens: torch.Tensor,
+                    entity_types: torch.Tensor,
+                    entity_ids: torch.Tensor,
+                    mention_lengths: torch.Tensor,
+                    contexts: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        """
+        Computes the same outputs as ``_loop``. Only the dynamic entity updates (and entity id
+        scores, which depend on them) are computed one timestep at a time using
+        ``fused_entity_step``, all of the other projections are applied to the whole chunk.
+        """
+        # pylint: disable=protected-access
+        batch_size, sequence_length = tokens.shape
+        dynamic_embeddings = self._dynamic_embeddings
+        embeddings = dynamic_embeddings.embeddings
+        num_embeddings = dynamic_embeddings.num_embeddings
+        last_seen = dynamic_embeddings.last_seen
+        slot_ids = dynamic_embeddings.slot_ids
+        last_used = dynamic_embeddings._last_used
+
+        hidden = self._dropout(hidden)
+        # The bilinear entity scores are ``hidden^T W e``, so projecting the hidden states by
+        # ``W^T`` once avoids projecting every embedding at every timestep.
+        projected_hidden = hidden.matmul(dynamic_embeddings._embedding_projection.weight)
+        noise = 1e-4 * torch.randn_like(hidden)
+        timesteps = torch.arange(sequence_length, dtype=torch.int64, device=hidden.device)
+        clocks = timesteps + dynamic_embeddings._clock
+
+        all_entity_id_logits = []
+        all_next_entity_slots = []
+        all_next_entity_embeddings = []
+        for timestep in range(sequence_length - 1):
+            step_outputs = fused_entity_step(embeddings=embeddings,
+                                             num_embeddings=num_embeddings,
+                                             last_seen=last_seen,
+                                             slot_ids=slot_ids,
+                                             last_used=last_used,
+                                             hidden=hidden[:, timestep],
+                                             projected_hidden=projected_hidden[:, timestep],
+                                             noise=noise[:, timestep],
+                                             initial_embedding=dynamic_embeddings._initial_embedding,
+                                             delta_weight=dynamic_embeddings._delta_projection.weight,
+                                             distance_scalar=dynamic_embeddings._distance_scalar,
+                                             current_entity_types=entity_types[:, timestep],
+                                             current_entity_ids=entity_ids[:, timestep],
+                                             next_entity_ids=entity_ids[:, timestep + 1],
+                                             timestep=timesteps[timestep],
+                                             clock=clocks[timestep])
+            embeddings, num_embeddings, last_seen, slot_ids, last_used = step_outputs[:5]
+            all_next_entity_slots.append(step_outputs[5])
+            all_entity_id_logits.append(step_outputs[6])
+            all_next_entity_embeddings.append(step_outputs[7])
+
+        dynamic_embeddings.embeddings = embeddings
+        dynamic_embeddings.num_embeddings = num_embeddings
+        dynamic_embeddings.last_seen = last_seen
+        dynamic_embeddings.slot_ids = slot_ids
+        dynamic_embeddings._last_used = last_used
+        dynamic_embeddings._clock += max(sequence_length - 1, 0)
+
+        if sequence_length < 2:
+            return 0.0, 0.0, 0.0, 0.0, hidden.new_zeros(batch_size), contexts
+
+        # shape: (batch_size, sequence_length - 1, ...)
+        entity_id_logits = torch.stack(all_entity_id_logits, dim=1)
+        next_entity_slots = torch.stack(all_next_entity_slots, dim=1)
+        next_entity_embeddings = torch.stack(all_next_entity_embeddings, dim=1)
+        current_hidden = hidden[:, :-1]
+        current_mention_lengths = mention_lengths[:, :-1]
+        next_entity_types = entity_types[:, 1:]
+        next_mention_lengths = mention_lengths[:, 1:]
+        next_mask = mask[:, 1:].byte()
+        next_tokens = tokens[:, 1:]
+
+        # See ``_loop`` for an explanation of when the types / ids / lengths are predicted.
+        predict_all = current_mention_lengths.eq(1) & next_mask
+        predict_em = next_entity_types.byte() & predict_all
+
+        # Equation 3 in the paper.
+        entity_type_logits = self._entity_type_projection(current_hidden)
+        entity_type_logp = F.log_softmax(entity_type_logits, dim=-1)
+        entity_type_logp = entity_type_logp.gather(-1, next_entity_types.long().unsqueeze(-1)).squeeze(-1)
+        entity_type_logp = entity_type_logp * predict_all.float()
+        self._entity_type_accuracy(predictions=entity_type_logits,
+                                   gold_labels=next_entity_types.long(),
+                                   mask=predict_all.float())
+
+        # Equation 4 in the paper. Logits of unused embeddings are -inf, so ``torch.where`` is
+        # used instead of multiplying by the mask (which would produce NaNs).
+        entity_id_logp = F.log_softmax(entity_id_logits, dim=-1)
+        entity_id_logp = entity_id_logp.gather(-1, next_entity_slots.unsqueeze(-1)).squeeze(-1)
+        entity_id_logp = torch.where(predict_em, entity_id_logp, torch.zeros_like(entity_id_logp))
+        self._entity_id_accuracy(predictions=entity_id_logits,
+                                 gold_labels=next_entity_slots,
+                                 mask=predict_em.float())
+
+        # Equation 5 in the paper.
+        concatenated = torch.cat((current_hidden, self._dropout(next_entity_embeddings)), dim=-1)
+        mention_length_logits = self._mention_length_projection(concatenated)
+        _next_mention_lengths = next_mention_lengths.clamp(max=self._max_mention_length - 1)
+        mention_length_logp = F.log_softmax(mention_length_logits, dim=-1)
+        mention_length_logp = mention_length_logp.gather(-1, _next_mention_lengths.unsqueeze(-1)).squeeze(-1)
+        mention_length_logp = mention_length_logp * predict_em.float()
+        self._mention_length_accuracy(predictions=mention_length_logits,
+                                      gold_labels=_next_mention_lengths,
+                                      mask=predict_em.float())
+
+        # The context of each timestep is the hidden state of the previous timestep.
+        previous_hidden = torch.cat((contexts.unsqueeze(1), current_hidden[:, :-1]), dim=1)
+        entity_features = self._entity_output_projection(next_entity_embeddings)
+        context_features = self._context_output_projection(previous_hidden)
+        vocab_features = current_hidden + torch.where(next_entity_types.byte().unsqueeze(-1),
+                                                      entity_features,
+                                                      context_features)
+        vocab_logits = self._vocab_projection(vocab_features)
+        vocab_logp = F.log_softmax(vocab_logits, dim=-1)
+        vocab_logp = vocab_logp.gather(-1, next_tokens.unsqueeze(-1)).squeeze(-1)
+        vocab_logp = vocab_logp * next_mask.float()
+
+        entity_type_loss = -entity_type_logp.sum()
+        entity_id_loss = -entity_id_logp.sum()
+        mention_length_loss = -mention_length_logp.sum()
+        vocab_loss = -vocab_logp.sum()
+        logp = (entity_type_logp + entity_id_logp + mention_length_logp + vocab_logp).sum(-1)
+
+        return entity_type_loss, entity_id_loss, mention_length_loss, vocab_loss, logp, current_hidden[:, -1]
+
+    def _encode(self,
+                tokens: Dict[str, torch.Tensor],
+                mask: torch.Tensor) -> torch.Tensor:
+        embeddings = self._text_field_embedder(tokens)
+        embeddings = self._variational_dropout(embeddings)
+        return self._encoder(embeddings, mask)
 
-        # Update the model state
-        self._state = {
-                'prev_tokens': {field: tokens[field][:, -1].unsqueeze(1).detach() for field in tokens},
-                'prev_entity_types': entity_types[:, -1].unsqueeze(1).detach(),
-                'prev_entity_ids': entity_ids[:, -1].unsqueeze(1).detach(),
-                'prev_mention_lengths': mention_lengths[:, -1].unsqueeze(1).detach(),
-                'prev_contexts': contexts.detach()
-        }
+    def encode(self, tokens: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes entire (unsplit) sequences of tokens, starting from a fresh encoder state. The
+        output can be repeated and passed to ``forward`` to score multiple annotations of the
+        same sequences.
 
-        return output_dict
+        Parameters
+        ----------
+        tokens : ``Dict[str, torch.Tensor]``
+            A tensor of shape ``(batch_size, sequence_length)`` containing the sequence of
+            tokens.
+
+        Returns
+        -------
+        A tensor of shape ``(batch_size, sequence_length, embedding_dim)`` containing the hidden
+        states.
+        """
+        self._encoder.reset_states()
+        return self._encode(tokens, get_text_field_mask(tokens))
 
     def reset_states(self, batch_size: int) -> None:
         """Resets the model's internals. Should be called at the start of a new batch."""
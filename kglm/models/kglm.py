@@ -1,26 +1,35 @@
 import logging
 import math
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+from allennlp.common.checks import ConfigurationError
 from allennlp.data.vocabulary import Vocabulary, DEFAULT_OOV_TOKEN
 from allennlp.modules import TextFieldEmbedder, Seq2SeqEncoder
 from allennlp.models import Model
 from allennlp.nn import InitializerApplicator
-from allennlp.nn.util import (
-    get_text_field_mask, masked_log_softmax, sequence_cross_entropy_with_logits)
+from allennlp.nn.util import get_text_field_mask, masked_log_softmax
 from allennlp.training.metrics import Average, CategoricalAccuracy, F1Measure, SequenceAccuracy
 from overrides import overrides
 import torch
 import torch.nn.functional as F
 
 from kglm.data import AliasDatabase
+from kglm.data.dataset_readers.enhanced_wikitext import entity_namespace_maps
 from kglm.modules import (
-    embedded_dropout, LockedDropout, WeightDrop, KnowledgeGraphLookup, RecentEntities)
+    embedded_dropout, AliasEncodingCache, LockedDropout, WeightDrop, KnowledgeGraphLookup,
+    RecentEntities, SplitCrossEntropyLoss, EntityIndex)
+from kglm.modules.entity_index import top_k_entities
 from kglm.training.metrics import Ppl
 
 logger = logging.getLogger(__name__)
 
 
+def _sample(logits: torch.Tensor, mask: torch.Tensor, temperature: float) -> torch.Tensor:
+    """Samples an index from each row of the masked softmax of the given logits."""
+    log_probs = masked_log_softmax(logits / temperature, mask)
+    return torch.multinomial(log_probs.exp(), 1).squeeze(-1)
+
+
 @Model.register('kglm')
 class Kglm(Model):
     """
@@ -30,6 +39,28 @@ class Kglm(Model):
     ----------
     vocab : ``Vocabulary``
         The model vocabulary.
+    splits : ``List[int]``, optional (default=``[]``)
+        Splits to use in an adaptive softmax over the vocabulary when generating tokens. The copy
+        scores are normalized jointly with the head of the adaptive softmax. If empty, then a full
+        softmax is used.
+    num_sampled_entities : ``int``, optional (default=0)
+        If positive and ``use_shortlist`` is false, new entities are predicted during training using
+        a sampled softmax with this many (log-uniformly sampled) negative entities. Evaluation
+        always uses an exact softmax.
+    entity_splits : ``List[int]``, optional (default=``[]``)
+        If non-empty and ``use_shortlist`` is false, new entities are predicted (exactly) using a
+        hierarchical softmax whose clusters are given by these splits of the entity vocabulary.
+        Cannot be combined with ``num_sampled_entities``, since the cluster scores would then never
+        be trained.
+    entity_index_path : ``str``, optional (default=None)
+        Path to an ``EntityIndex`` (see the ``build-entity-index`` command) over the entity
+        embeddings, used by ``new_entity_candidates`` to retrieve candidates without scoring every
+        entity. Requires ``tie_weights`` and no shortlist.
+    knowledge_graph_cache_directory : ``str``, optional (default=None)
+        If given, a directory in which the indexed knowledge graph is cached (see
+        ``KnowledgeGraphLookup``).
+    alias_cache_size : ``int``, optional (default=4096)
+        The number of alias encodings cached during evaluation (0 disables the cache).
     """
     def __init__(self,
                  vocab: Vocabulary,
@@ -43,6 +74,9 @@ class Kglm(Model):
                  num_layers: int,
                  cutoff: int = 30,
                  tie_weights: bool = False,
+                 splits: List[int] = [],
+                 num_sampled_entities: int = 0,
+                 entity_splits: List[int] = [],
                  dropout: float = 0.4,
                  dropouth: float = 0.3,
                  dropouti: float = 0.65,
@@ -50,6 +84,9 @@ class Kglm(Model):
                  wdrop: float = 0.5,
                  alpha: float = 2.0,
                  beta: float = 1.0,
+                 alias_cache_size: int = 4096,
+                 entity_index_path: str = None,
+                 knowledge_graph_cache_directory: str = None,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(Kglm, self).__init__(vocab)
 
@@ -59,9 +96,23 @@ class Kglm(Model):
         self._entity_embedder = entity_embedder._token_embedders['entity_ids']
         self._relation_embedder = relation_embedder._token_embedders['relations']
         self._alias_encoder = alias_encoder
+        self._alias_encoding_cache = AliasEncodingCache(max_size=alias_cache_size)
         self._recent_entities = RecentEntities(cutoff=cutoff)
-        self._knowledge_graph_lookup = KnowledgeGraphLookup(knowledge_graph_path, vocab=vocab)
+        self._knowledge_graph_lookup = KnowledgeGraphLookup(knowledge_graph_path,
+                                                            vocab=vocab,
+                                                            cache_directory=knowledge_graph_cache_directory)
         self._use_shortlist = use_shortlist
+        if entity_index_path is not None:
+            # The index is built over the entity embeddings, so it only retrieves the highest
+            # scoring new entities if they are also the weights of ``_fc_new_entity``.
+            if use_shortlist or not tie_weights:
+                raise ConfigurationError('An entity index requires tie_weights and no shortlist')
+            self._entity_index = EntityIndex.load(entity_index_path)
+            if self._entity_index.embedding_dim != entity_embedder.get_output_dim() + 1:
+                raise ConfigurationError('The entity index was not built over the entity logits of '
+                                         'this model (see build-entity-index)')
+        else:
+            self._entity_index = None
         self._hidden_size = hidden_size
         self._num_layers = num_layers
         self._cutoff = cutoff
@@ -112,6 +163,14 @@ class Kglm(Model):
             if tie_weights:
                 self._fc_new_entity.weight = self._entity_embedder.weight
 
+        if num_sampled_entities > 0 and entity_splits:
+            raise ConfigurationError('num_sampled_entities and entity_splits cannot both be used')
+        self._num_sampled_entities = num_sampled_entities
+        if entity_splits and not use_shortlist:
+            self._entity_split_cross_entropy = SplitCrossEntropyLoss(entity_embedding_dim, entity_splits)
+        else:
+            self._entity_split_cross_entropy = None
+
         self._fc_condense = torch.nn.Linear(
             in_features=token_embedding_dim + entity_embedding_dim,
             out_features=token_embedding_dim)
@@ -127,7 +186,14 @@ class Kglm(Model):
         if tie_weights:
             self._fc_generate.weight = self._token_embedder.weight
 
+        if splits:
+            self._split_cross_entropy = SplitCrossEntropyLoss(token_embedding_dim, splits)
+        else:
+            self._split_cross_entropy = None
+
         self._state: Optional[Dict[str, Any]] = None
+        self._entity_to_raw: torch.Tensor = None
+        self._raw_to_entity: torch.Tensor = None
 
         # Metrics
         self._unk_index = vocab.get_token_index(DEFAULT_OOV_TOKEN)
@@ -162,14 +228,21 @@ class Kglm(Model):
                 relations: Dict[str, torch.Tensor] = None,
                 shortlist: Dict[str, torch.Tensor] = None,
                 shortlist_inds: torch.Tensor = None,
-                alias_copy_inds: torch.Tensor = None) -> Dict[str, torch.Tensor]:
+                alias_copy_inds: torch.Tensor = None,
+                encoded: torch.Tensor = None) -> Dict[str, torch.Tensor]:
+
+        if encoded is not None and not reset.all():
+            raise ValueError('Encoded inputs can only be used at the start of a sequence.')
 
         # Tensorize the alias_database - this will only perform the operation once.
         alias_database = metadata[0]['alias_database']
         alias_database.tensorize(vocab=self.vocab)
 
-        # Reset the model if needed
-        if reset.any() and (self._state is not None):
+        # Reset the model if needed. Encoded inputs bypass the recurrent state entirely (and may
+        # have a different batch size than the one it was computed for), so it is discarded.
+        if encoded is not None:
+            self._state = None
+        elif reset.any() and (self._state is not None):
             for layer in range(self._num_layers):
                 h, c = self._state['layer_%i' % layer]
                 h[:, reset, :] = torch.zeros_like(h[:, reset, :])
@@ -189,7 +262,8 @@ class Kglm(Model):
                 relations=relations,
                 shortlist=shortlist,
                 shortlist_inds=shortlist_inds,
-                alias_copy_inds=alias_copy_inds)
+                alias_copy_inds=alias_copy_inds,
+                encoded=encoded)
         else:
             # TODO: Figure out what we want here - probably to do some king of inference on
             # entities / mention types.
@@ -197,6 +271,25 @@ class Kglm(Model):
 
         return output_dict
 
+    def encode(self, source: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes entire (unsplit) sequences of source tokens, starting from a fresh recurrent
+        state. Since the hidden states do not depend on the annotations, the output can be
+        repeated and passed to ``forward`` (as ``encoded``) to score multiple annotations of the
+        same sequences while only encoding them once.
+
+        The recurrent state is left empty, since the annotated sequences are typically scored in
+        a batch of a different size.
+
+        Returns
+        -------
+        A tensor of shape ``(batch_size, sequence_length, hidden_dim)``.
+        """
+        self._state = None
+        encoded, _, _ = self._encode_source(source['tokens'])
+        self._state = None
+        return encoded
+
     def _encode_source(self, source: Dict[str, torch.Tensor]) -> torch.Tensor:
 
         # Extract and embed source tokens.
@@ -243,11 +336,12 @@ class Kglm(Model):
                            mask: torch.Tensor) -> torch.Tensor:
         """
         Computes the loss for predicting whether or not the the next token will be part of an
-        entity mention.
+        entity mention. Also returns the log-probability of the mention types of each sequence.
         """
         logits = self._fc_mention_type(encoded)
-        mention_type_loss = sequence_cross_entropy_with_logits(logits, mention_type, mask,
-                                                               average='token')
+        log_probs = F.log_softmax(logits, dim=-1)
+        target_log_probs = log_probs.gather(-1, mention_type.unsqueeze(-1)).squeeze(-1) * mask.float()
+        mention_type_loss = -target_log_probs.sum() / (mask.float().sum() + 1e-13)
         # if not self.training:
         self._new_mention_f1(predictions=logits,
                              gold_labels=mention_type,
@@ -256,7 +350,7 @@ class Kglm(Model):
                             gold_labels=mention_type,
                             mask=mask)
 
-        return mention_type_loss
+        return mention_type_loss, target_log_probs.sum(-1)
 
     def _new_entity_loss(self,
                          encoded: torch.Tensor,
@@ -264,6 +358,9 @@ class Kglm(Model):
                          shortlist: torch.Tensor,
                          target_mask: torch.Tensor) -> torch.Tensor:
         """
+        Computes the loss for predicting new entities, along with the log-probability of the new
+        entities of each sequence.
+
         Parameters
         ==========
         target_inds : ``torch.Tensor``
@@ -298,26 +395,125 @@ class Kglm(Model):
                                         gold_labels=target_inds[mask])
 
             # Return the token-wise average loss
-            return -target_log_probs.sum() / (target_mask.sum() + 1e-13)
+            return -target_log_probs.sum() / (target_mask.sum() + 1e-13), target_log_probs.sum(-1)
 
         else:
-            logits = self._fc_new_entity(encoded)
-            log_probs = F.log_softmax(logits, dim=-1)
-
-            num_categories = log_probs.shape[-1]
-            flat_log_probs = log_probs.view(-1, num_categories)
+            # Only new mentions have a target entity, so we only score the entities at those
+            # positions.
+            flat_encoded = encoded.contiguous().view(-1, encoded.shape[-1])
             flat_target_inds = target_inds.view(-1)
-            target_log_probs = torch.gather(flat_log_probs, -1, flat_target_inds.unsqueeze(-1)).squeeze(-1)
+            mention_positions = flat_target_inds.gt(0).nonzero().view(-1)
+            mention_encoded = flat_encoded.index_select(0, mention_positions)
+            mention_target_inds = flat_target_inds.index_select(0, mention_positions)
+
+            if self.training and self._num_sampled_entities > 0:
+                target_log_probs = self._sampled_new_entity_log_probs(mention_encoded,
+                                                                      mention_target_inds)
+            elif self._entity_split_cross_entropy is not None:
+                num_mentions = mention_positions.shape[0]
+                target_log_probs, _ = self._entity_split_cross_entropy.mixture_log_probs(
+                    self._fc_new_entity.weight,
+                    self._fc_new_entity.bias,
+                    mention_encoded,
+                    mention_target_inds,
+                    mention_encoded.new_zeros(num_mentions, 0),
+                    mention_target_inds.new_zeros(num_mentions, 0).byte())
+            else:
+                logits = self._fc_new_entity(mention_encoded)
+                log_probs = F.log_softmax(logits, dim=-1)
+                target_log_probs = torch.gather(log_probs, -1, mention_target_inds.unsqueeze(-1)).squeeze(-1)
+
+                self._new_entity_accuracy(predictions=log_probs,
+                                          gold_labels=mention_target_inds)
+                self._new_entity_accuracy20(predictions=log_probs,
+                                            gold_labels=mention_target_inds)
+
+            sequence_log_probs = flat_encoded.new_zeros(flat_target_inds.shape)
+            sequence_log_probs = sequence_log_probs.index_copy(0, mention_positions, target_log_probs)
+            sequence_log_probs = sequence_log_probs.view(*target_inds.shape).sum(-1)
+            return -target_log_probs.sum() / (target_mask.sum() + 1e-13), sequence_log_probs
+
+    def _sampled_new_entity_log_probs(self,
+                                      encoded: torch.Tensor,
+                                      target_inds: torch.Tensor) -> torch.Tensor:
+        """
+        Approximates the log-probabilities of the target entities using a sampled softmax.
 
-            mask = ~flat_target_inds.eq(0)
-            target_log_probs[~mask] = 0
+        Negative entities are drawn from a log-uniform (Zipfian) distribution, which is appropriate
+        since the entity vocabulary is sorted by frequency. The same samples are shared by every
+        position, and the logits are corrected by the log expected count of each entity.
 
-            self._new_entity_accuracy(predictions=flat_log_probs[mask],
-                                      gold_labels=flat_target_inds[mask])
-            self._new_entity_accuracy20(predictions=flat_log_probs[mask],
-                                        gold_labels=flat_target_inds[mask])
+        Parameters
+        ==========
+        encoded : ``torch.Tensor``
+            A tensor of shape ``(num_mentions, entity_embedding_dim)``.
+        target_inds : ``torch.Tensor``
+            A tensor of shape ``(num_mentions,)`` containing the target entity ids.
 
-            return -target_log_probs.sum() / (target_mask.sum() + 1e-13)
+        Returns
+        =======
+        A tensor of shape ``(num_mentions,)`` containing the approximate target log-probabilities.
+        """
+        num_entities = self._fc_new_entity.out_features
+        num_samples = self._num_sampled_entities
+        log_range = math.log(num_entities + 1)
+
+        def log_expected_count(ids: torch.Tensor) -> torch.Tensor:
+            ids = ids.float()
+            probs = ((ids + 2) / (ids + 1)).log() / log_range
+            return (probs * num_samples).log()
+
+        # Inverse transform sampling of the log-uniform distribution.
+        uniform = torch.rand(num_samples, device=encoded.device)
+        sampled_ids = ((uniform * log_range).exp() - 1).long().clamp(0, num_entities - 1)
+
+        weight = self._fc_new_entity.weight
+        bias = self._fc_new_entity.bias
+        target_logits = (encoded * weight[target_inds]).sum(-1) + bias[target_inds]
+        target_logits = target_logits - log_expected_count(target_inds)
+        sampled_logits = F.linear(encoded, weight[sampled_ids], bias[sampled_ids])
+        sampled_logits = sampled_logits - log_expected_count(sampled_ids)
+
+        # Samples which happen to be the target are not negatives, so we mask them out.
+        accidental_hits = sampled_ids.unsqueeze(0).eq(target_inds.unsqueeze(-1))
+        logits = torch.cat((target_logits.unsqueeze(-1), sampled_logits), dim=-1)
+        mask = torch.cat((accidental_hits.new_ones(target_inds.shape[0], 1), ~accidental_hits), dim=-1)
+        log_probs = masked_log_softmax(logits, mask)
+
+        return log_probs[:, 0]
+
+    def new_entity_candidates(self,
+                              encoded: torch.Tensor,
+                              k: int,
+                              num_probes: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Finds the ``k`` highest scoring new entities (when not using a shortlist). If the model has
+        an entity index, candidates are retrieved from the index and then re-scored exactly,
+        otherwise every entity is scored.
+
+        Parameters
+        ==========
+        encoded : ``torch.Tensor``
+            A tensor of shape ``(*, entity_embedding_dim)`` containing the predicted new entity
+            embeddings.
+        k : ``int``
+            The number of candidates.
+        num_probes : ``int``, optional (default=1)
+            The number of index clusters searched for candidates.
+
+        Returns
+        =======
+        A tuple ``(logits, entity_ids)`` of tensors of shape ``(*, k)``, sorted by decreasing
+        logit.
+        """
+        if self._use_shortlist:
+            raise RuntimeError('New entity candidates are only available when not using a shortlist')
+        return top_k_entities(encoded,
+                              self._fc_new_entity.weight,
+                              self._fc_new_entity.bias,
+                              k,
+                              entity_index=self._entity_index,
+                              num_probes=num_probes)
 
     def _parent_log_probs(self,
                           encoded_head: torch.Tensor,
@@ -378,34 +574,46 @@ class Kglm(Model):
                             parent_ids: torch.Tensor) -> torch.Tensor:
 
         # Lookup edges out of parents
-        indices, parent_ids_list, relations_list, tail_ids_list = self._knowledge_graph_lookup(parent_ids)
-
-        # Embed relations
-        relation_embeddings = [self._relation_embedder(r) for r in relations_list]
+        # shape: (batch_size, sequence_length, num_parents, max_num_edges)
+        relations, tail_ids, edge_mask = self._knowledge_graph_lookup(parent_ids)
 
         # Logits are computed using a general bilinear form that measures the similarity between
         # the projected hidden state and the embeddings of relations
         encoded = self._locked_dropout(encoded_relation, self._dropout)
 
-        # This is a little funky, but to avoid massive amounts of padding we are going to just
-        # iterate over the relation and tail_id vectors one-by-one.
-        # shape: (batch_size, sequence_length, num_parents, num_relations)
+        # shape: (batch_size, sequence_length, num_parents)
         target_log_probs = encoded.new_empty(*parent_ids.shape).fill_(math.log(1e-45))
-        for index, parent_id, relation_embedding, tail_id in zip(indices, parent_ids_list, relation_embeddings, tail_ids_list):
-            # First we compute the score for each relation w.r.t the current encoding, and convert
-            # the scores to log-probabilities
-            logits = torch.mv(relation_embedding, encoded[index[:-1]])
-            logger.debug('Relation logits shape: %s', logits.shape)
-            log_probs = F.log_softmax(logits, dim=-1)
-
-            # Next we gather the log probs for edges with the correct tail entity and sum them up
-            target_id = raw_entity_ids[index[:-1]]
-            mask = tail_id.eq(target_id)
-            if ~mask.any():
-                import pdb; pdb.set_trace()
-            relevant_log_probs = log_probs.masked_select(tail_id.eq(target_id))
-            target_log_prob = torch.logsumexp(relevant_log_probs, dim=0)
-            target_log_probs[index] = target_log_prob
+
+        # Only the (batch, timestep, parent) tuples with outgoing edges need to be scored. To avoid
+        # padding out every null parent, we gather these tuples into a flat batch and compute all
+        # of their logits with a single bmm.
+        has_edges = edge_mask.any(dim=-1)
+        if not has_edges.any():
+            return target_log_probs
+        num_parents = parent_ids.shape[-1]
+
+        # shape: (num_scored, max_num_edges)
+        relations = relations[has_edges]
+        tail_ids = tail_ids[has_edges]
+        edge_mask = edge_mask[has_edges]
+        # shape: (num_scored, embedding_dim)
+        encoded = encoded.unsqueeze(2).expand(-1, -1, num_parents, -1)[has_edges]
+        # shape: (num_scored,)
+        target_ids = raw_entity_ids.unsqueeze(-1).expand_as(has_edges)[has_edges]
+
+        # First we compute the score for each relation w.r.t the current encoding, and convert
+        # the scores to log-probabilities
+        # shape: (num_scored, max_num_edges, embedding_dim)
+        relation_embeddings = self._relation_embedder(relations)
+        logits = torch.bmm(relation_embeddings, encoded.unsqueeze(-1)).squeeze(-1)
+        logger.debug('Relation logits shape: %s', logits.shape)
+        log_probs = masked_log_softmax(logits, edge_mask)
+
+        # Next we gather the log probs for edges with the correct tail entity, sum them up, and
+        # scatter the results back into their (batch, timestep, parent) positions.
+        target_mask = tail_ids.eq(target_ids.unsqueeze(-1)) & edge_mask
+        log_probs = log_probs + (target_mask.float() + 1e-45).log()
+        target_log_probs[has_edges] = torch.logsumexp(log_probs, dim=-1)
 
         return target_log_probs
 
@@ -430,18 +638,50 @@ class Kglm(Model):
         # if not self.training:
         self._parent_ppl(-torch.logsumexp(parent_log_probs, dim=-1)[mask].sum(), mask.float().sum())
         self._relation_ppl(-torch.logsumexp(relation_log_probs, dim=-1)[mask].sum(), mask.float().sum())
-        # Lastly return the tokenwise average loss
-        return -target_log_probs.sum() / (target_mask.sum() + 1e-13)
-
-    def _generate_scores(self,
-                         encoded: torch.Tensor,
-                         entity_ids: torch.Tensor) -> torch.Tensor:
+        # Lastly return the tokenwise average loss, along with the log-probability of each sequence
+        return -target_log_probs.sum() / (target_mask.sum() + 1e-13), target_log_probs.sum(-1)
+
+    def _condense(self,
+                  encoded: torch.Tensor,
+                  entity_ids: torch.Tensor) -> torch.Tensor:
+        # Only tokens inside of mentions have a non-null entity. Everywhere else the entity
+        # embedding is that of the null entity, so rather than embedding and projecting it for
+        # every token, we split ``_fc_condense`` into its token and entity parts, compute the null
+        # entity's contribution once, and only compute entity-specific contributions at mention
+        # positions.
+        batch_size, sequence_length, token_embedding_dim = encoded.shape
+        flattened_encoded = encoded.contiguous().view(-1, token_embedding_dim)
+        flattened_entity_ids = entity_ids.contiguous().view(-1)
+        mention_positions = flattened_entity_ids.gt(0).nonzero().view(-1)
+
+        # Embed the mentioned entities and the null entity in a single call, so that they share the
+        # same embedding dropout mask (as they would if every token were embedded).
+        # shape: (num_mentions + 1, entity_embedding_dim)
+        words = torch.cat((flattened_entity_ids.index_select(0, mention_positions),
+                           flattened_entity_ids.new_zeros(1)))
         entity_embeddings = embedded_dropout(embed=self._entity_embedder,
-                                             words=entity_ids,
+                                             words=words,
                                              dropout=self._dropoute if self.training else 0)
-        concatenated = torch.cat((encoded, entity_embeddings), dim=-1)
-        condensed = self._fc_condense(concatenated)
-        return self._fc_generate(condensed)
+
+        weight = self._fc_condense.weight
+        token_contribution = F.linear(flattened_encoded, weight[:, :token_embedding_dim])
+        entity_contribution = F.linear(entity_embeddings,
+                                       weight[:, token_embedding_dim:],
+                                       self._fc_condense.bias)
+        null_contribution = entity_contribution[-1:].expand_as(token_contribution)
+        entity_contribution = null_contribution.index_copy(0,
+                                                           mention_positions,
+                                                           entity_contribution[:-1])
+        condensed = token_contribution + entity_contribution
+        return condensed.view(batch_size, sequence_length, -1)
+
+    def _encode_aliases(self, aliases: torch.Tensor) -> torch.Tensor:
+        embedded = self._token_embedder(aliases)
+        mask = aliases.gt(0)
+        encoded_aliases = self._alias_encoder(embedded, mask)
+
+        # Equation 8 in the CopyNet paper recommends applying the additional step.
+        return torch.tanh(self._fc_copy(encoded_aliases))
 
     def _copy_scores(self,
                      encoded: torch.Tensor,
@@ -449,63 +689,85 @@ class Kglm(Model):
         # Begin by flattening the tokens so that they fit the expected shape of a
         # ``Seq2SeqEncoder``.
         batch_size, sequence_length, num_aliases, alias_length = alias_tokens.shape
-        flattened = alias_tokens.view(-1, alias_length)
-        copy_mask = flattened != 0
-        if copy_mask.sum() == 0:
-            return encoded.new_zeros((batch_size, sequence_length, num_aliases * alias_length),
-                                     dtype=torch.float32)
-
-        # Embed and encode the alias tokens.
-        embedded = self._token_embedder(flattened)
-        mask = flattened.gt(0)
-        encoded_aliases = self._alias_encoder(embedded, mask)
-
-        # Equation 8 in the CopyNet paper recommends applying the additional step.
-        projected = torch.tanh(self._fc_copy(encoded_aliases))
+        copy_scores = encoded.new_zeros((batch_size * sequence_length, num_aliases * alias_length),
+                                        dtype=torch.float32)
+
+        # Copy scores are only needed at positions inside of mentions (since there are no aliases
+        # to copy from anywhere else, all of the other scores get masked out in ``_vocab_loss``).
+        mention_positions = alias_tokens.view(batch_size * sequence_length, -1).gt(0).any(dim=-1)
+        mention_positions = mention_positions.nonzero().view(-1)
+        num_mentions = mention_positions.shape[0]
+        if num_mentions == 0:
+            return copy_scores.view(batch_size, sequence_length, -1)
+        alias_tokens = alias_tokens.view(batch_size * sequence_length, -1)
+        flattened = alias_tokens.index_select(0, mention_positions).view(-1, alias_length)
+
+        # Embed and encode the alias tokens. Most positions share the same few aliases (or are
+        # padding), so we only encode each unique alias once and then scatter the results back to
+        # their original positions. During evaluation, encodings are also reused across batches.
+        unique_aliases, inverse = torch.unique(flattened, sorted=True, return_inverse=True, dim=0)
+        projected = self._alias_encoding_cache(unique_aliases, self._encode_aliases)
+        projected = projected.index_select(0, inverse.view(-1))
         projected = self._locked_dropout(projected, self._dropout)
 
         # This part gets a little funky - we need to make sure that the first dimension in
-        # `projected` and `hidden` is batch_size x sequence_length.
-        encoded = encoded.view(batch_size * sequence_length, 1, -1)
-        projected = projected.view(batch_size * sequence_length, -1, num_aliases * alias_length)
-        copy_scores = torch.bmm(encoded, projected).squeeze()
+        # `projected` and `hidden` is the number of mention positions.
+        encoded = encoded.contiguous().view(batch_size * sequence_length, -1)
+        encoded = encoded.index_select(0, mention_positions).unsqueeze(1)
+        projected = projected.view(num_mentions, -1, num_aliases * alias_length)
+        mention_copy_scores = torch.bmm(encoded, projected).squeeze(1)
+        copy_scores = copy_scores.index_copy(0, mention_positions, mention_copy_scores)
         copy_scores = copy_scores.view(batch_size, sequence_length, -1).contiguous()
         logger.debug('Copy scores shape: %s', copy_scores.shape)
 
         return copy_scores
 
     def _vocab_loss(self,
-                    generate_scores: torch.Tensor,
+                    condensed: torch.Tensor,
                     copy_scores: torch.Tensor,
                     target_tokens: torch.Tensor,
                     target_alias_indices: torch.Tensor,
                     mask: torch.Tensor,
                     alias_indices: torch.Tensor,
                     mention_mask: torch.Tensor):
-        batch_size, sequence_length, vocab_size = generate_scores.shape
-        copy_sequence_length = copy_scores.shape[-1]
+        batch_size, sequence_length = target_tokens.shape
 
         # Flat sequences make life **much** easier.
+        flattened_condensed = condensed.view(batch_size * sequence_length, -1)
+        flattened_copy_scores = copy_scores.view(batch_size * sequence_length, -1)
         flattened_targets = target_tokens.view(batch_size * sequence_length, 1)
         flattened_mask = mask.view(-1, 1).byte()
 
         # In order to obtain proper log probabilities we create a mask to omit padding alias tokens
         # from the calculation.
-        alias_mask = alias_indices.view(batch_size, sequence_length, -1).gt(0)
-        score_mask = mask.new_ones(batch_size, sequence_length, vocab_size + copy_sequence_length)
-        score_mask[:, :, vocab_size:] = alias_mask
-
-        # The log-probability distribution is then given by taking the masked log softmax.
-        concatenated_scores = torch.cat((generate_scores, copy_scores), dim=-1)
-        log_probs = masked_log_softmax(concatenated_scores, score_mask)
+        alias_mask = alias_indices.view(batch_size * sequence_length, -1).gt(0)
+
+        if self._split_cross_entropy is None:
+            # The log-probability distribution is given by taking the masked log softmax over the
+            # generate and copy scores.
+            generate_scores = self._fc_generate(flattened_condensed)
+            vocab_size = generate_scores.shape[-1]
+            score_mask = torch.cat((alias_mask.new_ones(generate_scores.shape), alias_mask), dim=-1)
+            concatenated_scores = torch.cat((generate_scores, flattened_copy_scores), dim=-1)
+            flattened_log_probs = masked_log_softmax(concatenated_scores, score_mask)
+            # The generated token log probabilities are simply gathered.
+            generate_log_probs_source_vocab = flattened_log_probs.gather(1, flattened_targets)
+            copy_log_probs = flattened_log_probs[:, vocab_size:]
+        else:
+            # When using an adaptive softmax the copy scores are normalized together with the head
+            # (and tombstones), and the tails are only computed for the tokens that need them.
+            generate_log_probs_source_vocab, copy_log_probs = self._split_cross_entropy.mixture_log_probs(
+                self._fc_generate.weight,
+                self._fc_generate.bias,
+                flattened_condensed,
+                flattened_targets.view(-1),
+                flattened_copy_scores,
+                alias_mask)
+            generate_log_probs_source_vocab = generate_log_probs_source_vocab.unsqueeze(1)
 
         # GENERATE LOSS ###
-        # The generated token loss is a simple cross-entropy calculation, we can just gather
-        # the log probabilties...
-        flattened_log_probs = log_probs.view(batch_size * sequence_length, -1)
-        generate_log_probs_source_vocab = flattened_log_probs.gather(1, flattened_targets)
-        # ...except we need to ignore the contribution of UNK tokens that are copied (only when
-        # computing the loss). To do that we create a mask which is 1 only if the token is not a
+        # We need to ignore the contribution of UNK tokens that are copied (only when computing the
+        # loss). To do that we create a mask which is 1 only if the token is not a
         # copied UNK (or padding).
         unks = target_tokens.eq(self._unk_index).view(-1, 1)
         copied = target_alias_indices.gt(0).view(-1, 1)
@@ -514,7 +776,6 @@ class Kglm(Model):
         generate_log_probs_extended_vocab = generate_log_probs_source_vocab + (generate_mask.float() + 1e-45).log()
 
         # COPY LOSS ###
-        copy_log_probs = flattened_log_probs[:, vocab_size:]
         # When computing the loss we need to get the log probability of **only** the copied tokens.
         alias_indices = alias_indices.view(batch_size * sequence_length, -1)
         target_alias_indices = target_alias_indices.view(-1, 1)
@@ -559,7 +820,10 @@ class Kglm(Model):
         if bg_mask.any():
             self._bg_ppl(-combined_log_probs_source_vocab[bg_mask].sum(), bg_mask.float().sum() + 1e-13)
 
-        return vocab_loss
+        # The log-probability of the tokens in each sequence.
+        sequence_log_probs = (combined_log_probs_source_vocab * mask.float()).view(batch_size, -1).sum(-1)
+
+        return vocab_loss, sequence_log_probs
 
     def _forward_loop(self,
                       source: Dict[str, torch.Tensor],
@@ -572,7 +836,8 @@ class Kglm(Model):
                       relations: Dict[str, torch.Tensor],
                       shortlist: Dict[str, torch.Tensor],
                       shortlist_inds: torch.Tensor,
-                      alias_copy_inds: torch.Tensor) -> Dict[str, torch.Tensor]:
+                      alias_copy_inds: torch.Tensor,
+                      encoded: torch.Tensor = None) -> Dict[str, torch.Tensor]:
         # Get the token mask and extract indexed text fields.
         # shape: (batch_size, sequence_length)
         target_mask = get_text_field_mask(target)
@@ -587,55 +852,61 @@ class Kglm(Model):
         logger.debug('Entity ids shape: %s', entity_ids.shape)
         logger.debug('Relations & Parent ids shape: %s', relations.shape)
         logger.debug('Shortlist shape: %s', shortlist['entity_ids'].shape)
-        # Embed source tokens.
+        # Embed source tokens (unless they have already been encoded, in which case the
+        # activation regularizers are skipped).
         # shape: (batch_size, sequence_length, embedding_dim)
-        encoded, alpha_loss, beta_loss = self._encode_source(source)
+        if encoded is None:
+            encoded, alpha_loss, beta_loss = self._encode_source(source)
+        else:
+            alpha_loss = beta_loss = 0.0
         splits = [self.token_embedding_dim] + [self.entity_embedding_dim] * 2
         encoded_token, encoded_head, encoded_relation = encoded.split(splits, dim=-1)
 
         # Predict whether or not the next token will be an entity mention, and if so which type.
-        mention_type_loss = self._mention_type_loss(encoded_token, mention_type, target_mask)
+        mention_type_loss, mention_type_logp = self._mention_type_loss(encoded_token, mention_type, target_mask)
         self._avg_mention_type_loss(float(mention_type_loss))
 
         # For new mentions, predict which entity (among those in the supplied shortlist) will be
         # mentioned.
         if self._use_shortlist:
-            new_entity_loss = self._new_entity_loss(encoded_head + encoded_relation,
-                                                    shortlist_inds,
-                                                    shortlist,
-                                                    target_mask)
+            new_entity_loss, new_entity_logp = self._new_entity_loss(encoded_head + encoded_relation,
+                                                                     shortlist_inds,
+                                                                     shortlist,
+                                                                     target_mask)
         else:
-            new_entity_loss = self._new_entity_loss(encoded_head + encoded_relation,
-                                                    entity_ids,
-                                                    None,
-                                                    target_mask)
+            new_entity_loss, new_entity_logp = self._new_entity_loss(encoded_head + encoded_relation,
+                                                                     entity_ids,
+                                                                     None,
+                                                                     target_mask)
 
         self._avg_new_entity_loss(float(new_entity_loss))
 
         # For derived mentions, first predict which parent(s) to expand...
-        knowledge_graph_entity_loss = self._knowledge_graph_entity_loss(encoded_head,
-                                                                        encoded_relation,
-                                                                        raw_entity_ids,
-                                                                        entity_ids,
-                                                                        parent_ids,
-                                                                        target_mask)
+        knowledge_graph_entity_loss, knowledge_graph_entity_logp = self._knowledge_graph_entity_loss(
+            encoded_head,
+            encoded_relation,
+            raw_entity_ids,
+            entity_ids,
+            parent_ids,
+            target_mask)
         self._avg_knowledge_graph_entity_loss(float(knowledge_graph_entity_loss))
 
-        # Predict generation-mode scores. Note: these are W.R.T to entity_ids since we need the embedding.
-        generate_scores = self._generate_scores(encoded_token, entity_ids)
+        # Condense the hidden states used to predict generation-mode scores. Note: these are W.R.T
+        # to entity_ids since we need the embedding.
+        condensed = self._condense(encoded_token, entity_ids)
 
         # Predict copy-mode scores. Note: these are W.R.T raw_entity_ids since we need to look up aliases.
         alias_tokens, alias_inds = alias_database.lookup(raw_entity_ids)
         copy_scores = self._copy_scores(encoded_token, alias_tokens)
 
         # Combine scores to get vocab loss
-        vocab_loss = self._vocab_loss(generate_scores,
-                                      copy_scores,
-                                      target,
-                                      alias_copy_inds,
-                                      target_mask,
-                                      alias_inds,
-                                      entity_ids.gt(0))
+        vocab_loss, vocab_logp = self._vocab_loss(condensed,
+                                                  copy_scores,
+                                                  target,
+                                                  alias_copy_inds,
+                                                  target_mask,
+                                                  alias_inds,
+                                                  entity_ids.gt(0))
         self._avg_vocab_loss(float(vocab_loss))
 
         # Compute total loss
@@ -648,7 +919,257 @@ class Kglm(Model):
         if self._beta:
             loss = loss + self._beta * beta_loss
 
-        return {'loss': loss}
+        # The joint log-probability of the tokens and annotations of each sequence.
+        logp = vocab_logp + mention_type_logp + new_entity_logp + knowledge_graph_entity_logp
+
+        return {'loss': loss, 'logp': logp}
+
+    def reset_generation(self, batch_size: int) -> None:
+        """
+        Resets the recurrent state and recent entities of the model before generating
+        ``batch_size`` sequences in parallel.
+        """
+        device = next(self.parameters()).device
+        self._state = None
+        self._recent_entities.reset(torch.ones(batch_size, dtype=torch.uint8, device=device))
+
+    def prime(self,
+              source: torch.Tensor,
+              entity_ids: torch.Tensor = None) -> None:
+        """
+        Advances the model over a prefix without generating anything, so that subsequent calls to
+        ``step`` continue from it.
+
+        Parameters
+        ==========
+        source : ``torch.Tensor``
+            A tensor of shape ``(batch_size, prefix_length)`` containing the ids of the prefix
+            tokens.
+        entity_ids : ``torch.Tensor``, optional
+            A tensor of shape ``(batch_size, prefix_length)`` containing the ids (in the
+            ``entity_ids`` namespace) of the entity mentioned by the token following each source
+            token (i.e. aligned the same way as during training). If not given, the prefix is
+            assumed to contain no mentions.
+        """
+        with torch.no_grad():
+            self._encode_source(source)
+            if entity_ids is None:
+                entity_ids = torch.zeros_like(source)
+            self._recent_entities(entity_ids)
+
+    def step(self,
+             source: torch.Tensor,
+             alias_database: AliasDatabase,
+             temperature: float = 1.0,
+             top_k_entities: int = None) -> Dict[str, torch.Tensor]:
+        """
+        Advances the model a single timestep. The source tokens are encoded starting from the
+        cached recurrent state, and then the mention type, entity and next token are sampled.
+        Only the new token is encoded, and the recent entities and alias encodings are reused
+        between calls. The model should be in evaluation mode, and not use a shortlist.
+
+        Parameters
+        ==========
+        source : ``torch.Tensor``
+            A tensor of shape ``(batch_size,)`` containing the ids of the current tokens (e.g. the
+            tokens sampled by the previous call).
+        alias_database : ``AliasDatabase``
+            The alias database, used to look up the aliases of mentioned entities.
+        temperature : ``float``, optional (default=1.0)
+            The temperature used when sampling.
+        top_k_entities : ``int``, optional
+            If given, new entities are only sampled from the ``top_k_entities`` highest scoring
+            candidates (which are retrieved using the entity index, if the model has one).
+
+        Returns
+        =======
+        A dictionary of tensors with shape ``(batch_size,)``:
+            - ``tokens``: the ids of the sampled tokens.
+            - ``mention_type``: 0 if the token is not part of a mention, 1 if it mentions a new
+              entity, and 2 if it mentions an entity related to a recent entity.
+            - ``entity_ids`` and ``raw_entity_ids``: the ids of the mentioned entities.
+            - ``parent_ids`` and ``relations``: the parent entity and relation of entities related
+              to recent entities.
+            - ``alias_copy_inds``: the (entity-local) ids of copied alias tokens, or 0 if the token
+              was generated from the vocabulary.
+        """
+        if self._use_shortlist:
+            raise RuntimeError('Generation is not supported when using a shortlist')
+        alias_database.tensorize(vocab=self.vocab)
+
+        with torch.no_grad():
+            batch_size = source.shape[0]
+            encoded, _, _ = self._encode_source(source.view(batch_size, 1))
+            splits = [self.token_embedding_dim] + [self.entity_embedding_dim] * 2
+            encoded_token, encoded_head, encoded_relation = encoded.squeeze(1).split(splits, dim=-1)
+            entity_to_raw, raw_to_entity = self._entity_namespace_maps(source.device)
+
+            # Only recent entities with outgoing edges in the knowledge graph can be expanded.
+            candidate_ids, candidate_mask = self._recent_entities.current()
+            can_expand = torch.zeros_like(source, dtype=torch.uint8)
+            if candidate_ids.shape[1] > 0:
+                candidate_relations, candidate_tail_ids, edge_mask = self._knowledge_graph_lookup(candidate_ids)
+                if edge_mask.shape[-1] > 0:
+                    candidate_mask = candidate_mask & edge_mask.any(dim=-1)
+                    can_expand = candidate_mask.any(dim=-1)
+
+            # Sample the mention type.
+            mention_type_logits = self._fc_mention_type(encoded_token)
+            mention_type_mask = torch.ones_like(mention_type_logits, dtype=torch.uint8)
+            mention_type_mask[:, 2] = can_expand
+            mention_type = _sample(mention_type_logits, mention_type_mask, temperature)
+
+            # Sample new entities.
+            if top_k_entities is not None:
+                new_entity_logits, new_entity_candidates = self.new_entity_candidates(
+                    encoded_head + encoded_relation, top_k_entities)
+                new_entity_mask = new_entity_candidates.gt(0)
+                new_entity_index = _sample(new_entity_logits, new_entity_mask, temperature)
+                new_entity_ids = new_entity_candidates.gather(1, new_entity_index.unsqueeze(1)).squeeze(1)
+            else:
+                new_entity_logits = self._fc_new_entity(encoded_head + encoded_relation)
+                # The padding entity is never a valid prediction.
+                new_entity_mask = torch.ones_like(new_entity_logits, dtype=torch.uint8)
+                new_entity_mask[:, 0] = 0
+                new_entity_ids = _sample(new_entity_logits, new_entity_mask, temperature)
+
+            # Sample parents and relations for entities related to recent entities.
+            parent_ids = torch.zeros_like(source)
+            relations = torch.zeros_like(source)
+            derived_raw_entity_ids = torch.zeros_like(source)
+            if can_expand.any():
+                candidate_embeddings = self._entity_embedder(candidate_ids)
+                parent_logits = torch.bmm(candidate_embeddings, encoded_head.unsqueeze(-1)).squeeze(-1)
+                parent_index = _sample(parent_logits, candidate_mask, temperature)
+                parent_ids = candidate_ids.gather(1, parent_index.unsqueeze(1)).squeeze(1)
+
+                # shape: (batch_size, max_num_edges)
+                index = parent_index.view(batch_size, 1, 1).expand(-1, -1, edge_mask.shape[-1])
+                parent_relations = candidate_relations.gather(1, index).squeeze(1)
+                parent_tail_ids = candidate_tail_ids.gather(1, index).squeeze(1)
+                parent_edge_mask = edge_mask.gather(1, index).squeeze(1)
+                relation_embeddings = self._relation_embedder(parent_relations)
+                relation_logits = torch.bmm(relation_embeddings, encoded_relation.unsqueeze(-1)).squeeze(-1)
+                edge_index = _sample(relation_logits, parent_edge_mask, temperature).unsqueeze(1)
+                relations = parent_relations.gather(1, edge_index).squeeze(1)
+                derived_raw_entity_ids = parent_tail_ids.gather(1, edge_index).squeeze(1)
+
+            is_new = mention_type.eq(1)
+            is_derived = mention_type.eq(2)
+            entity_ids = torch.where(is_new, new_entity_ids, raw_to_entity[derived_raw_entity_ids])
+            entity_ids = entity_ids * (is_new | is_derived).long()
+            raw_entity_ids = torch.where(is_new, entity_to_raw[new_entity_ids], derived_raw_entity_ids)
+            raw_entity_ids = raw_entity_ids * (is_new | is_derived).long()
+            parent_ids = parent_ids * is_derived.long()
+            relations = relations * is_derived.long()
+
+            # Sample the next token, either from the vocabulary or by copying an alias token.
+            condensed = self._condense(encoded_token.unsqueeze(1), entity_ids.unsqueeze(1)).squeeze(1)
+            alias_tokens, alias_inds = alias_database.lookup(raw_entity_ids.unsqueeze(1))
+            copy_scores = self._copy_scores(encoded_token.unsqueeze(1), alias_tokens).squeeze(1)
+            alias_tokens = alias_tokens.view(batch_size, -1)
+            alias_inds = alias_inds.view(batch_size, -1)
+            log_probs = self._vocab_log_probs(condensed, copy_scores, alias_inds.gt(0))
+            vocab_size = log_probs.shape[-1] - alias_inds.shape[-1]
+            # The padding token is never generated.
+            token_mask = torch.cat((alias_inds.new_ones(batch_size, vocab_size).byte(),
+                                    alias_inds.gt(0)), dim=-1)
+            token_mask[:, 0] = 0
+            index = _sample(log_probs, token_mask, temperature)
+
+            copied = index.ge(vocab_size)
+            copy_index = (index - vocab_size).clamp(min=0).unsqueeze(1)
+            tokens = torch.where(copied, alias_tokens.gather(1, copy_index).squeeze(1), index)
+            alias_copy_inds = alias_inds.gather(1, copy_index).squeeze(1) * copied.long()
+
+            # Lastly, update the recent entities.
+            self._recent_entities(entity_ids.unsqueeze(1))
+
+        return {
+                'tokens': tokens,
+                'mention_type': mention_type,
+                'entity_ids': entity_ids,
+                'raw_entity_ids': raw_entity_ids,
+                'parent_ids': parent_ids,
+                'relations': relations,
+                'alias_copy_inds': alias_copy_inds
+        }
+
+    def generate(self,
+                 alias_database: AliasDatabase,
+                 max_length: int,
+                 batch_size: int = 1,
+                 prefix: torch.Tensor = None,
+                 temperature: float = 1.0,
+                 top_k_entities: int = None) -> Dict[str, torch.Tensor]:
+        """
+        Samples ``batch_size`` continuations of length ``max_length`` in parallel (see ``step``).
+        Tokens sampled after an ``@@END@@`` token should be ignored.
+
+        Parameters
+        ==========
+        alias_database : ``AliasDatabase``
+            The alias database.
+        max_length : ``int``
+            The number of tokens to generate.
+        batch_size : ``int``, optional (default=1)
+            The number of sequences to generate. Ignored if a prefix is given.
+        prefix : ``torch.Tensor``, optional
+            A tensor of shape ``(batch_size, prefix_length)`` containing the ids of the tokens to
+            continue from (starting with the ``@@START@@`` token). If not given, sequences are
+            generated starting from the ``@@START@@`` token.
+
+        Returns
+        =======
+        A dictionary of tensors of shape ``(batch_size, max_length)``, with the same keys as the
+        output of ``step``.
+        """
+        if prefix is None:
+            device = next(self.parameters()).device
+            start_index = self.vocab.get_token_index('@@START@@', 'tokens')
+            prefix = torch.full((batch_size, 1), start_index, dtype=torch.int64, device=device)
+        self.reset_generation(prefix.shape[0])
+        if prefix.shape[1] > 1:
+            self.prime(prefix[:, :-1])
+
+        source = prefix[:, -1]
+        outputs: Dict[str, List[torch.Tensor]] = {}
+        for _ in range(max_length):
+            output = self.step(source, alias_database, temperature, top_k_entities)
+            for key, value in output.items():
+                outputs.setdefault(key, []).append(value)
+            source = output['tokens']
+
+        return {key: torch.stack(values, dim=1) for key, values in outputs.items()}
+
+    def _vocab_log_probs(self,
+                         condensed: torch.Tensor,
+                         copy_scores: torch.Tensor,
+                         alias_mask: torch.Tensor) -> torch.Tensor:
+        # Log probabilities of every token in the vocabulary, followed by the log probabilities of
+        # copying each alias token.
+        if self._split_cross_entropy is None:
+            generate_scores = self._fc_generate(condensed)
+            score_mask = torch.cat((alias_mask.new_ones(generate_scores.shape), alias_mask), dim=-1)
+            return masked_log_softmax(torch.cat((generate_scores, copy_scores), dim=-1), score_mask)
+        return self._split_cross_entropy.mixture_logprob(self._fc_generate.weight,
+                                                         self._fc_generate.bias,
+                                                         condensed,
+                                                         copy_scores,
+                                                         alias_mask)
+
+    def _entity_namespace_maps(self, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Entities are predicted in the ``entity_ids`` namespace, but their aliases and the tails
+        # of knowledge graph edges are in the ``raw_entity_ids`` namespace, so when generating we
+        # need to map between the two.
+        if self._entity_to_raw is None:
+            entity_to_raw, raw_to_entity = entity_namespace_maps(self.vocab)
+            self._entity_to_raw = torch.tensor(entity_to_raw, dtype=torch.int64)
+            self._raw_to_entity = torch.tensor(raw_to_entity, dtype=torch.int64)
+        if self._entity_to_raw.device != device:
+            self._entity_to_raw = self._entity_to_raw.to(device)
+            self._raw_to_entity = self._raw_to_entity.to(device)
+        return self._entity_to_raw, self._raw_to_entity
 
     @overrides
     def train(self, mode=True):
@@ -689,5 +1210,6 @@ class Kglm(Model):
         out['new_ent_acc_20'] = self._new_entity_accuracy20.get_metric(reset)
         out['parent_ppl'] = self._parent_ppl.get_metric(reset)
         out['relation_ppl'] = self._relation_ppl.get_metric(reset)
+        out['alias_cache_hit_rate'] = self._alias_encoding_cache.get_metric(reset)
         return out
 
@@ -30,6 +30,9 @@ class KglmDisc(Model):
     ----------
     vocab : ``Vocabulary``
         The model vocabulary.
+    knowledge_graph_cache_directory : ``str``, optional (default=None)
+        If given, a directory in which the indexed knowledge graph is cached (see
+        ``KnowledgeGraphLookup``).
     """
     def __init__(self,
                  vocab: Vocabulary,
@@ -49,6 +52,7 @@ class KglmDisc(Model):
                  wdrop: float = 0.5,
                  alpha: float = 2.0,
                  beta: float = 1.0,
+                 knowledge_graph_cache_directory: str = None,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(KglmDisc, self).__init__(vocab)
 
@@ -58,7 +62,9 @@ class KglmDisc(Model):
         self._entity_embedder = entity_embedder._token_embedders['entity_ids']
         self._relation_embedder = relation_embedder._token_embedders['relations']
         self._recent_entities = RecentEntities(cutoff=cutoff)
-        self._knowledge_graph_lookup = KnowledgeGraphLookup(knowledge_graph_path, vocab=vocab)
+        self._knowledge_graph_lookup = KnowledgeGraphLookup(knowledge_graph_path,
+                                                            vocab=vocab,
+                                                            cache_directory=knowledge_graph_cache_directory)
         self._use_shortlist = use_shortlist
         self._hidden_size = hidden_size
         self._num_layers = num_layers
@@ -166,6 +172,22 @@ class KglmDisc(Model):
 
         return output_dict
 
+    def encode(self, source: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes entire (unsplit) sequences of source tokens, starting from a fresh recurrent
+        state. Used when sampling, since the hidden states do not depend on the annotations. The
+        recurrent state is left empty afterwards.
+
+        Returns
+        -------
+        A tensor of shape ``(batch_size, sequence_length, token_embedding_dim + 2 *
+        entity_embedding_dim)``.
+        """
+        self._state = None
+        encoded, _, _ = self._encode_source(source['tokens'])
+        self._state = None
+        return encoded
+
     def _encode_source(self, source: Dict[str, torch.Tensor]) -> torch.Tensor:
 
         # Extract and embed source tokens.
@@ -347,32 +369,46 @@ class KglmDisc(Model):
                             parent_ids: torch.Tensor) -> torch.Tensor:
 
         # Lookup edges out of parents
-        indices, parent_ids_list, relations_list, tail_ids_list = self._knowledge_graph_lookup(parent_ids)
-
-        # Embed relations
-        relation_embeddings = [self._relation_embedder(r) for r in relations_list]
+        # shape: (batch_size, sequence_length, num_parents, max_num_edges)
+        relations, tail_ids, edge_mask = self._knowledge_graph_lookup(parent_ids)
 
         # Logits are computed using a general bilinear form that measures the similarity between
         # the projected hidden state and the embeddings of relations
         encoded = self._locked_dropout(encoded_relation, self._dropout)
 
-        # This is a little funky, but to avoid massive amounts of padding we are going to just
-        # iterate over the relation and tail_id vectors one-by-one.
-        # shape: (batch_size, sequence_length, num_parents, num_relations)
+        # shape: (batch_size, sequence_length, num_parents)
         target_log_probs = encoded.new_empty(*parent_ids.shape).fill_(math.log(1e-45))
-        for index, parent_id, relation_embedding, tail_id in zip(indices, parent_ids_list, relation_embeddings, tail_ids_list):
-            # First we compute the score for each relation w.r.t the current encoding, and convert
-            # the scores to log-probabilities
-            logits = torch.mv(relation_embedding, encoded[index[:-1]])
-            logger.debug('Relation logits shape: %s', logits.shape)
-            log_probs = F.log_softmax(logits, dim=-1)
 
-            # Next we gather the log probs for edges with the correct tail entity and sum them up
-            target_id = raw_entity_ids[index[:-1]]
-            mask = tail_id.eq(target_id)
-            relevant_log_probs = log_probs.masked_select(tail_id.eq(target_id))
-            target_log_prob = torch.logsumexp(relevant_log_probs, dim=0)
-            target_log_probs[index] = target_log_prob
+        # Only the (batch, timestep, parent) tuples with outgoing edges need to be scored. To avoid
+        # padding out every null parent, we gather these tuples into a flat batch and compute all
+        # of their logits with a single bmm.
+        has_edges = edge_mask.any(dim=-1)
+        if not has_edges.any():
+            return target_log_probs
+        num_parents = parent_ids.shape[-1]
+
+        # shape: (num_scored, max_num_edges)
+        relations = relations[has_edges]
+        tail_ids = tail_ids[has_edges]
+        edge_mask = edge_mask[has_edges]
+        # shape: (num_scored, embedding_dim)
+        encoded = encoded.unsqueeze(2).expand(-1, -1, num_parents, -1)[has_edges]
+        # shape: (num_scored,)
+        target_ids = raw_entity_ids.unsqueeze(-1).expand_as(has_edges)[has_edges]
+
+        # First we compute the score for each relation w.r.t the current encoding, and convert
+        # the scores to log-probabilities
+        # shape: (num_scored, max_num_edges, embedding_dim)
+        relation_embeddings = self._relation_embedder(relations)
+        logits = torch.bmm(relation_embeddings, encoded.unsqueeze(-1)).squeeze(-1)
+        logger.debug('Relation logits shape: %s', logits.shape)
+        log_probs = masked_log_softmax(logits, edge_mask)
+
+        # Next we gather the log probs for edges with the correct tail entity, sum them up, and
+        # scatter the results back into their (batch, timestep, parent) positions.
+        target_mask = tail_ids.eq(target_ids.unsqueeze(-1)) & edge_mask
+        log_probs = log_probs + (target_mask.float() + 1e-45).log()
+        target_log_probs[has_edges] = torch.logsumexp(log_probs, dim=-1)
 
         return target_log_probs
 
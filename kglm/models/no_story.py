@@ -15,7 +15,8 @@ import torch.nn.functional as F
 
 from kglm.data import AliasDatabase
 from kglm.modules import (
-    embedded_dropout, LockedDropout, WeightDrop, KnowledgeGraphLookup, RecentEntities)
+    embedded_dropout, AliasEncodingCache, LockedDropout, WeightDrop, KnowledgeGraphLookup,
+    RecentEntities)
 from kglm.training.metrics import Ppl
 
 logger = logging.getLogger(__name__)
@@ -30,6 +31,8 @@ class NoStory(Model):
     ----------
     vocab : ``Vocabulary``
         The model vocabulary.
+    alias_cache_size : ``int``, optional (default=4096)
+        The number of alias encodings cached during evaluation (0 disables the cache).
     """
     def __init__(self,
                  vocab: Vocabulary,
@@ -48,6 +51,7 @@ class NoStory(Model):
                  wdrop: float = 0.5,
                  alpha: float = 2.0,
                  beta: float = 1.0,
+                 alias_cache_size: int = 4096,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(NoStory, self).__init__(vocab)
 
@@ -56,6 +60,7 @@ class NoStory(Model):
         self._token_embedder = token_embedder._token_embedders['tokens']
         self._entity_embedder = entity_embedder._token_embedders['entity_ids']
         self._alias_encoder = alias_encoder
+        self._alias_encoding_cache = AliasEncodingCache(max_size=alias_cache_size)
         self._recent_entities = RecentEntities(cutoff=cutoff)
         self._use_shortlist = use_shortlist
         self._hidden_size = hidden_size
@@ -371,6 +376,14 @@ class NoStory(Model):
         condensed = self._fc_condense(concatenated)
         return self._fc_generate(condensed)
 
+    def _encode_aliases(self, aliases: torch.Tensor) -> torch.Tensor:
+        embedded = self._token_embedder(aliases)
+        mask = aliases.gt(0)
+        encoded_aliases = self._alias_encoder(embedded, mask)
+
+        # Equation 8 in the CopyNet paper recommends applying the additional step.
+        return torch.tanh(self._fc_copy(encoded_aliases))
+
     def _copy_scores(self,
                      encoded: torch.Tensor,
                      alias_tokens: torch.Tensor) -> torch.Tensor:
@@ -383,13 +396,12 @@ class NoStory(Model):
             return encoded.new_zeros((batch_size, sequence_length, num_aliases * alias_length),
                                      dtype=torch.float32)
 
-        # Embed and encode the alias tokens.
-        embedded = self._token_embedder(flattened)
-        mask = flattened.gt(0)
-        encoded_aliases = self._alias_encoder(embedded, mask)
-
-        # Equation 8 in the CopyNet paper recommends applying the additional step.
-        projected = torch.tanh(self._fc_copy(encoded_aliases))
+        # Embed and encode the alias tokens. Most positions share the same few aliases (or are
+        # padding), so we only encode each unique alias once and then scatter the results back to
+        # their original positions. During evaluation, encodings are also reused across batches.
+        unique_aliases, inverse = torch.unique(flattened, sorted=True, return_inverse=True, dim=0)
+        projected = self._alias_encoding_cache(unique_aliases, self._encode_aliases)
+        projected = projected.index_select(0, inverse.view(-1))
         projected = self._locked_dropout(projected, self._dropout)
 
         # This part gets a little funky - we need to make sure that the first dimension in
@@ -599,4 +611,5 @@ class NoStory(Model):
         out['new_f1'] = f
         out['new_ent_acc'] = self._new_entity_accuracy.get_metric(reset)
         out['new_ent_acc_20'] = self._new_entity_accuracy20.get_metric(reset)
+        out['alias_cache_hit_rate'] = self._alias_encoding_cache.get_metric(reset)
         return out
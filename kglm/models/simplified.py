@@ -13,7 +13,7 @@ import torch
 import torch.nn.functional as F
 
 from kglm.data import AliasDatabase
-from kglm.modules import embedded_dropout, LockedDropout, WeightDrop
+from kglm.modules import embedded_dropout, AliasEncodingCache, LockedDropout, WeightDrop
 from kglm.training.metrics import Ppl
 
 logger = logging.getLogger(__name__)
@@ -34,6 +34,8 @@ class AliasCopynet(Model):
         Used to encode the sequence of token embeddings.
     embedding_dim : ``int``
         The dimension of entity / length embeddings. Should match the encoder output size.
+    alias_cache_size : ``int``, optional (default=4096)
+        The number of alias encodings cached during evaluation (0 disables the cache).
     """
     def __init__(self,
                  vocab: Vocabulary,
@@ -50,6 +52,7 @@ class AliasCopynet(Model):
                  alpha: float = 2.0,
                  beta: float = 1.0,
                  tie_weights: bool = False,
+                 alias_cache_size: int = 4096,
                  initializer: InitializerApplicator = InitializerApplicator()) -> None:
         super(AliasCopynet, self).__init__(vocab)
 
@@ -59,6 +62,7 @@ class AliasCopynet(Model):
         self._token_embedder = token_embedder._token_embedders['tokens']
         self._entity_embedder = entity_embedder._token_embedders['entity_ids']
         self._alias_encoder = alias_encoder
+        self._alias_encoding_cache = AliasEncodingCache(max_size=alias_cache_size)
         self._hidden_size = hidden_size
         self._num_layers = num_layers
         self._tie_weights = tie_weights
@@ -213,6 +217,14 @@ class AliasCopynet(Model):
         entity_loss = entity_loss / (mask.float().sum() + 1e-13)
         return entity_loss
 
+    def _encode_aliases(self, aliases: torch.Tensor) -> torch.Tensor:
+        embedded = self._token_embedder(aliases)
+        mask = aliases.gt(0)
+        encoded_aliases = self._alias_encoder(embedded, mask)
+
+        # Equation 8 in the CopyNet paper recommends applying the additional step.
+        return torch.tanh(self._fc_copy(encoded_aliases))
+
     def _copy_scores(self,
                      encoded: torch.Tensor,
                      alias_tokens: torch.Tensor) -> torch.Tensor:
@@ -225,13 +237,12 @@ class AliasCopynet(Model):
             return encoded.new_zeros((batch_size, sequence_length, alias_length),
                                      dtype=torch.float32)
 
-        # Embed and encode the alias tokens.
-        embedded = self._token_embedder(flattened)
-        mask = flattened.gt(0)
-        encoded_aliases = self._alias_encoder(embedded, mask)
-
-        # Equation 8 in the CopyNet paper recommends applying the additional step.
-        projected = torch.tanh(self._fc_copy(encoded_aliases))
+        # Embed and encode the alias tokens. Most positions share the same few aliases (or are
+        # padding), so we only encode each unique alias once and then scatter the results back to
+        # their original positions. During evaluation, encodings are also reused across batches.
+        unique_aliases, inverse = torch.unique(flattened, sorted=True, return_inverse=True, dim=0)
+        projected = self._alias_encoding_cache(unique_aliases, self._encode_aliases)
+        projected = projected.index_select(0, inverse.view(-1))
         projected = self._locked_dropout(projected, self._dropout)
 
         # This part gets a little funky - we need to make sure that the first dimension in
@@ -414,5 +425,6 @@ class AliasCopynet(Model):
             'ppl': self._ppl.get_metric(reset),
             'upp': self._upp.get_metric(reset),
             'kg_ppl': self._kg_ppl.get_metric(reset),
-            'bg_ppl': self._bg_ppl.get_metric(reset)
+            'bg_ppl': self._bg_ppl.get_metric(reset),
+            'alias_cache_hit_rate': self._alias_encoding_cache.get_metric(reset)
         }
@@ -1,5 +1,7 @@
+from .alias_encoding_cache import AliasEncodingCache
 from .dynamic_embeddings import DynamicEmbedding
 from .embed_regularize import embedded_dropout
+from .entity_index import EntityIndex
 from .knowledge_graph_lookup import KnowledgeGraphLookup
 from .locked_dropout import LockedDropout
 from .recent_entities import RecentEntities
@@ -0,0 +1,163 @@
+from typing import Callable
+
+import torch
+
+# The base of the polynomial hash used to compare aliases (see ``AliasEncodingCache._hash``).
+_HASH_BASE = 1000003
+
+
+class AliasEncodingCache(torch.nn.Module):
+    """
+    A size-bounded LRU cache of alias encodings, used to avoid re-encoding the aliases of popular
+    entities during evaluation.
+
+    The cache is keyed by the alias tokens (so it does not matter which entity an alias belongs
+    to) and is only used in evaluation mode, since the encodings change whenever the parameters
+    are updated. It is cleared whenever the module (or its parent) switches modes and whenever a
+    state dict is loaded into its parent.
+
+    The cached aliases and their encodings are stored in preallocated tensors, so that the
+    aliases of a batch are looked up without leaving the device (apart from counting the misses)
+    and the memory used by the cache is bounded by ``max_size``. Since aliases are padded to the
+    length of the longest alias in the database, all of the aliases are expected to have the same
+    length; if the length changes, the cache is cleared.
+
+    Parameters
+    ----------
+    max_size : ``int``, optional (default=4096)
+        The maximum number of alias encodings to store. If 0, then caching is disabled.
+    """
+    def __init__(self, max_size: int = 4096) -> None:
+        super(AliasEncodingCache, self).__init__()
+        self._max_size = max_size
+        # The cached aliases, their hashes and encodings, and when each was last used. These are
+        # allocated when the first aliases are cached.
+        self._keys: torch.Tensor = None
+        self._hashes: torch.Tensor = None
+        self._values: torch.Tensor = None
+        self._last_used: torch.Tensor = None
+        self._clock = 0
+        self._hits = 0
+        self._lookups = 0
+
+    @staticmethod
+    def _hash(aliases: torch.LongTensor) -> torch.LongTensor:
+        # Integer overflow simply wraps around, which is fine for hashing. Collisions are handled by
+        # comparing the tokens of matching aliases.
+        hashes = torch.zeros_like(aliases[:, 0])
+        for i in range(aliases.shape[1]):
+            hashes = hashes * _HASH_BASE + aliases[:, i]
+        return hashes
+
+    def forward(self,  # pylint: disable=arguments-differ
+                aliases: torch.LongTensor,
+                encode: Callable[[torch.LongTensor], torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes the given aliases, using cached encodings whenever possible.
+
+        Parameters
+        ----------
+        aliases : ``torch.LongTensor``
+            A tensor of shape ``(num_aliases, alias_length)`` containing unique alias tokens.
+        encode : ``Callable[[torch.LongTensor], torch.Tensor]``
+            The function used to encode aliases which are not in the cache. Must map a tensor of
+            shape ``(n, alias_length)`` to a tensor of shape ``(n, *)``.
+
+        Returns
+        -------
+        A tensor of shape ``(num_aliases, *)`` containing the encoded aliases.
+        """
+        if self.training or self._max_size <= 0 or aliases.shape[0] == 0:
+            return encode(aliases)
+
+        if self._keys is not None and (self._keys.shape[1] != aliases.shape[1] or
+                                       self._keys.device != aliases.device):
+            self.clear()
+
+        num_aliases = aliases.shape[0]
+        hashes = self._hash(aliases)
+        if self._keys is not None:
+            # shape: (num_aliases, num_cached)
+            matches = hashes.unsqueeze(1).eq(self._hashes.unsqueeze(0))
+            hit, slots = matches.max(dim=1)
+            hit = hit & self._keys.index_select(0, slots).eq(aliases).all(dim=-1)
+        else:
+            hit = torch.zeros_like(hashes, dtype=torch.uint8)
+            slots = torch.zeros_like(hashes)
+        hit_index = hit.nonzero().view(-1)
+        miss_index = (hit == 0).nonzero().view(-1)
+        num_misses = miss_index.shape[0]
+        self._hits += num_aliases - num_misses
+        self._lookups += num_aliases
+
+        if self._keys is not None:
+            hit_slots = slots.index_select(0, hit_index)
+            self._last_used.index_fill_(0, hit_slots, self._clock)
+            outputs = self._values.index_select(0, slots)
+        if num_misses > 0:
+            encoded = encode(aliases.index_select(0, miss_index)).detach()
+            if self._keys is None:
+                outputs = encoded
+            else:
+                outputs = outputs.index_copy(0, miss_index, encoded)
+            self._insert(aliases.index_select(0, miss_index),
+                         hashes.index_select(0, miss_index),
+                         encoded)
+        self._clock += 1
+
+        return outputs
+
+    def _insert(self,
+                keys: torch.LongTensor,
+                hashes: torch.LongTensor,
+                values: torch.Tensor) -> None:
+        # If there are more new aliases than fit in the cache, then only some of them are stored.
+        # The stored encodings are copies, so that they do not keep the encoded batch alive.
+        keys = keys[:self._max_size]
+        hashes = hashes[:self._max_size]
+        values = values[:self._max_size].clone()
+        last_used = torch.full_like(hashes, self._clock)
+        if self._keys is None:
+            self._keys, self._hashes, self._values, self._last_used = keys, hashes, values, last_used
+            return
+
+        # Fill any free space first...
+        num_free = min(self._max_size - self._keys.shape[0], keys.shape[0])
+        if num_free > 0:
+            self._keys = torch.cat((self._keys, keys[:num_free]), dim=0)
+            self._hashes = torch.cat((self._hashes, hashes[:num_free]), dim=0)
+            self._values = torch.cat((self._values, values[:num_free]), dim=0)
+            self._last_used = torch.cat((self._last_used, last_used[:num_free]), dim=0)
+        # ...then replace the least recently used entries.
+        num_evicted = keys.shape[0] - num_free
+        if num_evicted > 0:
+            _, evicted = self._last_used.topk(num_evicted, largest=False)
+            self._keys.index_copy_(0, evicted, keys[num_free:])
+            self._hashes.index_copy_(0, evicted, hashes[num_free:])
+            self._values.index_copy_(0, evicted, values[num_free:])
+            self._last_used.index_copy_(0, evicted, last_used[num_free:])
+
+    def clear(self) -> None:
+        self._keys = None
+        self._hashes = None
+        self._values = None
+        self._last_used = None
+
+    def get_metric(self, reset: bool = False) -> float:
+        """Returns the fraction of lookups which were cache hits."""
+        hit_rate = self._hits / self._lookups if self._lookups > 0 else 0.0
+        if reset:
+            self._hits = 0
+            self._lookups = 0
+        return hit_rate
+
+    def train(self, mode=True):
+        # Cached encodings are invalidated whenever the mode changes (e.g. since the parameters
+        # will have been updated after training).
+        self.clear()
+        return super(AliasEncodingCache, self).train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        # The parameters of the alias encoder are being reloaded, so cached encodings are stale.
+        self.clear()
+        super(AliasEncodingCache, self)._load_from_state_dict(*args, **kwargs)
@@ -1,4 +1,4 @@
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
 from overrides import overrides
 import torch
@@ -14,14 +14,20 @@ class DynamicEmbedding(Module):
     Designed so that entity lookups and updates can be efficiently done in batch.
     The tricks are:
         1. To pre-allocate a tensor for storing the entity embeddings on each reset.
-        2. To use logical indexing to perform the updates.
+        2. To perform the updates in-place, using the indices of the affected sequences.
+
+    Each embedding is stored in a slot, and ``slot_ids`` records which entity occupies each slot.
+    Entities are stored in the order they are added (so slots and entity ids coincide) until
+    ``max_embeddings`` is exhausted. After that the least recently used entity (other than the
+    null entity in slot 0) is evicted to make room for a new one. If an evicted entity is
+    mentioned again, its embedding is re-initialized.
 
     Parameters
     ----------
     embedding_dim : ``int``
         Dimension of the entity embeddings.
     max_embeddings : ``int``
-        Maximum number of allowed embeddings.
+        Maximum number of embeddings stored at once.
     """
     def __init__(self,
                  embedding_dim: int,
@@ -41,8 +47,14 @@ class DynamicEmbedding(Module):
                                                  bias=False)
 
         self.embeddings: torch.Tensor = None  # Storage for embeddings
-        self.num_embeddings: torch.Tensor = None  # Tracks how many embeddings are in use
+        self.num_embeddings: torch.Tensor = None  # Tracks how many entities have been added
         self.last_seen: torch.Tensor = None  # Tracks last time embedding was seen
+        self.slot_ids: torch.Tensor = None  # Tracks which entity is stored in each slot (-1 if empty)
+
+        # ``last_seen`` is relative to the start of the current chunk, so eviction uses a counter
+        # which is incremented at every update instead.
+        self._last_used: torch.Tensor = None
+        self._clock = 0
 
     def reset_states(self, batch_size: int) -> None:
         """
@@ -58,6 +70,9 @@ class DynamicEmbedding(Module):
         self.num_embeddings = self._initial_embedding.new_zeros(batch_size, dtype=torch.int64)
         self.last_seen = self._initial_embedding.new_zeros(batch_size, self._max_embeddings,
                                                            dtype=torch.int64)
+        self.slot_ids = self.last_seen.new_full((batch_size, self._max_embeddings), -1)
+        self._last_used = self.last_seen.new_zeros(batch_size, self._max_embeddings)
+        self._clock = 0
         self.add_embeddings(0)
 
     def detach_states(self) -> None:
@@ -67,11 +82,67 @@ class DynamicEmbedding(Module):
         """
         self.embeddings = self.embeddings.detach()
 
+    def slots(self, entity_ids: torch.LongTensor) -> torch.LongTensor:
+        """
+        Finds the slots storing the embeddings of the given entities.
+
+        Parameters
+        ----------
+        entity_ids : ``torch.LongTensor``
+            A tensor of shape ``(batch_size,)`` containing entity ids.
+
+        Returns
+        -------
+        A tensor of shape ``(batch_size,)`` containing the slot of each entity. Entities which are
+        not stored (e.g. have not been added yet, or have been evicted) are mapped to the slot of
+        the null entity (e.g. 0).
+        """
+        return self._find_slots(self.slot_ids, entity_ids)
+
+    @staticmethod
+    def _find_slots(slot_ids: torch.LongTensor,
+                    entity_ids: torch.LongTensor) -> torch.LongTensor:
+        found, slots = slot_ids.eq(entity_ids.unsqueeze(1)).long().max(dim=1)
+        return slots * found
+
+    def _rows(self, mask: Optional[torch.Tensor]) -> torch.LongTensor:
+        if mask is None:
+            return torch.arange(self.num_embeddings.shape[0], dtype=torch.int64,
+                                device=self.num_embeddings.device)
+        return mask.nonzero().view(-1)
+
+    def _allocate(self,
+                  rows: torch.LongTensor,
+                  entity_ids: torch.LongTensor,
+                  timestep: int) -> torch.LongTensor:
+        """
+        Stores freshly initialized embeddings for the given entities, evicting the least recently
+        used entities if there are no free slots. Returns the allocated slots.
+        """
+        # Slots are never freed, so the free slots are always the trailing ones.
+        num_occupied = self.slot_ids.index_select(0, rows).ge(0).long().sum(-1)
+        least_recently_used = self._last_used.index_select(0, rows)[:, 1:].argmin(-1) + 1
+        slots = torch.where(num_occupied.lt(self._max_embeddings), num_occupied, least_recently_used)
+
+        # Embeddings are initialized by adding a small amount of random noise to the initial
+        # embedding tensor then normalizing.
+        initial = self._initial_embedding.repeat((rows.shape[0], 1))
+        noise = 1e-4 * torch.randn_like(initial)  # 1e-4 is a magic number from the original implementation
+        unnormalized = initial + noise
+        normalized = F.normalize(unnormalized, dim=-1)
+
+        self.embeddings.index_put_((rows, slots), normalized)
+        self.last_seen.index_put_((rows, slots), self.last_seen.new_full(slots.shape, timestep))
+        self.slot_ids.index_put_((rows, slots), entity_ids)
+        self._last_used.index_put_((rows, slots), self._last_used.new_full(slots.shape, self._clock))
+        return slots
+
     def add_embeddings(self,
                        timestep: int,
                        mask: Optional[torch.Tensor] = None) -> None:
         """
-        Adds new embeddings to the current collection of embeddings.
+        Adds new embeddings to the current collection of embeddings. The id of each new entity is
+        the number of entities previously added to the sequence.
 
         Parameters
         ----------
@@ -82,22 +153,12 @@ class DynamicEmbedding(Module):
             embedding to. If no mask is provided then a new embedding is added for each sequence
             in the batch.
         """
-        if mask is None:
-            batch_size = self.num_embeddings.shape[0]
-            mask = self.num_embeddings.new_ones(batch_size, dtype=torch.uint8)
-        elif mask.sum() == 0:
+        rows = self._rows(mask)
+        if rows.shape[0] == 0:
             return
 
-        # Embeddings are initialized by adding a small amount of random noise to the initial
-        # embedding tensor then normalizing.
-        initial = self._initial_embedding.repeat((mask.sum(), 1, 1))
-        noise = 1e-4 * torch.randn_like(initial)  # 1e-4 is a magic number from the original implementation
-        unnormalized = initial + noise
-        normalized = F.normalize(unnormalized, dim=-1)
-
-        self.embeddings[mask, self.num_embeddings[mask]] = normalized.squeeze()
-        self.last_seen[mask, self.num_embeddings[mask]] = timestep
-        self.num_embeddings[mask] += 1
+        self._allocate(rows, self.num_embeddings.index_select(0, rows), timestep)
+        self.num_embeddings.index_add_(0, rows, torch.ones_like(rows))
 
     def update_embeddings(self,
                           hidden: torch.Tensor,
@@ -112,8 +173,8 @@ class DynamicEmbedding(Module):
         hidden : ``torch.Tensor``
             A tensor of shape ``(batch_size, embedding_dim)`` used to update existing embeddings.
         update_indices : ``torch.Tensor``
-            A tensor of shape ``(batch_size)`` whose elements specify which of the existing
-            embeddings to update. Only one embedding per sequence can be updated at a time.
+            A tensor of shape ``(batch_size)`` whose elements specify the ids of the entities to
+            update. Only one embedding per sequence can be updated at a time.
         timestep : ``int``
             The current time step.
         mask: ``Optional[torch.Tensor]``
@@ -121,32 +182,39 @@ class DynamicEmbedding(Module):
             the dynamic embeddings for. If a mask is not provided then all sequences will be
             updated.
         """
-        if mask is None:
-            batch_size = self.num_embeddings.shape[0]
-            mask = self.num_embeddings.new_ones(batch_size, dtype=torch.uint8)
-        elif mask.sum() == 0:
+        rows = self._rows(mask)
+        if rows.shape[0] == 0:
+            self._clock += 1
             return
-        else:
-            batch_size = mask.sum()
 
-        embeddings = self.embeddings[mask, update_indices[mask]]
-        hidden = hidden.clone()[mask]
+        entity_ids = update_indices.index_select(0, rows)
+        slot_ids = self.slot_ids.index_select(0, rows)
+        found = slot_ids.eq(entity_ids.unsqueeze(1)).any(dim=1)
+        slots = self._find_slots(slot_ids, entity_ids)
+
+        # Entities whose embeddings have been evicted are re-added before being updated.
+        if not found.all():
+            missing = (~found).nonzero().view(-1)
+            reallocated = self._allocate(rows.index_select(0, missing),
+                                         entity_ids.index_select(0, missing),
+                                         timestep)
+            slots = slots.index_copy(0, missing, reallocated)
+
+        embeddings = self.embeddings[rows, slots]
+        hidden = hidden.index_select(0, rows)
 
         # Equation 8 in the paper.
         projected = self._delta_projection(embeddings)
-        score = torch.bmm(hidden.view(batch_size, 1, -1),
-                          projected.view(batch_size, -1, 1))
-        score = score.view(batch_size, 1)
+        score = (hidden * projected).sum(dim=-1, keepdim=True)
         delta = torch.sigmoid(score)
 
         unnormalized = delta * embeddings + (1 - delta) * hidden
         normalized = F.normalize(unnormalized, dim=-1)
 
-        # If the batch size is one, our approach of indexing with masks will drop the batch
-        # dimension when accessing self.embeddings. Accordingly, the batch dimension of
-        # normalized needs to be dropped in this case in order for assignment to work.
-        self.embeddings[mask, update_indices[mask]] = normalized.squeeze(0)
-        self.last_seen[mask, update_indices[mask]] = timestep
+        self.embeddings.index_put_((rows, slots), normalized)
+        self.last_seen.index_put_((rows, slots), self.last_seen.new_full(slots.shape, timestep))
+        self._last_used.index_put_((rows, slots), self._last_used.new_full(slots.shape, self._clock))
+        self._clock += 1
 
     @overrides
     def forward(self,  # pylint: disable=arguments-differ
@@ -172,38 +240,31 @@ class DynamicEmbedding(Module):
         -------
         An output dictionary consisting of:
         logits : ``torch.Tensor``
-            The entity prediction logits.
+            The entity prediction logits, over the embedding slots.
         logit_mask : ``torch.Tensor``
             Mask for the logit tensor.
         loss : ``Optional[torch.Tensor]``
             The loss.
         """
-        if mask is None:
-            batch_size = self.num_embeddings.shape[0]
-            mask = self.num_embeddings.new_ones(batch_size, dtype=torch.uint8)
-        elif mask.sum() == 0:
+        rows = self._rows(mask)
+        if rows.shape[0] == 0:
             return {'loss': 0.0}
-        else:
-            batch_size = mask.sum()
 
         # First half of equation 4.
-        embeddings = self.embeddings[mask]
+        embeddings = self.embeddings.index_select(0, rows)
         projected_embeddings = self._embedding_projection(embeddings)
-        hidden = hidden[mask].unsqueeze(1)
-        bilinear = torch.bmm(hidden, projected_embeddings.transpose(1, 2))
-        bilinear = bilinear.view(batch_size, -1)
+        hidden = hidden.index_select(0, rows).unsqueeze(-1)
+        bilinear = torch.bmm(projected_embeddings, hidden).squeeze(-1)
 
         # Second half of equation 4.
-        distance_score = torch.exp(self._distance_scalar * self.last_seen[mask].float())
+        distance_score = torch.exp(self._distance_scalar * self.last_seen.index_select(0, rows).float())
         logits = bilinear + distance_score
 
         # Since we pre-allocate the embedding array, logits includes scores for all of the
-        # embeddings which have not yet been initialized. We create a mask to indicate which scores
-        # should be used for prediction / loss calculation.
-        num_embeddings = self.num_embeddings[mask].unsqueeze(1)
-        arange = torch.arange(self._max_embeddings, device=num_embeddings.device).repeat(mask.sum(), 1)
-        logit_mask = arange.lt(num_embeddings)
-        logits[logit_mask != 1] = -float('inf')
+        # slots which are not in use. We create a mask to indicate which scores should be used
+        # for prediction / loss calculation.
+        logit_mask = self.slot_ids.index_select(0, rows).ge(0)
+        logits = logits.masked_fill(~logit_mask, -float('inf'))
 
         out = {
                 'logits': logits,
@@ -211,8 +272,108 @@ class DynamicEmbedding(Module):
         }
 
         if target is not None:
-            target = target[mask]
+            target = self.slots(target).index_select(0, rows)
             loss = F.cross_entropy(logits, target, reduction='none')
             out['loss'] = loss
 
         return out
+
+
+def fused_add_and_update(embeddings: torch.Tensor,
+                         num_embeddings: torch.Tensor,
+                         last_seen: torch.Tensor,
+                         slot_ids: torch.Tensor,
+                         last_used: torch.Tensor,
+                         hidden: torch.Tensor,
+                         noise: torch.Tensor,
+                         initial_embedding: torch.Tensor,
+                         delta_weight: torch.Tensor,
+                         entity_types: torch.Tensor,
+                         entity_ids: torch.Tensor,
+                         timestep: torch.Tensor,
+                         clock: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+    """
+    Adds new entities and updates the embeddings of the mentioned entities, in the same way as
+    calling ``DynamicEmbedding.add_embeddings`` followed by ``update_embeddings``.
+
+    Unlike those methods every batch element is processed, and the results are only kept where
+    needed (using ``torch.where``). Since there is no masked indexing or branching on the values
+    of tensors, all of the shapes are static (so the function can be compiled using
+    ``torch.jit.trace``) and no synchronization with the host is required.
+
+    Parameters
+    ----------
+    embeddings, num_embeddings, last_seen, slot_ids : ``torch.Tensor``
+        The state of a ``DynamicEmbedding`` module.
+    last_used : ``torch.LongTensor``
+        A tensor of shape ``(batch_size, max_embeddings)`` containing the value of ``clock``
+        when each slot was last used (used to pick slots to evict).
+    hidden : ``torch.Tensor``
+        A tensor of shape ``(batch_size, embedding_dim)`` containing the current hidden states.
+    noise : ``torch.Tensor``
+        A tensor of shape ``(batch_size, embedding_dim)`` added to the initial embedding of new
+        entities.
+    initial_embedding, delta_weight : ``torch.Tensor``
+        The initial embedding and the weight of the delta projection of the module.
+    entity_types, entity_ids : ``torch.Tensor``
+        Tensors of shape ``(batch_size,)`` containing the current entity types and ids.
+    timestep : ``torch.Tensor``
+        A 0-dimensional tensor containing the current timestep.
+    clock : ``torch.Tensor``
+        A 0-dimensional tensor containing the current value of the module's eviction counter.
+
+    Returns
+    -------
+    The updated state ``(embeddings, num_embeddings, last_seen, slot_ids, last_used)``.
+    """
+    batch_size, max_embeddings, embedding_dim = embeddings.shape
+    slots = torch.arange(max_embeddings, dtype=torch.int64, device=embeddings.device).unsqueeze(0)
+    entity_types = entity_types.byte()
+
+    # Add new entities, as well as mentioned entities which have been evicted (see
+    # ``DynamicEmbedding._allocate``).
+    new_entities = entity_ids.eq(num_embeddings)
+    allocate = new_entities | (entity_types & ~slot_ids.eq(entity_ids.unsqueeze(1)).any(dim=1))
+    num_occupied = slot_ids.ge(0).long().sum(dim=1)
+    least_recently_used = last_used[:, 1:].argmin(dim=1) + 1
+    allocated_slots = torch.where(num_occupied.lt(max_embeddings), num_occupied, least_recently_used)
+    add_slot = slots.eq(allocated_slots.unsqueeze(1)) & allocate.unsqueeze(1)
+    initial = F.normalize(initial_embedding.unsqueeze(0) + noise, dim=-1)
+    embeddings = torch.where(add_slot.unsqueeze(-1),
+                             initial.unsqueeze(1).expand_as(embeddings),
+                             embeddings)
+    last_seen = last_seen.masked_fill(add_slot, timestep)
+    last_used = last_used.masked_fill(add_slot, clock)
+    slot_ids = torch.where(add_slot, entity_ids.unsqueeze(1).expand_as(slot_ids), slot_ids)
+    num_embeddings = num_embeddings + new_entities.long()
+
+    # Update the mentioned entities (see ``DynamicEmbedding.update_embeddings``).
+    current_slots = DynamicEmbedding._find_slots(slot_ids, entity_ids)  # pylint: disable=protected-access
+    gather_index = current_slots.view(batch_size, 1, 1).expand(batch_size, 1, embedding_dim)
+    current_embeddings = embeddings.gather(1, gather_index).squeeze(1)
+    score = (hidden * F.linear(current_embeddings, delta_weight)).sum(-1, keepdim=True)
+    delta = torch.sigmoid(score)
+    updated = F.normalize(delta * current_embeddings + (1 - delta) * hidden, dim=-1)
+    update_slot = slots.eq(current_slots.unsqueeze(1)) & entity_types.unsqueeze(1)
+    embeddings = torch.where(update_slot.unsqueeze(-1),
+                             updated.unsqueeze(1).expand_as(embeddings),
+                             embeddings)
+    last_seen = last_seen.masked_fill(update_slot, timestep)
+    last_used = last_used.masked_fill(update_slot, clock)
+
+    return embeddings, num_embeddings, last_seen, slot_ids, last_used
+
+
+def fused_entity_logits(embeddings: torch.Tensor,
+                        last_seen: torch.Tensor,
+                        slot_ids: torch.Tensor,
+                        projected_hidden: torch.Tensor,
+                        distance_scalar: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the same logits as ``DynamicEmbedding.forward`` for every batch element, given the
+    hidden states projected by the transpose of the module's embedding projection (which is
+    cheaper than projecting every embedding). Unused slots have logits of ``-inf``.
+    """
+    bilinear = torch.bmm(embeddings, projected_hidden.unsqueeze(-1)).squeeze(-1)
+    logits = bilinear + torch.exp(distance_scalar * last_seen.float())
+    return logits.masked_fill(slot_ids.lt(0), -float('inf'))
@@ -0,0 +1,276 @@
+import logging
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+
+class EntityIndex:
+    """
+    An inverted file (IVF) index for approximate maximum inner product search over a fixed set of
+    entity embeddings.
+
+    Embeddings are clustered using k-means. At query time only the entities in the ``num_probes``
+    clusters whose centroids have the largest inner product with the query are scored, so the
+    returned top-k candidates should be re-scored using the exact model scores.
+
+    The entities in each cluster are stored contiguously (in the same fashion as the edges in
+    ``KnowledgeGraphLookup``), with ``offsets[c]:offsets[c + 1]`` giving the slice belonging to
+    cluster ``c``.
+
+    Parameters
+    ----------
+    centroids : ``torch.Tensor``
+        A tensor of shape ``(num_clusters, embedding_dim)`` containing the cluster centroids.
+    offsets : ``torch.LongTensor``
+        A tensor of shape ``(num_clusters + 1,)`` containing the start of each cluster.
+    entity_ids : ``torch.LongTensor``
+        A tensor of shape ``(num_entities,)`` containing the entity ids, sorted by cluster.
+    vectors : ``torch.Tensor``
+        A tensor of shape ``(num_entities, embedding_dim)`` containing the entity embeddings, sorted
+        by cluster.
+    """
+    def __init__(self,
+                 centroids: torch.Tensor,
+                 offsets: torch.LongTensor,
+                 entity_ids: torch.LongTensor,
+                 vectors: torch.Tensor) -> None:
+        self._centroids = centroids
+        self._offsets = offsets
+        self._entity_ids = entity_ids
+        self._vectors = vectors
+
+        # To score the clusters in a batch we lay them out as a padded tensor of shape
+        # ``(num_clusters, max_cluster_size)`` containing positions in ``_vectors``.
+        sizes = offsets[1:] - offsets[:-1]
+        max_cluster_size = int(sizes.max()) if sizes.numel() > 0 else 0
+        steps = torch.arange(max_cluster_size, dtype=torch.int64)
+        self._cluster_mask = steps.unsqueeze(0) < sizes.unsqueeze(1)
+        self._cluster_positions = (offsets[:-1].unsqueeze(1) + steps.unsqueeze(0)) * self._cluster_mask.long()
+
+    @property
+    def num_clusters(self) -> int:
+        return self._centroids.shape[0]
+
+    @property
+    def embedding_dim(self) -> int:
+        return self._centroids.shape[1]
+
+    @classmethod
+    def build(cls,
+              embeddings: torch.Tensor,
+              num_clusters: int,
+              num_iterations: int = 10,
+              ignore_padding: bool = True,
+              seed: int = 13370) -> 'EntityIndex':
+        """
+        Builds an index by clustering the given embeddings with k-means.
+
+        Parameters
+        ----------
+        embeddings : ``torch.Tensor``
+            A tensor of shape ``(num_entities, embedding_dim)``. The row index is the entity id.
+        num_clusters : ``int``
+            The number of clusters.
+        num_iterations : ``int``, optional (default=10)
+            The number of k-means iterations.
+        ignore_padding : ``bool``, optional (default=True)
+            Whether to leave the padding entity (id 0) out of the index.
+        seed : ``int``, optional (default=13370)
+            Random seed used to initialize the centroids.
+        """
+        embeddings = embeddings.detach().cpu().float()
+        start = 1 if ignore_padding else 0
+        entity_ids = torch.arange(start, embeddings.shape[0], dtype=torch.int64)
+        vectors = embeddings[start:]
+        num_clusters = min(num_clusters, vectors.shape[0])
+
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        initial = torch.randperm(vectors.shape[0], generator=generator)[:num_clusters]
+        centroids = vectors[initial].clone()
+        for _ in range(num_iterations):
+            assignments = cls._assign(vectors, centroids)
+            counts = torch.zeros(num_clusters).index_add_(0, assignments, torch.ones(vectors.shape[0]))
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+            # Empty clusters keep their previous centroid.
+            nonempty = counts.gt(0)
+            centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+        assignments = cls._assign(vectors, centroids)
+
+        order = assignments.argsort()
+        counts = torch.zeros(num_clusters, dtype=torch.int64).index_add_(
+            0, assignments, torch.ones_like(assignments))
+        offsets = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+        return cls(centroids, offsets, entity_ids[order], vectors[order])
+
+    @staticmethod
+    def _assign(vectors: torch.Tensor, centroids: torch.Tensor) -> torch.LongTensor:
+        # Squared euclidean distances, dropping the (constant) norm of each vector.
+        distances = centroids.pow(2).sum(-1).unsqueeze(0) - 2 * vectors.mm(centroids.t())
+        return distances.argmin(dim=-1)
+
+    def search(self,
+               queries: torch.Tensor,
+               k: int,
+               num_probes: int = 1) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        Finds (approximately) the ``k`` entities whose embeddings have the largest inner product
+        with each query.
+
+        Parameters
+        ----------
+        queries : ``torch.Tensor``
+            A tensor of shape ``(num_queries, embedding_dim)``.
+        k : ``int``
+            The number of candidates to return.
+        num_probes : ``int``, optional (default=1)
+            The number of clusters to search. Searching all of the clusters is exact.
+
+        Returns
+        -------
+        A tuple ``(scores, entity_ids)`` of tensors of shape ``(num_queries, k)``. If fewer than
+        ``k`` entities are found, the remaining entity ids are 0 and their scores are ``-inf``.
+        """
+        device = queries.device
+        self._to(device)
+        num_probes = min(num_probes, self.num_clusters)
+
+        # shape: (num_queries, num_probes)
+        _, probes = queries.mm(self._centroids.t()).topk(num_probes, dim=-1)
+
+        # shape: (num_queries, num_probes * max_cluster_size)
+        positions = self._cluster_positions[probes].view(queries.shape[0], -1)
+        mask = self._cluster_mask[probes].view(queries.shape[0], -1)
+
+        # shape: (num_queries, num_probes * max_cluster_size)
+        candidates = self._vectors[positions]
+        scores = torch.bmm(candidates, queries.unsqueeze(-1)).squeeze(-1)
+        scores = scores.masked_fill(~mask, -float('inf'))
+
+        k = min(k, scores.shape[-1])
+        top_scores, top_inds = scores.topk(k, dim=-1)
+        top_ids = self._entity_ids[positions.gather(1, top_inds)]
+        top_ids = top_ids.masked_fill(~mask.gather(1, top_inds), 0)
+        return top_scores, top_ids
+
+    def _to(self, device: torch.device) -> None:
+        if self._centroids.device != device:
+            self._centroids = self._centroids.to(device)
+            self._entity_ids = self._entity_ids.to(device)
+            self._vectors = self._vectors.to(device)
+            self._cluster_mask = self._cluster_mask.to(device)
+            self._cluster_positions = self._cluster_positions.to(device)
+
+    def save(self, path: str) -> None:
+        np.savez(path,
+                 centroids=self._centroids.cpu().numpy(),
+                 offsets=self._offsets.cpu().numpy(),
+                 entity_ids=self._entity_ids.cpu().numpy(),
+                 vectors=self._vectors.cpu().numpy())
+
+    @classmethod
+    def load(cls, path: str) -> 'EntityIndex':
+        logger.info('Loading entity index from: %s', path)
+        with np.load(path) as data:
+            return cls(centroids=torch.from_numpy(data['centroids']),
+                       offsets=torch.from_numpy(data['offsets']),
+                       entity_ids=torch.from_numpy(data['entity_ids']),
+                       vectors=torch.from_numpy(data['vectors']))
+
+
+def entity_logit_vectors(weight: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+    """
+    Appends the bias of a linear layer scoring entities to its weights. Since ``w . x + b`` is
+    the inner product of ``[w, b]`` and ``[x, 1]``, an index built over these vectors retrieves
+    entities by their exact logits (see ``top_k_entities``).
+    """
+    return torch.cat((weight, bias.unsqueeze(-1)), dim=-1)
+
+
+def top_k_entities(encoded: torch.Tensor,
+                   weight: torch.Tensor,
+                   bias: torch.Tensor,
+                   k: int,
+                   entity_index: EntityIndex = None,
+                   num_probes: int = 1) -> Tuple[torch.Tensor, torch.LongTensor]:
+    """
+    Finds the ``k`` entities with the highest logits ``encoded . weight + bias``, never including
+    the padding entity. If an index (built over ``entity_logit_vectors``) is given, candidates are
+    retrieved from it and then re-scored exactly, otherwise every entity is scored.
+
+    Parameters
+    ----------
+    encoded : ``torch.Tensor``
+        A tensor of shape ``(*, embedding_dim)`` containing the queries.
+    weight : ``torch.Tensor``
+        A tensor of shape ``(num_entities, embedding_dim)``.
+    bias : ``torch.Tensor``
+        A tensor of shape ``(num_entities,)``.
+    k : ``int``
+        The number of candidates.
+    entity_index : ``EntityIndex``, optional (default=None)
+        The index used to retrieve candidates.
+    num_probes : ``int``, optional (default=1)
+        The number of index clusters searched for candidates.
+
+    Returns
+    -------
+    A tuple ``(logits, entity_ids)`` of tensors of shape ``(*, k)``, sorted by decreasing logit.
+    """
+    leading_shape = encoded.shape[:-1]
+    flat_encoded = encoded.contiguous().view(-1, encoded.shape[-1])
+    if entity_index is None:
+        logits = F.linear(flat_encoded, weight, bias)
+        # The padding entity is never a valid prediction.
+        logits[:, 0] = -float('inf')
+        logits, entity_ids = logits.topk(k, dim=-1)
+    else:
+        queries = torch.cat((flat_encoded, flat_encoded.new_ones(flat_encoded.shape[0], 1)), dim=-1)
+        _, entity_ids = entity_index.search(queries, k, num_probes)
+        # Re-score the candidates using the current parameters.
+        logits = torch.bmm(weight[entity_ids], flat_encoded.unsqueeze(-1)).squeeze(-1)
+        logits = logits + bias[entity_ids]
+        logits = logits.masked_fill(entity_ids.eq(0), -float('inf'))
+        logits, order = logits.sort(dim=-1, descending=True)
+        entity_ids = entity_ids.gather(1, order)
+    return logits.view(*leading_shape, -1), entity_ids.view(*leading_shape, -1)
+
+
+def benchmark_entity_index(index: EntityIndex,
+                           embeddings: torch.Tensor,
+                           queries: torch.Tensor,
+                           k: int,
+                           num_probes: int) -> Dict[str, float]:
+    """
+    Compares the top-k entities retrieved by the index to those found by exhaustively scoring all
+    of the embeddings.
+
+    Returns
+    -------
+    A dictionary containing the recall@k of the index, as well as the per-query latency (in
+    milliseconds) of both the index and exhaustive search.
+    """
+    embeddings = embeddings.to(queries.device)
+
+    start = time.perf_counter()
+    exact_scores = queries.mm(embeddings.t())
+    # The padding entity is never a valid prediction.
+    exact_scores[:, 0] = -float('inf')
+    _, exact_ids = exact_scores.topk(k, dim=-1)
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, approximate_ids = index.search(queries, k, num_probes)
+    index_time = time.perf_counter() - start
+
+    hits = approximate_ids.unsqueeze(-1).eq(exact_ids.unsqueeze(1)).any(dim=1)
+    return {
+            'recall': hits.float().mean().item(),
+            'exact_latency_ms': 1000 * exact_time / queries.shape[0],
+            'index_latency_ms': 1000 * index_time / queries.shape[0]
+    }
@@ -1,58 +1,123 @@
+import hashlib
 import logging
+import os
 import pickle
 from typing import List, Tuple
 
 from allennlp.data.vocabulary import Vocabulary
+import numpy as np
 from tqdm import tqdm
 import torch
 
-from kglm.nn.util import nested_enumerate
-
 logger = logging.getLogger(__name__)
 
 
 class KnowledgeGraphLookup:
+    """
+    Stores the edges of a knowledge graph in compressed sparse row (CSR) format. The outgoing
+    edges of the entity with id ``i`` (in the ``entity_ids`` namespace) are given by the slice
+    ``offsets[i]:offsets[i+1]`` of the flat ``relations`` and ``tail_ids`` tensors.
+
+    Since loading and indexing the knowledge graph is slow, the indexed edges can be cached in a
+    ``.npz`` file in a cache directory. The name of the cache file contains a hash of the contents
+    of the knowledge graph and of the vocabulary namespaces used to index the edges, so a cache is
+    only ever reused with the knowledge graph and vocabulary it was created with.
+
+    Parameters
+    ----------
+    knowledge_graph_path : ``str``
+        Path to a pickled dictionary mapping entity ids to lists of ``(relation, tail_id)``
+        pairs.
+    vocab : ``Vocabulary``
+        The vocabulary used to index the entities and relations.
+    cache_directory : ``str``, optional (default=None)
+        If given, the directory in which the indexed edges are cached. Otherwise the edges are
+        not cached.
+    """
     def __init__(self,
                  knowledge_graph_path: str,
-                 vocab: Vocabulary) -> None:
-        self._knowledge_graph_path = knowledge_graph_path
+                 vocab: Vocabulary,
+                 cache_directory: str = None) -> None:
+        self._knowledge_graph_path = str(knowledge_graph_path)
         self._vocab = vocab
-        self._relations, self._tail_ids = self.load_edges(knowledge_graph_path)
+        self._cache_directory = cache_directory
+        if cache_directory is not None:
+            edges = self.load_cached_edges(self._knowledge_graph_path)
+        else:
+            edges = self.load_edges(self._knowledge_graph_path)
+        self._offsets, self._relations, self._tail_ids = edges
+
+    def cache_path(self, knowledge_graph_path: str) -> str:
+        """
+        Returns the path (in the cache directory) of the cache of indexed edges for the given
+        knowledge graph and the current vocabulary.
+        """
+        md5 = hashlib.md5()
+        with open(knowledge_graph_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        for namespace in ('entity_ids', 'relations', 'raw_entity_ids'):
+            md5.update(namespace.encode('utf-8'))
+            index_to_token = self._vocab.get_index_to_token_vocabulary(namespace)
+            for i in range(len(index_to_token)):
+                md5.update(b'\0' + index_to_token[i].encode('utf-8'))
+        filename = '%s.%s.npz' % (os.path.basename(knowledge_graph_path), md5.hexdigest())
+        return os.path.join(self._cache_directory, filename)
 
-    def load_edges(self, knowledge_graph_path: str) -> Tuple[List[torch.LongTensor], List[torch.LongTensor]]:
+    def load_cached_edges(self,
+                          knowledge_graph_path: str) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]:
+        """
+        Same as ``load_edges``, except that the indexed edges are read from the cache if it exists.
+        Otherwise the cache is created.
+        """
+        cache_path = self.cache_path(knowledge_graph_path)
+        if os.path.exists(cache_path):
+            logger.info('Loading indexed knowledge graph from: %s', cache_path)
+            with np.load(cache_path) as cache:
+                return tuple(torch.from_numpy(cache[key]) for key in ('offsets', 'relations', 'tail_ids'))
+
+        offsets, relations, tail_ids = self.load_edges(knowledge_graph_path)
+        logger.info('Caching indexed knowledge graph to: %s', cache_path)
+        try:
+            # Write to a temporary file first so that concurrent processes never read a partially
+            # written cache.
+            os.makedirs(self._cache_directory, exist_ok=True)
+            temp_path = '%s.%i.tmp.npz' % (cache_path[:-len('.npz')], os.getpid())
+            np.savez(temp_path,
+                     offsets=offsets.numpy(),
+                     relations=relations.numpy(),
+                     tail_ids=tail_ids.numpy())
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            logger.warning('Could not cache indexed knowledge graph: %s', error)
+        return offsets, relations, tail_ids
+
+    def load_edges(self,
+                   knowledge_graph_path: str) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]:
         logger.info('Loading knowledge graph from: %s', knowledge_graph_path)
         with open(knowledge_graph_path, 'rb') as f:
             knowledge_graph = pickle.load(f)
 
         entity_idx_to_token = self._vocab.get_index_to_token_vocabulary('entity_ids')
-        all_relations: List[torch.Tensor] = []
-        all_tail_ids: List[torch.Tensor] = []
-        for i in tqdm(range(len(entity_idx_to_token))):
+        num_entities = len(entity_idx_to_token)
+        offsets = np.zeros(num_entities + 1, dtype=np.int64)
+        all_relations: List[int] = []
+        all_tail_ids: List[int] = []
+        for i in tqdm(range(num_entities)):
             entity_id = entity_idx_to_token[i]
-            try:
-                edges = knowledge_graph[entity_id]
-            except KeyError:
-                relations = None
-                tail_ids = None
-            else:
-                if edges == []:
-                    relations = None
-                    tail_ids = None
-                else:
-                    # Get the relation and tail id tokens
-                    relation_tokens, tail_id_tokens = zip(*knowledge_graph[entity_id])
-                    # Index tokens
-                    relations = [self._vocab.get_token_index(t, 'relations') for t in relation_tokens]
-                    tail_ids = [self._vocab.get_token_index(t, 'raw_entity_ids') for t in tail_id_tokens]
-                    # Convert to tensors
-                    relations = torch.LongTensor(relations)
-                    tail_ids = torch.LongTensor(tail_ids)
-            all_relations.append(relations)
-            all_tail_ids.append(tail_ids)
-        return all_relations, all_tail_ids
+            edges = knowledge_graph.get(entity_id, [])
+            for relation, tail_id in edges:
+                all_relations.append(self._vocab.get_token_index(relation, 'relations'))
+                all_tail_ids.append(self._vocab.get_token_index(tail_id, 'raw_entity_ids'))
+            offsets[i + 1] = len(all_relations)
+
+        offsets = torch.from_numpy(offsets)
+        relations = torch.from_numpy(np.array(all_relations, dtype=np.int64))
+        tail_ids = torch.from_numpy(np.array(all_tail_ids, dtype=np.int64))
+        return offsets, relations, tail_ids
 
     def __call__(self,
-                 parent_ids: torch.LongTensor) -> torch.Tensor:
+                 parent_ids: torch.LongTensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Returns all relations of the form:
 
             (parent_id, relation, tail_id)
@@ -67,30 +132,46 @@ class KnowledgeGraphLookup:
 
         Returns
         -------
-        A tuple `(relations, tail_ids)` containing the following elements:
+        A tuple `(relations, tail_ids, mask)` containing the following elements:
         relations : ``torch.LongTensor``
             A tensor of shape `(N, *, K)` corresponding to the input shape, with an
             additional dimension whose size `K` is the largest number of relations to
             a parent in the input. Each element is a relation id.
         tail_ids : ``torch.LongTensor``
             A tensor of shape `(N, *, K)` containing the corresponding tail ids.
+        mask : ``torch.Tensor``
+            A tensor of shape `(N, *, K)` indicating which elements of ``relations`` and
+            ``tail_ids`` are actual edges (as opposed to padding).
         """
-        # Collect the information to load into the output tensors.
-        indices: List[Tuple[int, ...]] = []
-        parent_ids_list: List[torch.LongTensor] = []
-        relations_list: List[torch.LongTensor] = []
-        tail_ids_list: List[torch.LongTensor] = []
-        for *inds, parent_id in nested_enumerate(parent_ids):
-            # Retrieve data
-            relations = self._relations[parent_id]
-            tail_ids = self._tail_ids[parent_id]
-            if relations is None:
-                continue
-            # Add to lists
-            indices.append(tuple(inds))
-            parent_ids_list.append(parent_id)
-            relations_list.append(relations.to(device=parent_ids.device))
-            tail_ids_list.append(tail_ids.to(device=parent_ids.device))
-
-        return indices, parent_ids_list, relations_list, tail_ids_list
+        # The edge tensors are moved to the device of the inputs the first time they are used
+        # there, and kept there afterwards to avoid copying them on every call.
+        if self._offsets.device != parent_ids.device:
+            self._offsets = self._offsets.to(parent_ids.device)
+            self._relations = self._relations.to(parent_ids.device)
+            self._tail_ids = self._tail_ids.to(parent_ids.device)
+
+        # Lookup the start and end of each parent's slice of the edge tensors.
+        flattened = parent_ids.contiguous().view(-1)
+        starts = self._offsets.index_select(0, flattened)
+        ends = self._offsets.index_select(0, flattened + 1)
+        num_edges = ends - starts
+
+        if flattened.numel() > 0:
+            max_num_edges = int(num_edges.max())
+        else:
+            max_num_edges = 0
+        output_shape = (*parent_ids.shape, max_num_edges)
+
+        # Gather the edges of every parent at once. Positions beyond a parent's last edge are
+        # pointed at the first edge and then masked out. If no parent has any edges, then every
+        # output is empty (but the mask still has the same type).
+        arange = torch.arange(max_num_edges, dtype=torch.int64, device=parent_ids.device)
+        mask = arange.unsqueeze(0) < num_edges.unsqueeze(1)
+        positions = (starts.unsqueeze(1) + arange.unsqueeze(0)) * mask.long()
+        positions = positions.view(-1)
+        relations = self._relations.index_select(0, positions).view(flattened.shape[0], max_num_edges)
+        tail_ids = self._tail_ids.index_select(0, positions).view(flattened.shape[0], max_num_edges)
+        relations = relations * mask.long()
+        tail_ids = tail_ids * mask.long()
 
+        return relations.view(output_shape), tail_ids.view(output_shape), mask.view(output_shape)
@@ -1,16 +1,16 @@
-from typing import Dict, List, Tuple
+from typing import Tuple
 
-from allennlp.modules.token_embedders import TokenEmbedder
-from overrides import overrides
 import torch
 
-from kglm.nn.util import nested_enumerate
-
 
 class RecentEntities:
     """
     Module for tracking a dynamically changing list of entities.
 
+    The state is stored entirely in tensors (on the same device as the inputs): a buffer of
+    entity ids which are still recent at the end of the last split, along with the timestep each
+    was last seen at (relative to the start of the next split, so these are always negative).
+
     Parameters
     ----------
     cutoff : ``int``
@@ -19,7 +19,8 @@ class RecentEntities:
     def __init__(self,
                  cutoff: int) -> None:
         self._cutoff = cutoff
-        self._remaining: List[Dict[int, int]] = []
+        self._remaining_ids: torch.LongTensor = None
+        self._last_seen: torch.LongTensor = None
 
     def __call__(self,
                  entity_ids: torch.LongTensor) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -29,7 +30,7 @@ class RecentEntities:
         Parameters
         ----------
         entity_ids : ``torch.LongTensor``
-            A tensor of shape ``(batch_size, sequence_length)`` whose elements are the ids
+            A tensor of shape ``(batch_size, sequence_length, *)`` whose elements are the ids
             of the corresponding token in the ``target`` sequence.
 
         Returns
@@ -43,44 +44,66 @@ class RecentEntities:
             subset of candidates can be selected at the given point in the sequence.
         """
         batch_size, sequence_length = entity_ids.shape[:2]
+        self._to(entity_ids.device)
 
-        # TODO: See if we can get away without nested loops / cast to CPU.
+        # shape: (batch_size, n_candidates)
         candidate_ids = self._get_candidates(entity_ids)
-        candidate_lookup = [{parent_id: j for j, parent_id in enumerate(l)} for l in candidate_ids.tolist()]
-
-        # Create mask
-        candidate_mask = entity_ids.new_zeros(size=(batch_size, sequence_length, candidate_ids.shape[-1]),
-                                              dtype=torch.uint8)
-
-        # Start by accounting for unfinished masks that remain from the last batch
-        for i, lookup in enumerate(self._remaining):
-            for parent_id, remainder in lookup.items():
-                # Find index w.r.t. the **current** set of candidates
-                k = candidate_lookup[i][parent_id]
-                # Fill in the remaining amount of mask
-                candidate_mask[i, :remainder, k] = 1
-                # If splits are really short, then we might still have some remaining
-                lookup[parent_id] -= sequence_length
-
-        # Cast to list so we can use elements as keys (not possible for tensors)
-        parent_id_list = entity_ids.tolist()
-        for i, j, *_, parent_id in nested_enumerate(parent_id_list):
-            if parent_id == 0:
-                continue
-            else:
-                # Fill in mask
-                k = candidate_lookup[i][parent_id]
-                candidate_mask[i, j + 1:j + self._cutoff + 1, k] = 1
-                # Track how many sequence elements remain
-                remainder = sequence_length - (j + self._cutoff + 1)
-                self._remaining[i][parent_id] = (j + self._cutoff + 1) - sequence_length
-
-        # Remove any ids for non-recent parents (e.g. those without remaining mask)
-        for i, lookup in enumerate(self._remaining):
-            self._remaining[i] = {key: value for key, value in lookup.items() if value > 0}
+        non_null = ~candidate_ids.eq(0)
+
+        # Find where each candidate is mentioned in the current sequence.
+        # shape: (batch_size, sequence_length, n_candidates)
+        _entity_ids = entity_ids.view(batch_size, sequence_length, -1, 1)
+        _candidate_ids = candidate_ids.view(batch_size, 1, 1, -1)
+        occurs = _entity_ids.eq(_candidate_ids).any(dim=2) & non_null.unsqueeze(1)
+
+        # A candidate is recent at timestep t if it was mentioned at any of the timesteps
+        # [t - cutoff, t - 1]. Counting the mentions in this window can be done by taking
+        # differences of the cumulative sum.
+        # shape: (batch_size, sequence_length + 1, n_candidates)
+        cumulative = torch.cat((occurs.new_zeros(batch_size, 1, occurs.shape[-1]).long(),
+                                occurs.long().cumsum(dim=1)), dim=1)
+        timesteps = torch.arange(sequence_length, dtype=torch.int64, device=entity_ids.device)
+        window_start = (timesteps - self._cutoff).clamp(min=0)
+        num_recent_mentions = cumulative[:, :-1] - cumulative.index_select(1, window_start)
+        candidate_mask = num_recent_mentions.gt(0)
+
+        # Account for unfinished masks that remain from the last split. We start by aligning the
+        # last seen timesteps with the **current** set of candidates (candidates which are not
+        # carried over are treated as if they were seen too long ago to be recent).
+        # shape: (batch_size, n_candidates, n_remaining)
+        is_remaining = candidate_ids.unsqueeze(-1).eq(self._remaining_ids.unsqueeze(1))
+        is_remaining = is_remaining & ~self._remaining_ids.eq(0).unsqueeze(1)
+        # shape: (batch_size, n_candidates)
+        previous_last_seen = (is_remaining.long() * self._last_seen.unsqueeze(1)).sum(dim=-1)
+        previous_last_seen = previous_last_seen.masked_fill(~is_remaining.any(dim=-1), -self._cutoff - 1)
+        carried_over = timesteps.view(1, -1, 1) <= (previous_last_seen + self._cutoff).unsqueeze(1)
+        candidate_mask = candidate_mask | carried_over
+
+        # Lastly, update the last seen timesteps and only keep the ids of parents which will still
+        # be recent at the start of the next split.
+        # shape: (batch_size, n_candidates)
+        last_occurence, _ = (occurs.long() * (timesteps + 1).view(1, -1, 1)).max(dim=1)
+        last_seen = torch.where(last_occurence.gt(0), last_occurence - 1, previous_last_seen)
+        last_seen = last_seen - sequence_length
+        still_recent = last_seen.ge(-self._cutoff) & non_null
+        self._remaining_ids = candidate_ids * still_recent.long()
+        self._last_seen = last_seen * still_recent.long()
 
         return candidate_ids, candidate_mask
 
+    def current(self) -> Tuple[torch.LongTensor, torch.ByteTensor]:
+        """
+        Returns the entities which are recent at the start of the next split (i.e. the parent
+        candidates of its first token), without updating the state. Used when generating one
+        token at a time, since the candidates are needed before the entity of the token is known.
+
+        Returns
+        -------
+        A tuple ``(candidate_ids, candidate_mask)`` of tensors with shape ``(batch_size,
+        n_candidates)``.
+        """
+        return self._remaining_ids, ~self._remaining_ids.eq(0)
+
     # pylint: disable=redefined-builtin
     def _get_candidates(self,
                         entity_ids: torch.LongTensor) -> torch.LongTensor:
@@ -91,7 +114,7 @@ class RecentEntities:
         Parameters
         ----------
         entity_ids : ``torch.LongTensor``
-            A tensor of shape ``(batch_size, sequence_length)`` whose elements are the ids
+            A tensor of shape ``(batch_size, sequence_length, *)`` whose elements are the ids
             of the corresponding token in the ``target`` sequence.
 
         Returns
@@ -100,25 +123,32 @@ class RecentEntities:
             A tensor of shape ``(batch_size, max_num_parents)`` containing all of the unique
             candidate ids.
         """
-        # Get the tensors of unique ids for each batch element and store them in a list
-        all_unique: List[torch.LongTensor] = []
-        for i, ids in enumerate(entity_ids):
-            if self._remaining[i] is not None:
-                previous_ids = list(self._remaining[i].keys())
-                previous_ids = entity_ids.new_tensor(previous_ids)
-                ids = torch.cat((ids.view(-1), previous_ids), dim=0)
-            unique = torch.unique(ids, sorted=True)
-            all_unique.append(unique)
-
-        # Convert the list to a tensor by adding adequete padding.
         batch_size = entity_ids.shape[0]
-        max_num_parents = max(unique.shape[0] for unique in all_unique)
+        self._to(entity_ids.device)
+
+        # Sort all of the ids observed by each batch element, so that duplicates are adjacent.
+        all_ids = torch.cat((entity_ids.view(batch_size, -1), self._remaining_ids), dim=1)
+        sorted_ids, _ = all_ids.sort(dim=1)
+
+        # The position of each id in the output is the number of distinct ids that precede it.
+        # Duplicates are assigned to the same position (and have the same value) so the scatter
+        # below is well-defined.
+        is_first = torch.ones_like(sorted_ids, dtype=torch.uint8)
+        is_first[:, 1:] = ~sorted_ids[:, 1:].eq(sorted_ids[:, :-1])
+        positions = is_first.long().cumsum(dim=1) - 1
+
+        # Convert to a tensor with adequete padding.
+        max_num_parents = int(positions[:, -1].max()) + 1 if positions.numel() > 0 else 0
         unique_entity_ids = entity_ids.new_zeros(size=(batch_size, max_num_parents))
-        for i, unique in enumerate(all_unique):
-            unique_entity_ids[i, :unique.shape[0]] = unique
+        unique_entity_ids.scatter_(1, positions, sorted_ids)
 
         return unique_entity_ids
 
+    def _to(self, device: torch.device) -> None:
+        if self._remaining_ids.device != device:
+            self._remaining_ids = self._remaining_ids.to(device)
+            self._last_seen = self._last_seen.to(device)
+
     def reset(self, reset: torch.ByteTensor) -> None:
         """
         Parameters
@@ -127,19 +157,23 @@ class RecentEntities:
             A tensor of shape ``(batch_size,)`` indicating whether the state (e.g. list of
             previously seen entities) for the corresponding batch element should be reset.
         """
-        if (len(reset) != len(self._remaining)) and not reset.all():
+        batch_size = reset.shape[0]
+        if self._remaining_ids is None:
+            current_batch_size = 0
+        else:
+            current_batch_size = self._remaining_ids.shape[0]
+        if (batch_size != current_batch_size) and not reset.all():
             raise RuntimeError('Changing the batch size without resetting all internal states is '
                                'undefined.')
 
         # If everything is being reset, then we treat as if the Module has just been initialized.
         # This simplifies the case where the batch_size has been
         if reset.all():
-            batch_size = reset.shape[0]
-            self._remaining = [dict() for _ in range(batch_size)]
+            self._remaining_ids = torch.zeros(batch_size, 0, dtype=torch.int64, device=reset.device)
+            self._last_seen = torch.zeros(batch_size, 0, dtype=torch.int64, device=reset.device)
 
         # Otherwise only reset the internal state for the indicated batch elements
         else:
-            for i, should_reset in enumerate(reset):
-                if should_reset:
-                    self._remaining[i] = {}
-
+            reset = reset.unsqueeze(-1).to(self._remaining_ids.device)
+            self._remaining_ids = self._remaining_ids.masked_fill(reset, 0)
+            self._last_seen = self._last_seen.masked_fill(reset, 0)
@@ -2,6 +2,7 @@ from collections import defaultdict
 
 import torch
 import torch.nn as nn
+from allennlp.nn.util import masked_log_softmax
 
 import numpy as np
 
@@ -169,3 +170,82 @@ class SplitCrossEntropyLoss(nn.Module):
             total_loss = entropy.float().sum() if total_loss is None else total_loss + entropy.float().sum()
 
         return total_loss
+
+    def mixture_log_probs(self, weight, bias, hiddens, targets, extra_scores, extra_mask):
+        r'''Computes the log probabilities of the targets, along with the log probabilities of a set
+        of extra (e.g. copy) scores which are normalized jointly with the split softmax.
+
+        The extra scores are placed in the head softmax alongside the head vocabulary and the
+        tombstones, so that the tails only need to be computed for the rows whose target is in them.
+
+        Arguments:
+            weight, bias: the output layer parameters, of shape ``(vocab_size, hidden_size)`` and
+                ``(vocab_size,)``
+            hiddens: a tensor of shape ``(N, hidden_size)``
+            targets: a tensor of shape ``(N,)``
+            extra_scores: a tensor of shape ``(N, num_extra)``
+            extra_mask: a tensor of shape ``(N, num_extra)`` indicating which extra scores are valid
+
+        Returns a tuple ``(target_log_probs, extra_log_probs)`` of shapes ``(N,)`` and
+        ``(N, num_extra)``.
+        '''
+        head_size = self.splits[1]
+        log_probs, num_head_scores = self._mixture_head(weight, bias, hiddens, extra_scores, extra_mask)
+        extra_log_probs = log_probs[:, num_head_scores:]
+
+        # Targets in the head only need to be gathered (the others are overwritten below)
+        head_targets = targets.clamp(max=head_size - 1).view(-1, 1)
+        target_log_probs = log_probs.gather(1, head_targets).squeeze(1)
+
+        for idx in range(1, self.nsplits):
+            start, end = self.splits[idx], self.splits[idx + 1]
+            in_split = (targets >= start) & (targets < end)
+            if not in_split.any():
+                continue
+            positions = in_split.nonzero().view(-1)
+            tail_res = torch.nn.functional.linear(hiddens.index_select(0, positions),
+                                                  weight[start:end],
+                                                  bias=bias[start:end])
+            # Then we calculate p(tombstone) * p(word within tombstone), using the same tombstone
+            # ordering as ``logprob``
+            head_entropy = log_probs.index_select(0, positions)[:, num_head_scores - idx]
+            indices = (targets.index_select(0, positions) - start).view(-1, 1)
+            tail_entropy = torch.gather(torch.nn.functional.log_softmax(tail_res, dim=-1), dim=1, index=indices).squeeze(1)
+            target_log_probs = target_log_probs.index_copy(0, positions, head_entropy + tail_entropy)
+
+        return target_log_probs, extra_log_probs
+
+    def mixture_logprob(self, weight, bias, hiddens, extra_scores, extra_mask):
+        r'''Same as ``mixture_log_probs``, except that the log probabilities of every word in the
+        vocabulary are returned (e.g. for sampling).
+
+        Returns a tensor of shape ``(N, vocab_size + num_extra)`` whose last ``num_extra`` columns
+        are the log probabilities of the extra scores.
+        '''
+        log_probs, num_head_scores = self._mixture_head(weight, bias, hiddens, extra_scores, extra_mask)
+        num_head_words = min(self.splits[1], weight.size(0))
+        results = [log_probs[:, :num_head_words]]
+        for idx in range(1, self.nsplits):
+            start, end = self.splits[idx], min(self.splits[idx + 1], weight.size(0))
+            if start >= end:
+                continue
+            tail_res = torch.nn.functional.linear(hiddens, weight[start:end], bias=bias[start:end])
+            head_entropy = log_probs[:, num_head_scores - idx].unsqueeze(1)
+            results.append(head_entropy + torch.nn.functional.log_softmax(tail_res, dim=-1))
+        results.append(log_probs[:, num_head_scores:])
+        return torch.cat(results, dim=1)
+
+    def _mixture_head(self, weight, bias, hiddens, extra_scores, extra_mask):
+        # The joint softmax over the head vocabulary, the tombstones and the extra scores
+        head_size = self.splits[1]
+        head_weight = weight[:head_size]
+        head_bias = bias[:head_size]
+        if self.nsplits > 1:
+            head_weight = torch.cat([head_weight, self.tail_vectors])
+            head_bias = torch.cat([head_bias, self.tail_bias])
+        head_res = torch.nn.functional.linear(hiddens, head_weight, bias=head_bias)
+        num_head_scores = head_res.size(1)
+
+        score_mask = torch.cat([extra_mask.new_ones(head_res.size()), extra_mask], dim=1)
+        log_probs = masked_log_softmax(torch.cat([head_res, extra_scores], dim=1), score_mask)
+        return log_probs, num_head_scores
@@ -53,9 +53,9 @@ def sample_from_logp(logp: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
     pdf = torch.exp(logp)
     cdf = torch.cumsum(pdf, dim=-1)
     rng = torch.rand(logp.shape[:-1], device=logp.device).unsqueeze(-1)
-    selected_idx = cdf.lt(rng).sum(dim=-1)
-    hack = torch.ones(logp.shape[:-1], device=logp.device, dtype=torch.uint8)
-    selected_logp = logp[hack, selected_idx[hack]]
+    # Rounding errors may leave the total probability slightly below ``rng``.
+    selected_idx = cdf.lt(rng).sum(dim=-1).clamp(max=logp.shape[-1] - 1)
+    selected_logp = logp.gather(-1, selected_idx.unsqueeze(-1)).squeeze(-1)
     return selected_logp, selected_idx
 
 
@@ -0,0 +1 @@
+from .kglm import KglmPredictor
@@ -0,0 +1,68 @@
+import math
+from typing import List
+
+from allennlp.common.util import JsonDict
+from allennlp.data import Instance
+from allennlp.data.dataset import Batch
+from allennlp.nn import util
+from allennlp.predictors.predictor import Predictor
+from overrides import overrides
+import torch
+
+
+@Predictor.register('kglm')
+class KglmPredictor(Predictor):
+    """
+    Scores entire documents using a KGLM-family language model (i.e. a model whose output
+    contains the log-probability ``logp`` of each sequence, such as ``Kglm`` or ``EntityNLM``).
+
+    Inputs are in the same format as the input files of the model's dataset reader (e.g.
+    ``{"tokens": [...], "annotations": [...]}`` for the enhanced wikitext readers). Since a single
+    reader and model are used for every request, the alias database and knowledge graph are only
+    loaded (and tensorized) once.
+
+    Both of the input layouts used by these models are supported: separate ``source`` and
+    ``target`` fields (e.g. ``Kglm``), whose target tokens are scored, and a single ``tokens``
+    field (e.g. ``EntityNLM``), where every token after the first is scored.
+
+    The output for each document contains the joint log-probability ``joint_logp`` of its tokens
+    and of their annotations (e.g. the gold entity annotations), its number of tokens, and the
+    corresponding ``joint_perplexity``. Note that for models with latent annotations (e.g. ``Kglm``)
+    this is not the perplexity of the tokens alone, which is estimated by marginalizing over the
+    annotations (see the ``evaluate-perplexity`` command).
+    """
+    @overrides
+    def _json_to_instance(self, json_dict: JsonDict) -> Instance:
+        return self._dataset_reader.text_to_instance(json_dict)
+
+    @overrides
+    def predict_instance(self, instance: Instance) -> JsonDict:
+        return self.predict_batch_instance([instance])[0]
+
+    @overrides
+    def predict_batch_instance(self, instances: List[Instance]) -> List[JsonDict]:
+        cuda_device = self._model._get_prediction_device()  # pylint: disable=protected-access
+        dataset = Batch(instances)
+        dataset.index_instances(self._model.vocab)
+        model_input = dataset.as_tensor_dict()
+        # Every batch contains entire documents, so the recurrent state is reset.
+        if 'target' in model_input:
+            model_input['reset'] = torch.ones(len(instances), dtype=torch.uint8)
+            self._model._state = None  # pylint: disable=protected-access
+            num_tokens = util.get_text_field_mask(model_input['target']).sum(-1)
+        else:
+            model_input['reset'] = True
+            num_tokens = util.get_text_field_mask(model_input['tokens']).sum(-1) - 1
+        model_input = util.move_to_device(model_input, cuda_device)
+
+        with torch.no_grad():
+            output_dict = self._model(**model_input)
+        if 'logp' not in output_dict:
+            raise ValueError('The model did not score the documents (are they annotated?)')
+        logp = output_dict['logp'].tolist()
+        num_tokens = num_tokens.tolist()
+
+        return [{'joint_logp': document_logp,
+                 'num_tokens': document_num_tokens,
+                 'joint_perplexity': math.exp(-document_logp / max(document_num_tokens, 1))}
+                for document_logp, document_num_tokens in zip(logp, num_tokens)]
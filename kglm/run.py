@@ -14,8 +14,13 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s
 
 # pylint: disable=wrong-import-position
 from allennlp.commands import main
-from kglm.commands import EvaluatePerplexity
+from kglm.commands import (
+    BenchmarkEntityNlm, BuildAliasDatabase, BuildEntityIndex, EvaluatePerplexity, Serve)
 
 if __name__ == "__main__":
     main(prog="allennlp",
-         subcommand_overrides={'evaluate-perplexity': EvaluatePerplexity()})
+         subcommand_overrides={'benchmark-entity-nlm': BenchmarkEntityNlm(),
+                               'build-alias-database': BuildAliasDatabase(),
+                               'build-entity-index': BuildEntityIndex(),
+                               'evaluate-perplexity': EvaluatePerplexity(),
+                               'serve': Serve()})
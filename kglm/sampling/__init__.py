@@ -0,0 +1,2 @@
+from .samplers import Sampler, EntityNlmSampler, KglmSampler
+from .cache import CachedSampler, SampleCache
@@ -0,0 +1,232 @@
+"""
+An on-disk store of samples, so that several generative models can be evaluated against the
+same importance samples while only drawing them once.
+"""
+import hashlib
+import logging
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from allennlp.models import Model
+from allennlp.nn.util import get_text_field_mask
+import numpy as np
+import torch
+
+from kglm.sampling.samplers import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+class SampleCache:
+    """
+    Stores the samples drawn for each document as a compressed numpy archive, containing the
+    log-probabilities of the samples (with shape ``(num_samples,)``) and each of the sampled
+    annotations (with shape ``(num_samples, document_length)``).
+
+    Documents are identified by a hash of their tokens (and of the sampler which drew the samples,
+    see ``CachedSampler``), and samples are additionally keyed by the seed they were drawn with, so
+    that independent sets of samples can be stored side by side. The samples of a document are
+    drawn using a random seed derived from both (see ``document_seed``).
+
+    Parameters
+    ----------
+    directory : ``str``
+        The directory the samples are stored in. Created if it does not exist.
+    """
+    def __init__(self, directory: str) -> None:
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def document_key(tokens: torch.Tensor) -> str:
+        """
+        Computes the key of a document given the ids of its (unpadded) tokens.
+        """
+        data = tokens.detach().cpu().numpy().astype(np.int64).tobytes()
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def model_fingerprint(model: Model) -> str:
+        """
+        Computes a hash of the type and parameters of a model, which identifies the model that
+        drew a set of samples.
+        """
+        sha1 = hashlib.sha1(type(model).__name__.encode('utf-8'))
+        for name, value in sorted(model.state_dict().items()):
+            sha1.update(b'\0' + name.encode('utf-8') + b'\0')
+            sha1.update(value.detach().cpu().numpy().tobytes())
+        return sha1.hexdigest()
+
+    @staticmethod
+    def document_seed(key: str, seed: int) -> int:
+        """
+        Computes the random seed used to draw the samples of a document with the given key.
+        """
+        data = ('%s.%i' % (key, seed)).encode('utf-8')
+        return int(hashlib.sha1(data).hexdigest()[:8], 16)
+
+    def _path(self, key: str, seed: int) -> str:
+        return os.path.join(self._directory, '%s.%i.npz' % (key, seed))
+
+    def load(self,
+             key: str,
+             seed: int,
+             num_samples: int) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Loads the first ``num_samples`` samples of a document. Returns ``None`` if fewer samples
+        are stored.
+        """
+        path = self._path(key, seed)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if data['logp'].shape[0] < num_samples:
+                return None
+            return {name: data[name][:num_samples] for name in data.files}
+
+    def save(self,
+             key: str,
+             seed: int,
+             arrays: Dict[str, np.ndarray]) -> None:
+        """
+        Stores the samples of a document. ``arrays`` must contain a ``logp`` array.
+        """
+        # Write to a temporary file first, so that an interrupted run never leaves behind a
+        # truncated archive.
+        path = self._path(key, seed)
+        temp_path = path + '.tmp.npz'
+        np.savez_compressed(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+
+class CachedSampler(Sampler):
+    """
+    Wraps a ``Sampler`` so that the samples drawn for each batch are read from a ``SampleCache``
+    if all of its documents have enough stored samples, and are otherwise drawn and then stored.
+
+    Stored samples are keyed by a fingerprint of the sampler's model (see
+    ``SampleCache.model_fingerprint``), so samples drawn by a different model (or a different
+    version of the same model) are never replayed.
+
+    So that the samples of a document only depend on the document and the seed (and not e.g. on
+    the other documents in the batch), documents without stored samples are sampled one at a time,
+    after reseeding the random number generator. Every sample of these documents is drawn and
+    stored before the samples of the batch are yielded.
+
+    Parameters
+    ----------
+    sampler : ``Sampler``
+        The sampler used when the samples are not cached.
+    cache : ``SampleCache``
+        The sample store.
+    seed : ``int``, optional (default=0)
+        The seed the samples are keyed by.
+    """
+    def __init__(self,
+                 sampler: Sampler,
+                 cache: SampleCache,
+                 seed: int = 0) -> None:
+        super().__init__(sampler.model)
+        self._sampler = sampler
+        self._cache = cache
+        self._seed = seed
+        self._fingerprint = SampleCache.model_fingerprint(sampler.model)
+        self.text_field = sampler.text_field
+        logger.info('Caching samples of model with fingerprint: %s', self._fingerprint)
+
+    def inputs(self,
+               batch: Dict[str, Any],
+               annotations: Dict[str, torch.Tensor],
+               num_samples: int) -> Dict[str, Any]:
+        return self._sampler.inputs(batch, annotations, num_samples)
+
+    def sample(self,
+               batch: Dict[str, Any],
+               num_samples: int,
+               samples_per_chunk: int = None) -> Iterator[Dict[str, Any]]:
+        samples_per_chunk = samples_per_chunk or num_samples
+        tokens = batch[self.text_field]['tokens']
+        lengths = get_text_field_mask(batch[self.text_field]).long().sum(dim=-1).tolist()
+        keys = ['%s.%s' % (self._fingerprint, SampleCache.document_key(tokens[i, :length]))
+                for i, length in enumerate(lengths)]
+
+        cached = [self._cache.load(key, self._seed, num_samples) for key in keys]
+        for i, (key, length) in enumerate(zip(keys, lengths)):
+            if cached[i] is None:
+                logger.debug('Drawing samples for document: %s', key)
+                document = _select_document(batch, i, length, self._sampler.sequence_fields)
+                cached[i] = self._draw(document, key, num_samples, samples_per_chunk)
+        yield from self._replay(batch, cached, num_samples, samples_per_chunk)
+
+    def _replay(self,
+                batch: Dict[str, Any],
+                cached: List[Dict[str, np.ndarray]],
+                num_samples: int,
+                samples_per_chunk: int) -> Iterator[Dict[str, Any]]:
+        tokens = batch[self.text_field]['tokens']
+        sequence_length = tokens.shape[1]
+        names = [name for name in cached[0] if name != 'logp']
+        num_drawn = 0
+        while num_drawn < num_samples:
+            num_chunk_samples = min(samples_per_chunk, num_samples - num_drawn)
+            window = slice(num_drawn, num_drawn + num_chunk_samples)
+            num_drawn += num_chunk_samples
+
+            # Lanes are sample-major (see ``Sampler``), so the documents' samples are interleaved.
+            logp = np.stack([document['logp'][window] for document in cached], axis=1)
+            annotations = {}
+            for name in names:
+                padded = np.zeros((num_chunk_samples, len(cached), sequence_length),
+                                  dtype=cached[0][name].dtype)
+                for i, document in enumerate(cached):
+                    padded[:, i, :document[name].shape[1]] = document[name][window]
+                annotations[name] = torch.from_numpy(padded).view(-1, sequence_length).to(tokens.device)
+            logp = torch.from_numpy(logp).view(-1).to(tokens.device)
+
+            yield {
+                    'num_samples': num_chunk_samples,
+                    'logp': logp,
+                    'annotations': annotations,
+                    'sample': self.inputs(batch, annotations, num_chunk_samples)
+            }
+
+    def _draw(self,
+              document: Dict[str, Any],
+              key: str,
+              num_samples: int,
+              samples_per_chunk: int) -> Dict[str, np.ndarray]:
+        # Reseeding must not affect the random state of the caller.
+        device = document[self.text_field]['tokens'].device
+        devices = [device.index] if device.type == 'cuda' else []
+        logp: List[torch.Tensor] = []
+        annotations: Dict[str, List[torch.Tensor]] = {}
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(SampleCache.document_seed(key, self._seed))
+            for chunk in self._sampler.sample(document, num_samples, samples_per_chunk):
+                logp.append(chunk['logp'].cpu())
+                for name, value in chunk['annotations'].items():
+                    annotations.setdefault(name, []).append(value.cpu())
+        arrays = {name: torch.cat(values, dim=0).numpy() for name, values in annotations.items()}
+        arrays['logp'] = torch.cat(logp, dim=0).numpy()
+        self._cache.save(key, self._seed, arrays)
+        return arrays
+
+
+def _select_document(batch: Dict[str, Any],
+                     index: int,
+                     length: int,
+                     sequence_fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """
+    Selects a single document of a batch, removing the padding of the fields aligned with its
+    tokens.
+    """
+    def select(value: Any, trim: bool) -> Any:
+        if isinstance(value, dict):
+            return {name: select(nested, trim) for name, nested in value.items()}
+        if isinstance(value, torch.Tensor) and value.dim() > 0:
+            value = value[index:index + 1]
+            return value[:, :length] if trim else value
+        if isinstance(value, list):
+            return value[index:index + 1]
+        return value
+    return {name: select(value, name in sequence_fields) for name, value in batch.items()}
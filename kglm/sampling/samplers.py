@@ -0,0 +1,464 @@
+"""
+Samplers which draw many annotations of the same documents from a discriminative model, e.g. to
+be used as importance samples by the ``evaluate-perplexity`` command.
+"""
+import logging
+from typing import Any, Dict, Iterator, Tuple, Type
+
+from allennlp.common import Registrable
+from allennlp.common.checks import ConfigurationError
+from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN
+from allennlp.models import Model
+from allennlp.nn.util import get_text_field_mask, masked_log_softmax
+import torch
+import torch.nn.functional as F
+
+from kglm.data.dataset_readers.enhanced_wikitext import entity_namespace_maps
+from kglm.models.entity_disc import EntityNLMDiscriminator
+from kglm.models.kglm_disc import KglmDisc
+from kglm.modules.dynamic_embeddings import fused_add_and_update, fused_entity_logits
+from kglm.nn.util import sample_from_logp
+
+logger = logging.getLogger(__name__)
+
+
+class Sampler(Registrable):
+    """
+    Draws samples of the annotations of documents from a discriminative model.
+
+    Each batch of documents is only encoded once. The samples are then drawn in parallel along
+    ``num_samples * batch_size`` lanes, ordered so that lane ``i * batch_size + j`` holds the
+    ``i``-th sample of document ``j`` (i.e. as if the batch had been repeated ``num_samples``
+    times). Samplers are looked up by the type of the model using ``from_model``.
+
+    Samples are made of annotations, which are tensors of shape ``(num_lanes, sequence_length)``
+    aligned with the tokens in the ``text_field`` of the batch, and which are converted to the
+    inputs of the corresponding generative model by ``inputs``. The ``sequence_fields`` are the
+    fields of the batch which are aligned with the ``text_field`` and used to draw samples.
+
+    Parameters
+    ----------
+    model : ``Model``
+        The discriminative model. Must be an instance of the sampler's ``model_class``.
+    """
+    model_class: Type[Model] = Model
+    text_field: str = 'tokens'
+    sequence_fields: Tuple[str, ...] = ('tokens',)
+
+    def __init__(self, model: Model) -> None:
+        if not isinstance(model, self.model_class):
+            raise ConfigurationError('%s expects a %s model, got: %s' % (
+                type(self).__name__, self.model_class.__name__, type(model).__name__))
+        self.model = model
+
+    @classmethod
+    def from_model(cls, model: Model) -> 'Sampler':
+        """
+        Constructs the registered sampler for the type of ``model``.
+        """
+        for name in cls.list_available():
+            sampler_class = cls.by_name(name)
+            if isinstance(model, sampler_class.model_class):
+                return sampler_class(model)
+        raise ConfigurationError('No sampler is registered for models of type: %s' % type(model).__name__)
+
+    def sample(self,
+               batch: Dict[str, Any],
+               num_samples: int,
+               samples_per_chunk: int = None) -> Iterator[Dict[str, Any]]:
+        """
+        Draws ``num_samples`` samples for every document in a batch.
+
+        Parameters
+        ----------
+        batch : ``Dict[str, Any]``
+            A batch of entire (unsplit) documents.
+        num_samples : ``int``
+            The number of samples drawn for each document.
+        samples_per_chunk : ``int``, optional (default=None)
+            If given, the samples are drawn (and yielded) this many at a time for each document,
+            to bound memory usage. Otherwise all of the samples are drawn at once.
+
+        Returns
+        -------
+        An iterator over dictionaries consisting of:
+        num_samples : ``int``
+            The number of samples for each document in the chunk.
+        logp : ``torch.Tensor``
+            A tensor of shape ``(num_samples * batch_size,)`` containing the log-probability of
+            each sample.
+        annotations : ``Dict[str, torch.Tensor]``
+            The sampled annotations.
+        sample : ``Dict[str, Any]``
+            The inputs of the corresponding generative model for each lane, including the
+            (repeated) tokens.
+        """
+        samples_per_chunk = samples_per_chunk or num_samples
+        with torch.no_grad():
+            encoded = self._encode(batch)
+            num_drawn = 0
+            while num_drawn < num_samples:
+                num_chunk_samples = min(samples_per_chunk, num_samples - num_drawn)
+                num_drawn += num_chunk_samples
+                logp, annotations = self._sample(batch, encoded, num_chunk_samples)
+                yield {
+                        'num_samples': num_chunk_samples,
+                        'logp': logp,
+                        'annotations': annotations,
+                        'sample': self.inputs(batch, annotations, num_chunk_samples)
+                }
+
+    def inputs(self,
+               batch: Dict[str, Any],
+               annotations: Dict[str, torch.Tensor],
+               num_samples: int) -> Dict[str, Any]:
+        """
+        Combines sampled annotations with the (repeated) contents of the batch to form the inputs
+        of the corresponding generative model.
+        """
+        raise NotImplementedError
+
+    def _encode(self, batch: Dict[str, Any]) -> torch.Tensor:
+        raise NotImplementedError
+
+    def _sample(self,
+                batch: Dict[str, Any],
+                encoded: torch.Tensor,
+                num_samples: int) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        raise NotImplementedError
+
+
+@Sampler.register('entitydisc')
+class EntityNlmSampler(Sampler):
+    """
+    Samples the entity types, ids and mention lengths of ``EntityNLM`` from an
+    ``EntityNLMDiscriminator``.
+
+    Every lane is processed at every timestep using fixed-shape masked updates (see
+    ``fused_add_and_update``), so unlike ``EntityNLMDiscriminator.sample`` the loop never
+    synchronizes with the host.
+    """
+    model_class = EntityNLMDiscriminator
+
+    def _encode(self, batch: Dict[str, Any]) -> torch.Tensor:
+        return self.model.encode(batch['tokens'])
+
+    def inputs(self,
+               batch: Dict[str, Any],
+               annotations: Dict[str, torch.Tensor],
+               num_samples: int) -> Dict[str, Any]:
+        inputs = {
+                'tokens': {key: value.repeat(num_samples, 1) for key, value in batch['tokens'].items()},
+                'reset': True
+        }
+        inputs.update(annotations)
+        return inputs
+
+    def _sample(self,
+                batch: Dict[str, Any],
+                encoded: torch.Tensor,
+                num_samples: int) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        # pylint: disable=protected-access
+        model = self.model
+        dynamic_embeddings = model._dynamic_embeddings
+        tokens = batch['tokens']
+        mask = get_text_field_mask(tokens).byte().repeat(num_samples, 1)
+        hidden = encoded.repeat(num_samples, 1, 1)
+        num_lanes, sequence_length, _ = hidden.shape
+
+        # Everything which only depends on the hidden states is computed up front.
+        entity_type_logp = F.log_softmax(model._entity_type_projection(hidden), dim=-1)
+        projected_hidden = hidden.matmul(dynamic_embeddings._embedding_projection.weight)
+        noise = 1e-4 * torch.randn_like(hidden)  # See ``DynamicEmbedding.add_embeddings``
+
+        dynamic_embeddings.reset_states(num_lanes)
+        embeddings = dynamic_embeddings.embeddings
+        num_embeddings = dynamic_embeddings.num_embeddings
+        last_seen = dynamic_embeddings.last_seen
+        slot_ids = dynamic_embeddings.slot_ids
+        last_used = dynamic_embeddings._last_used
+
+        logp = hidden.new_zeros(num_lanes)
+        prev_entity_types = mask.new_zeros(num_lanes)
+        prev_entity_ids = slot_ids.new_zeros(num_lanes)
+        prev_mention_lengths = slot_ids.new_ones(num_lanes)
+        all_entity_types = []
+        all_entity_ids = []
+        all_mention_lengths = []
+        timesteps = torch.arange(sequence_length, dtype=torch.int64, device=hidden.device)
+
+        for timestep in range(sequence_length):
+            current_mask = mask[:, timestep]
+            current_hidden = hidden[:, timestep]
+
+            # We only predict types / ids / lengths if the previous mention is terminated.
+            # Otherwise the outputs are copied from the previous timestep (with the mention length
+            # decreased by 1), which has probability 1 under the model.
+            predict_mask = prev_mention_lengths.eq(1) & current_mask
+            continue_mask = prev_mention_lengths.gt(1) & current_mask
+
+            type_logp, sampled_types = sample_from_logp(entity_type_logp[:, timestep])
+            predict_em = predict_mask & sampled_types.byte()
+
+            # Entity ids are predicted as embedding slots, which are mapped back to ids (slot 0
+            # being a new entity).
+            entity_id_logits = fused_entity_logits(embeddings,
+                                                   last_seen,
+                                                   slot_ids,
+                                                   projected_hidden[:, timestep],
+                                                   dynamic_embeddings._distance_scalar)
+            id_logp, sampled_slots = sample_from_logp(F.log_softmax(entity_id_logits, dim=-1))
+            gather_index = sampled_slots.view(-1, 1, 1).expand(-1, 1, embeddings.shape[-1])
+            slot_embeddings = embeddings.gather(1, gather_index).squeeze(1)
+            sampled_ids = slot_ids.gather(1, sampled_slots.unsqueeze(1)).squeeze(1)
+            sampled_ids = torch.where(sampled_slots.eq(0), num_embeddings, sampled_ids)
+
+            concatenated = torch.cat((current_hidden, slot_embeddings), dim=-1)
+            mention_length_logp = F.log_softmax(model._mention_length_projection(concatenated), dim=-1)
+            length_logp, sampled_lengths = sample_from_logp(mention_length_logp)
+
+            entity_types = torch.where(predict_mask, sampled_types.byte(), prev_entity_types & continue_mask)
+            entity_ids = torch.where(predict_em, sampled_ids, prev_entity_ids * continue_mask.long())
+            mention_lengths = torch.where(predict_em,
+                                          sampled_lengths,
+                                          torch.where(continue_mask,
+                                                      prev_mention_lengths - 1,
+                                                      torch.ones_like(prev_mention_lengths)))
+            zeros = torch.zeros_like(logp)
+            logp = logp + torch.where(predict_mask, type_logp, zeros)
+            logp = logp + torch.where(predict_em, id_logp + length_logp, zeros)
+
+            # Add / update entity embeddings
+            embeddings, num_embeddings, last_seen, slot_ids, last_used = fused_add_and_update(
+                embeddings=embeddings,
+                num_embeddings=num_embeddings,
+                last_seen=last_seen,
+                slot_ids=slot_ids,
+                last_used=last_used,
+                hidden=current_hidden,
+                noise=noise[:, timestep],
+                initial_embedding=dynamic_embeddings._initial_embedding,
+                delta_weight=dynamic_embeddings._delta_projection.weight,
+                entity_types=entity_types,
+                entity_ids=entity_ids,
+                timestep=timesteps[timestep],
+                clock=timesteps[timestep])
+
+            all_entity_types.append(entity_types)
+            all_entity_ids.append(entity_ids)
+            all_mention_lengths.append(mention_lengths)
+            prev_entity_types = entity_types
+            prev_entity_ids = entity_ids
+            prev_mention_lengths = mention_lengths
+
+        annotations = {
+                'entity_types': torch.stack(all_entity_types, dim=1),
+                'entity_ids': torch.stack(all_entity_ids, dim=1),
+                'mention_lengths': torch.stack(all_mention_lengths, dim=1)
+        }
+        return logp, annotations
+
+
+@Sampler.register('kglm-disc')
+class KglmSampler(Sampler):
+    """
+    Samples the annotations of ``Kglm`` from a ``KglmDisc``.
+
+    The mention types and new entities only depend on the hidden states, so their distributions
+    are computed once for all of the timesteps. Only the parents and relations of entities
+    related to recent entities are sampled one timestep at a time (as in ``Kglm.step``). The
+    samples are converted to the inputs of the generative model, i.e. aligned with the ``target``
+    tokens and with the alias tokens to copy.
+
+    Note that tokens are only matched to alias tokens by their ids in the ``tokens`` namespace, so
+    out-of-vocabulary alias tokens are never copied.
+    """
+    model_class = KglmDisc
+    text_field = 'target'
+    sequence_fields = ('source', 'target')
+
+    def __init__(self, model: Model) -> None:
+        super().__init__(model)
+        self._entity_to_raw: torch.Tensor = None
+        self._raw_to_entity: torch.Tensor = None
+
+    def _encode(self, batch: Dict[str, Any]) -> torch.Tensor:
+        return self.model.encode(batch['source'])
+
+    def inputs(self,
+               batch: Dict[str, Any],
+               annotations: Dict[str, torch.Tensor],
+               num_samples: int) -> Dict[str, Any]:
+        model = self.model
+        target = batch['target']['tokens'].repeat(num_samples, 1)
+        num_lanes, sequence_length = target.shape
+        if model._use_shortlist:  # pylint: disable=protected-access
+            shortlist = batch['shortlist']['entity_ids'].repeat(num_samples, 1)
+        else:
+            shortlist = target.new_zeros(num_lanes, 1)
+
+        # Find the alias tokens which are copied.
+        alias_database = batch['metadata'][0]['alias_database']
+        alias_database.tensorize(vocab=model.vocab)
+        global_ids, local_ids = alias_database.lookup(annotations['raw_entity_ids'])
+        unk_index = model.vocab.get_token_index(DEFAULT_OOV_TOKEN)
+        copied = global_ids.eq(target.view(num_lanes, sequence_length, 1, 1))
+        copied = copied & ~global_ids.eq(unk_index) & local_ids.gt(0)
+        alias_copy_inds, _ = (local_ids * copied.long()).view(num_lanes, sequence_length, -1).max(dim=-1)
+
+        return {
+                'source': {'tokens': batch['source']['tokens'].repeat(num_samples, 1)},
+                'target': {'tokens': target},
+                'reset': torch.ones_like(target[:, 0], dtype=torch.uint8),
+                'metadata': batch['metadata'] * num_samples,
+                'mention_type': annotations['mention_type'],
+                'raw_entity_ids': {'raw_entity_ids': annotations['raw_entity_ids']},
+                'entity_ids': {'entity_ids': annotations['entity_ids']},
+                'parent_ids': {'entity_ids': annotations['parent_ids'].unsqueeze(-1)},
+                'relations': {'relations': annotations['relations'].unsqueeze(-1)},
+                'shortlist': {'entity_ids': shortlist},
+                'shortlist_inds': annotations['shortlist_inds'],
+                'alias_copy_inds': alias_copy_inds
+        }
+
+    def _sample(self,
+                batch: Dict[str, Any],
+                encoded: torch.Tensor,
+                num_samples: int) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
+        # pylint: disable=protected-access,too-many-locals,too-many-statements
+        model = self.model
+        if 'target' not in batch:
+            raise ConfigurationError('KglmSampler requires batches read in generative mode')
+        source = batch['source']['tokens']
+        batch_size, sequence_length = source.shape
+        num_lanes = num_samples * batch_size
+        entity_to_raw, raw_to_entity = self._entity_namespace_maps(source.device)
+
+        # Annotations are aligned with the source tokens (so the first token is never annotated).
+        annotate = get_text_field_mask(batch['source']).byte()
+        annotate[:, 0] = 0
+        annotate = annotate.repeat(num_samples, 1)
+
+        splits = [model.token_embedding_dim] + [model.entity_embedding_dim] * 2
+        encoded_token, encoded_head, encoded_relation = encoded.split(splits, dim=-1)
+        mention_type_logits = model._fc_mention_type(encoded_token).repeat(num_samples, 1, 1)
+        encoded_head = encoded_head.repeat(num_samples, 1, 1)
+        encoded_relation = encoded_relation.repeat(num_samples, 1, 1)
+
+        # Sample new entities for every timestep.
+        if model._use_shortlist:
+            shortlist = batch['shortlist']['entity_ids']
+            shortlist_mask = get_text_field_mask(batch['shortlist'])
+            shortlist_embeddings = model._entity_embedder(shortlist)
+            logits = torch.bmm(encoded_head + encoded_relation,
+                               shortlist_embeddings.repeat(num_samples, 1, 1).transpose(1, 2))
+            log_probs = masked_log_softmax(logits, shortlist_mask.repeat(num_samples, 1).unsqueeze(1))
+            new_entity_logp, new_shortlist_inds = sample_from_logp(log_probs)
+            new_entity_ids = shortlist.repeat(num_samples, 1).gather(1, new_shortlist_inds)
+        else:
+            # Since the distribution over the entity vocabulary is shared by every sample of a
+            # document, it is computed once for each document and sampled from in one go.
+            new_entity_logp = []
+            new_entity_ids = []
+            for timestep in range(sequence_length):
+                logits = model._fc_new_entity(encoded_head[:batch_size, timestep] +
+                                              encoded_relation[:batch_size, timestep])
+                # The padding entity is never a valid prediction.
+                logits[:, 0] = -float('inf')
+                log_probs = F.log_softmax(logits, dim=-1)
+                # shape: (batch_size, num_samples)
+                sampled = torch.multinomial(log_probs.exp(), num_samples, replacement=True)
+                new_entity_logp.append(log_probs.gather(1, sampled).t().contiguous().view(-1))
+                new_entity_ids.append(sampled.t().contiguous().view(-1))
+            new_entity_logp = torch.stack(new_entity_logp, dim=1)
+            new_entity_ids = torch.stack(new_entity_ids, dim=1)
+            new_shortlist_inds = torch.zeros_like(new_entity_ids)
+
+        # Sample the remaining annotations one timestep at a time.
+        model._recent_entities.reset(annotate.new_ones(num_lanes))
+        logp = encoded.new_zeros(num_lanes)
+        outputs: Dict[str, list] = {key: [] for key in ('mention_type', 'entity_ids', 'raw_entity_ids',
+                                                        'parent_ids', 'relations', 'shortlist_inds')}
+        for timestep in range(sequence_length):
+            zeros = torch.zeros_like(logp)
+            parent_ids = annotate.new_zeros(num_lanes).long()
+            relations = torch.zeros_like(parent_ids)
+            derived_raw_entity_ids = torch.zeros_like(parent_ids)
+            derived_logp = zeros
+
+            # Only recent entities with outgoing edges in the knowledge graph can be expanded.
+            candidate_ids, candidate_mask = model._recent_entities.current()
+            can_expand = annotate.new_zeros(num_lanes)
+            if candidate_ids.shape[1] > 0:
+                candidate_relations, candidate_tail_ids, edge_mask = model._knowledge_graph_lookup(candidate_ids)
+                if edge_mask.shape[-1] > 0:
+                    candidate_mask = candidate_mask & edge_mask.any(dim=-1)
+                    can_expand = candidate_mask.any(dim=-1)
+
+                    candidate_embeddings = model._entity_embedder(candidate_ids)
+                    parent_logits = torch.bmm(candidate_embeddings,
+                                              encoded_head[:, timestep].unsqueeze(-1)).squeeze(-1)
+                    parent_logp, parent_index = sample_from_logp(masked_log_softmax(parent_logits,
+                                                                                    candidate_mask))
+                    parent_ids = candidate_ids.gather(1, parent_index.unsqueeze(1)).squeeze(1)
+
+                    # shape: (num_lanes, max_num_edges)
+                    index = parent_index.view(num_lanes, 1, 1).expand(-1, -1, edge_mask.shape[-1])
+                    parent_relations = candidate_relations.gather(1, index).squeeze(1)
+                    parent_tail_ids = candidate_tail_ids.gather(1, index).squeeze(1)
+                    parent_edge_mask = edge_mask.gather(1, index).squeeze(1)
+                    relation_embeddings = model._relation_embedder(parent_relations)
+                    relation_logits = torch.bmm(relation_embeddings,
+                                                encoded_relation[:, timestep].unsqueeze(-1)).squeeze(-1)
+                    relation_logp, edge_index = sample_from_logp(masked_log_softmax(relation_logits,
+                                                                                    parent_edge_mask))
+                    relations = parent_relations.gather(1, edge_index.unsqueeze(1)).squeeze(1)
+                    derived_raw_entity_ids = parent_tail_ids.gather(1, edge_index.unsqueeze(1)).squeeze(1)
+                    derived_logp = parent_logp + relation_logp
+
+            mention_type_mask = torch.ones_like(mention_type_logits[:, timestep], dtype=torch.uint8)
+            mention_type_mask[:, 2] = can_expand
+            mention_type_logp, mention_type = sample_from_logp(
+                masked_log_softmax(mention_type_logits[:, timestep], mention_type_mask))
+            mention_type = mention_type * annotate[:, timestep].long()
+
+            is_new = mention_type.eq(1)
+            is_derived = mention_type.eq(2)
+            current_new_entity_ids = new_entity_ids[:, timestep]
+            entity_ids = torch.where(is_new, current_new_entity_ids, raw_to_entity[derived_raw_entity_ids])
+            entity_ids = entity_ids * (is_new | is_derived).long()
+            raw_entity_ids = torch.where(is_new, entity_to_raw[current_new_entity_ids], derived_raw_entity_ids)
+            raw_entity_ids = raw_entity_ids * (is_new | is_derived).long()
+
+            logp = logp + torch.where(annotate[:, timestep], mention_type_logp, zeros)
+            logp = logp + torch.where(is_new, new_entity_logp[:, timestep], zeros)
+            logp = logp + torch.where(is_derived, derived_logp, zeros)
+
+            model._recent_entities(entity_ids.unsqueeze(1))
+
+            outputs['mention_type'].append(mention_type)
+            outputs['entity_ids'].append(entity_ids)
+            outputs['raw_entity_ids'].append(raw_entity_ids)
+            outputs['parent_ids'].append(parent_ids * is_derived.long())
+            outputs['relations'].append(relations * is_derived.long())
+            outputs['shortlist_inds'].append(new_shortlist_inds[:, timestep] * is_new.long())
+
+        # The generative model's annotations are aligned with the target tokens, i.e. shifted one
+        # position to the left.
+        def _shift(annotations: list) -> torch.Tensor:
+            stacked = torch.stack(annotations[1:], dim=1)
+            return torch.cat((stacked, stacked.new_zeros(num_lanes, 1)), dim=1)
+        annotations = {key: _shift(value) for key, value in outputs.items()}
+
+        return logp, annotations
+
+    def _entity_namespace_maps(self, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        # See ``Kglm._entity_namespace_maps``.
+        if self._entity_to_raw is None:
+            entity_to_raw, raw_to_entity = entity_namespace_maps(self.model.vocab)
+            self._entity_to_raw = torch.tensor(entity_to_raw, dtype=torch.int64)
+            self._raw_to_entity = torch.tensor(raw_to_entity, dtype=torch.int64)
+        if self._entity_to_raw.device != device:
+            self._entity_to_raw = self._entity_to_raw.to(device)
+            self._raw_to_entity = self._raw_to_entity.to(device)
+        return self._entity_to_raw, self._raw_to_entity
@@ -0,0 +1 @@
+from .server import MicroBatcher, make_server
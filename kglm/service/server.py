@@ -0,0 +1,181 @@
+"""
+A lightweight local HTTP server which serves predictions from a ``Predictor``, grouping
+concurrent requests into micro-batches.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import queue
+import socketserver
+import threading
+import time
+from typing import Callable, List, Optional
+
+from allennlp.common.util import JsonDict
+from allennlp.predictors.predictor import Predictor
+
+logger = logging.getLogger(__name__)
+
+
+def num_tokens(inputs: JsonDict) -> int:
+    """Counts the tokens of a document in the enhanced wikitext format."""
+    tokens = inputs.get('tokens', [])
+    return sum(len(sentence) if isinstance(sentence, list) else 1 for sentence in tokens)
+
+
+class _Request:
+    def __init__(self, inputs: JsonDict, length: int) -> None:
+        self.inputs = inputs
+        self.length = length
+        self.arrival = time.perf_counter()
+        self.result: Optional[JsonDict] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Groups requests submitted from multiple threads into micro-batches, which are processed by a
+    single worker thread.
+
+    The worker waits until either ``max_batch_size`` requests are pending, or the oldest pending
+    request has waited ``max_latency`` seconds. The pending requests are then sorted by length and
+    split into batches of similar length, so that little computation is wasted on padding.
+
+    Parameters
+    ----------
+    predict_batch : ``Callable[[List[JsonDict]], List[JsonDict]]``
+        Produces the outputs for a batch of inputs (e.g. ``Predictor.predict_batch_json``).
+    max_batch_size : ``int``, optional (default=32)
+        The maximum number of requests in a batch.
+    max_tokens : ``int``, optional (default=None)
+        If given, the maximum number of (padded) tokens in a batch. A request longer than this
+        is processed on its own.
+    max_latency : ``float``, optional (default=0.05)
+        The maximum time (in seconds) a request waits for other requests to be batched with.
+    length_fn : ``Callable[[JsonDict], int]``, optional (default=``num_tokens``)
+        Computes the length of a request.
+    """
+    def __init__(self,
+                 predict_batch: Callable[[List[JsonDict]], List[JsonDict]],
+                 max_batch_size: int = 32,
+                 max_tokens: int = None,
+                 max_latency: float = 0.05,
+                 length_fn: Callable[[JsonDict], int] = num_tokens) -> None:
+        self._predict_batch = predict_batch
+        self._max_batch_size = max_batch_size
+        self._max_tokens = max_tokens
+        self._max_latency = max_latency
+        self._length_fn = length_fn
+        self._queue: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, inputs: JsonDict) -> JsonDict:
+        """
+        Submits a request and blocks until its output is available. Exceptions raised while
+        processing its batch are re-raised.
+        """
+        request = _Request(inputs, self._length_fn(inputs))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            pending = [first]
+            deadline = first.arrival + self._max_latency
+            while len(pending) < self._max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for batch in self._group(pending):
+                self._process(batch)
+
+    def _group(self, pending: List[_Request]) -> List[List[_Request]]:
+        batches: List[List[_Request]] = []
+        batch: List[_Request] = []
+        for request in sorted(pending, key=lambda request: request.length):
+            # Since requests are sorted, the padded size of a batch is set by its last request.
+            padded_size = (len(batch) + 1) * request.length
+            if batch and self._max_tokens is not None and padded_size > self._max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(request)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _process(self, batch: List[_Request]) -> None:
+        try:
+            results = self._predict_batch([request.inputs for request in batch])
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception('Error processing batch')
+            for request in batch:
+                request.error = error
+        for request in batch:
+            request.done.set()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(predictor: Predictor,
+                host: str = '127.0.0.1',
+                port: int = 8000,
+                **batcher_kwargs) -> HTTPServer:
+    """
+    Creates a server which responds to ``POST /predict`` requests whose body is a single JSON
+    input for the predictor. Concurrent requests are batched using a ``MicroBatcher`` (which is
+    constructed using the additional keyword arguments).
+    """
+    batcher = MicroBatcher(predictor.predict_batch_json, **batcher_kwargs)
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:  # pylint: disable=invalid-name
+            if self.path != '/predict':
+                self._respond(404, {'error': 'Unknown path: %s' % self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                inputs = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as error:
+                self._respond(400, {'error': str(error)})
+                return
+            try:
+                self._respond(200, batcher.submit(inputs))
+            except Exception as error:  # pylint: disable=broad-except
+                self._respond(500, {'error': str(error)})
+
+        def _respond(self, status: int, body: JsonDict) -> None:
+            encoded = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+            logger.debug(format, *args)
+
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.batcher = batcher  # type: ignore
+    return server
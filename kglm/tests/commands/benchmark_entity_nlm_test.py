@@ -0,0 +1,19 @@
+# pylint: disable=protected-access
+from allennlp.common.testing import ModelTestCase
+
+from kglm.commands.benchmark_entity_nlm import benchmark_fused_step
+
+
+class BenchmarkEntityNlmTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_benchmark_fused_step(self):
+        batch = self.dataset.as_tensor_dict()
+        results = benchmark_fused_step(self.model, batch, num_repeats=1)
+        assert results['loop_tokens_per_sec'] > 0
+        assert results['fused_tokens_per_sec'] > 0
+        assert not self.model._fused_step
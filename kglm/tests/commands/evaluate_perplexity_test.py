@@ -0,0 +1,110 @@
+# pylint: disable=protected-access,not-callable
+import math
+import os
+
+from allennlp.common import Params
+from allennlp.common.testing import ModelTestCase
+from allennlp.data.iterators import BasicIterator
+from allennlp.models import Model
+
+from kglm.commands.evaluate_perplexity import evaluate_perplexity
+from kglm.common.testing import KglmModelTestCase
+
+
+class EvaluatePerplexityTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        params = Params({
+                'type': 'entitydisc',
+                'embedding_dim': 10,
+                'max_embeddings': 20,
+                'max_mention_length': 20,
+                'text_field_embedder': {
+                        'token_embedders': {'tokens': {'type': 'embedding', 'embedding_dim': 10}}
+                },
+                'encoder': {'type': 'lstm', 'input_size': 10, 'hidden_size': 10, 'stateful': True}
+        })
+        self.sampler = Model.from_params(vocab=self.vocab, params=params)
+        self.iterator = BasicIterator(batch_size=1)
+        self.iterator.index_with(self.vocab)
+
+    def test_evaluate_perplexity(self):
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                      cuda_device=-1, num_samples=8, samples_per_batch=3)
+        assert math.isfinite(metrics['perplexity'])
+        assert metrics['num_samples'] == 8
+        assert metrics['num_documents'] == len(self.instances)
+
+    def test_batched_documents(self):
+        # Padding documents to the same length does not change the number of scored tokens.
+        expected = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                       cuda_device=-1, num_samples=2)
+        iterator = BasicIterator(batch_size=2)
+        iterator.index_with(self.vocab)
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, iterator,
+                                      cuda_device=-1, num_samples=2)
+        assert metrics['num_tokens'] == expected['num_tokens']
+        assert metrics['num_documents'] == expected['num_documents'] == len(self.instances)
+        assert math.isfinite(metrics['perplexity'])
+
+    def test_adaptive_stopping(self):
+        # A criterion which is always met stops after ``min_samples``...
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                      cuda_device=-1, num_samples=8, min_samples=2,
+                                      min_effective_sample_size=0)
+        assert metrics['num_samples'] == 2
+        assert math.isfinite(metrics['perplexity'])
+
+        # ...while a criterion which is never met draws every sample.
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                      cuda_device=-1, num_samples=8, min_samples=2,
+                                      min_effective_sample_size=1e9)
+        assert metrics['num_samples'] == 8
+
+    def test_adaptive_stopping_stores_samples(self):
+        sample_cache = str(self.TEST_DIR / 'samples')
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                      cuda_device=-1, num_samples=8, min_samples=2,
+                                      min_effective_sample_size=0, sample_cache=sample_cache)
+        assert metrics['num_samples'] == 2
+        assert len(os.listdir(sample_cache)) == len(self.instances)
+
+        # The stored samples are replayed, so the estimates are the same.
+        replayed = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                       cuda_device=-1, num_samples=8, min_samples=2,
+                                       min_effective_sample_size=0, sample_cache=sample_cache)
+        assert math.isclose(replayed['perplexity'], metrics['perplexity'], rel_tol=1e-3)
+
+
+class EvaluateKglmPerplexityTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.no-shortlist.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        params = Params.from_file("kglm/tests/fixtures/training_config/kglm-disc.no-shortlist.json")
+        self.sampler = Model.from_params(vocab=self.vocab, params=params['model'])
+        self.iterator = BasicIterator(batch_size=1)
+        self.iterator.index_with(self.vocab)
+
+    def test_evaluate_perplexity(self):
+        # The model encodes each document once, and scores several samples of it at a time.
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                      cuda_device=-1, num_samples=4, samples_per_batch=3)
+        assert math.isfinite(metrics['perplexity'])
+        assert metrics['num_samples'] == 4
+        assert metrics['num_documents'] == len(self.instances)
+
+    def test_batched_documents(self):
+        expected = evaluate_perplexity(self.model, self.sampler, self.instances, self.iterator,
+                                       cuda_device=-1, num_samples=2)
+        iterator = BasicIterator(batch_size=2)
+        iterator.index_with(self.vocab)
+        metrics = evaluate_perplexity(self.model, self.sampler, self.instances, iterator,
+                                      cuda_device=-1, num_samples=2)
+        assert metrics['num_tokens'] == expected['num_tokens']
+        assert metrics['num_documents'] == expected['num_documents'] == len(self.instances)
+        assert math.isfinite(metrics['perplexity'])
@@ -7,6 +7,7 @@ from allennlp.data.vocabulary import Vocabulary
 import numpy as np
 
 from kglm.data import AliasDatabase
+from kglm.data.alias_database import MAX_ALIASES, MAX_TOKENS
 
 
 class AliasDatabaseTest(AllenNlpTestCase):
@@ -23,11 +24,11 @@ class AliasDatabaseTest(AllenNlpTestCase):
                 'Entity1': np.array([[1, 2], [3, 0]], dtype=int)
         }
         token_indexer = SingleIdTokenIndexer()
-        entity_indexer = SingleIdTokenIndexer(namespace='entity_ids')
+        entity_indexer = SingleIdTokenIndexer(namespace='raw_entity_ids')
         text_field = TextField([Token(t) for t in ['Robby', 'is', 'a', 'nickname', 'for', 'Robert']],
                                {'tokens': token_indexer})
         entity_field = TextField([Token(t) for t in ['Entity1', '', '', '', '', 'Entity1']],
-                                 {'entity_ids': entity_indexer})
+                                 {'raw_entity_ids': entity_indexer})
         self.instance = Instance({
                 'tokens': text_field,
                 'entity_identifiers': entity_field
@@ -56,6 +57,40 @@ class AliasDatabaseTest(AllenNlpTestCase):
         test_id_array = alias_database._id_array_lookup[test_entity]
         assert test_id_array[0, 0] == test_id_array[1, 0]
 
+    def test_save_and_load_pretokenized(self):
+        # Test that the pre-tokenized database contains the same information as the original
+        alias_database = AliasDatabase.load('kglm/tests/fixtures/mini.alias.pkl')
+        pretokenized_path = str(self.TEST_DIR / 'alias_database')
+        alias_database.save(pretokenized_path)
+        pretokenized = AliasDatabase.load(pretokenized_path)
+        assert pretokenized._pretokenized_arrays is not None
+
+        test_entity = 'Q156216'  # Benton County
+        for token in ['Benton', 'County', ',', 'Washington', 'Oregon']:
+            assert pretokenized.token_to_uid(test_entity, token) == \
+                    alias_database.token_to_uid(test_entity, token)
+        assert pretokenized._token_lookup[test_entity] == alias_database._token_lookup[test_entity]
+        assert np.array_equal(pretokenized._id_array_lookup[test_entity],
+                              alias_database._id_array_lookup[test_entity])
+
+        # Entities which are not in the database should not have any aliases
+        assert pretokenized.token_to_uid('not-an-entity', 'Benton') == 0
+
+    def test_tensorize_pretokenized(self):
+        # Tensorizing a pre-tokenized database should give the same results as tensorizing the
+        # original database.
+        alias_database = AliasDatabase(token_lookup=self.token_lookup,
+                                       id_map_lookup=self.id_map_lookup,
+                                       id_array_lookup=self.id_array_lookup)
+        pretokenized_path = str(self.TEST_DIR / 'alias_database')
+        alias_database.save(pretokenized_path)
+        pretokenized = AliasDatabase.load(pretokenized_path)
+
+        alias_database.tensorize(self.vocab)
+        pretokenized.tensorize(self.vocab)
+        assert pretokenized._global_id_lookup.equal(alias_database._global_id_lookup)
+        assert pretokenized._local_id_lookup.equal(alias_database._local_id_lookup)
+
     def test_token_to_uid(self):
         alias_database = AliasDatabase(token_lookup=self.token_lookup,
                                        id_map_lookup=self.id_map_lookup,
@@ -72,26 +107,26 @@ class AliasDatabaseTest(AllenNlpTestCase):
 
         # But should exist after ``AliasDatabase`` is tensorized
         alias_database.tensorize(self.vocab)
-        return
 
         assert alias_database.is_tensorized
-        assert alias_database._global_id_lookup != []
-        assert alias_database._local_id_lookup != []
+        assert alias_database._global_id_lookup is not None
+        assert alias_database._local_id_lookup is not None
 
         tensor_dict = self.dataset.as_tensor_dict()
-        entity_ids = tensor_dict['entity_identifiers']['entity_ids']
+        entity_ids = tensor_dict['entity_identifiers']['raw_entity_ids']
         global_tensor, local_tensor = alias_database.lookup(entity_ids)
 
         # The first two dimensions should match the batch_size and sequence length of the index.
-        # The next dimensions should be the max number of aliases of all entities (in this case 2
-        # for 'Robert Logan', and 'Robby') and the max length of the aliases (again 2 because
-        # 'Robert Logan' is two tokens).
-        assert global_tensor.shape == (1, 6, 2, 2)
-        assert local_tensor.shape == (1, 6, 2, 2)
+        # The next dimensions are the maximum number of aliases and the maximum alias length.
+        assert global_tensor.shape == (1, 6, MAX_ALIASES, MAX_TOKENS)
+        assert local_tensor.shape == (1, 6, MAX_ALIASES, MAX_TOKENS)
 
         # Check that the global ids match the vocabulary indices
         assert global_tensor[0, 0, 0, 0] == self.vocab.get_token_index('Robert', namespace='tokens')
+        assert global_tensor[0, 0, 1, 0] == self.vocab.get_token_index('Robby', namespace='tokens')
+        assert global_tensor[0, 0, 1, 1] == 0  # Padding since 'Robby' is only one token
         assert global_tensor[0, 1, 0, 0] == 0  # Padding since not an alias
 
         assert local_tensor[0, 0, 0, 0] == 1
+        assert local_tensor[0, 0, 1, 0] == 3
         assert local_tensor[0, 1, 0, 0] == 0  # Padding since not an alias
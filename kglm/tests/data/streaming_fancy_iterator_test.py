@@ -0,0 +1,59 @@
+# pylint: disable=protected-access,not-callable
+import numpy as np
+import torch
+
+from kglm.common.testing import KglmModelTestCase
+from kglm.data.iterators import FancyIterator, StreamingFancyIterator
+
+SPLITTING_KEYS = ['source', 'target', 'mention_type', 'raw_entity_ids', 'entity_ids', 'parent_ids',
+                  'relations', 'shortlist_inds', 'alias_copy_inds']
+
+
+def _assert_same_batch(expected, actual):
+    assert expected.keys() == actual.keys()
+    for key in expected:
+        if isinstance(expected[key], dict):
+            _assert_same_batch(expected[key], actual[key])
+        elif isinstance(expected[key], torch.Tensor):
+            # Documents are tensorized as a whole by the streaming iterator, so nested fields may
+            # have additional padding.
+            expected_array = expected[key].numpy()
+            actual_array = actual[key].numpy()
+            overlap = tuple(slice(0, size) for size in expected_array.shape)
+            np.testing.assert_array_equal(expected_array, actual_array[overlap], err_msg=key)
+            assert actual_array.sum() == expected_array.sum(), key
+        else:
+            assert expected[key] == actual[key], key
+
+
+class StreamingFancyIteratorTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def _iterators(self, batch_size):
+        iterators = (FancyIterator(splitting_keys=SPLITTING_KEYS, split_size=30, batch_size=batch_size),
+                     StreamingFancyIterator(splitting_keys=SPLITTING_KEYS, split_size=30, batch_size=batch_size))
+        for iterator in iterators:
+            iterator.index_with(self.vocab)
+        return iterators
+
+    def test_same_batches_as_fancy_iterator(self):
+        # With a single lane both iterators read the documents in the same order.
+        fancy_iterator, streaming_iterator = self._iterators(batch_size=1)
+        expected = [batch for batch, _ in fancy_iterator(self.instances, num_epochs=1)]
+        actual = [batch for batch, _ in streaming_iterator(self.instances, num_epochs=1)]
+        assert len(expected) == len(actual)
+        for expected_batch, actual_batch in zip(expected, actual):
+            _assert_same_batch(expected_batch, actual_batch)
+
+    def test_model_forward(self):
+        _, streaming_iterator = self._iterators(batch_size=2)
+        for batch, _ in streaming_iterator(self.instances, num_epochs=1):
+            # Metadata is batched as a list of dictionaries.
+            assert isinstance(batch['metadata'], list)
+            assert len(batch['metadata']) == 2
+            output_dict = self.model(**batch)
+            assert torch.isfinite(output_dict['loss'])
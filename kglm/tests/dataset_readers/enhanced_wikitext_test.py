@@ -107,3 +107,28 @@ class TestEnhancedWikitextKglmReader:
         first_instance_shortlist = [x.text for x in instances[0]['shortlist'].tokens]
         first_instance_shortlist_inds = instances[0]['shortlist_inds'].array
         assert first_instance_shortlist_inds[16+offset] == first_instance_shortlist.index('Q831285')
+
+    @pytest.mark.parametrize('num_workers', (0, 2))
+    def test_parallel_and_cached_reads_match(self, tmpdir, num_workers):
+        alias_database_path = 'kglm/tests/fixtures/mini.alias.pkl'
+        fixture_path = 'kglm/tests/fixtures/enhanced-wikitext.jsonl'
+        reader = EnhancedWikitextKglmReader(alias_database_path=alias_database_path)
+        expected_instances = ensure_list(reader.read(fixture_path))
+
+        cache_directory = str(tmpdir.join('cache'))
+        reader = EnhancedWikitextKglmReader(alias_database_path=alias_database_path,
+                                            num_workers=num_workers,
+                                            cache_directory=cache_directory,
+                                            lazy=True)
+        # The first read processes the data (in parallel if num_workers > 0) and writes the
+        # cache, the second read loads from the cache.
+        for _ in range(2):
+            instances = ensure_list(reader.read(fixture_path))
+            assert len(instances) == len(expected_instances)
+            for instance, expected_instance in zip(instances, expected_instances):
+                for key in ('source', 'target', 'raw_entity_ids', 'entity_ids', 'shortlist'):
+                    assert [x.text for x in instance[key].tokens] == \
+                            [x.text for x in expected_instance[key].tokens]
+                for key in ('mention_type', 'shortlist_inds', 'alias_copy_inds'):
+                    np.testing.assert_array_equal(instance[key].array, expected_instance[key].array)
+            assert len(tmpdir.join('cache').listdir()) == 1
@@ -16,3 +16,14 @@ class AliasCopynetTest(KglmModelTestCase):
 
     def test_model_can_train_save_and_load(self):
         self.ensure_model_can_train_save_and_load(self.param_file)
+
+
+class AliasCopynetSplitsTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/alias_copynet.splits.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_model_can_train_save_and_load(self):
+        self.ensure_model_can_train_save_and_load(self.param_file)
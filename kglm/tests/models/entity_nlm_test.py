@@ -5,7 +5,7 @@ import numpy as np
 import torch
 
 from kglm.data.dataset_readers.enhanced_wikitext import EnhancedWikitextEntityNlmReader
-from kglm.models.entity_nlm import EntityNLM
+from kglm.models.entity_nlm import EntityNLM, fused_entity_step
 
 
 class EntityNLMTest(ModelTestCase):
@@ -24,3 +24,90 @@ class EntityNLMTest(ModelTestCase):
         ]
         self.ensure_model_can_train_save_and_load(self.param_file,
                                                   gradients_to_ignore=gradients_to_ignore)
+
+    def test_fused_step_matches_loop(self):
+        batch = self.dataset.as_tensor_dict()
+        self.model.eval()
+        with torch.no_grad():
+            self.model._fused_step = False
+            loop_output = self.model(**batch, reset=True)
+            self.model._fused_step = True
+            fused_output = self.model(**batch, reset=True)
+        # New entity embeddings are initialized with a small amount of random noise, so the
+        # outputs only agree approximately.
+        for key in ('entity_type_loss', 'entity_id_loss', 'mention_length_loss', 'vocab_loss'):
+            np.testing.assert_allclose(float(fused_output[key]), float(loop_output[key]), atol=1e-3)
+        np.testing.assert_allclose(fused_output['logp'].numpy(), loop_output['logp'].numpy(), atol=1e-2)
+
+    def test_fused_step_can_be_traced(self):
+        batch = self.dataset.as_tensor_dict()
+        self.model.eval()
+        dynamic_embeddings = self.model._dynamic_embeddings
+        with torch.no_grad():
+            hidden = self.model.encode(batch['tokens'])
+            batch_size, sequence_length, _ = hidden.shape
+            projected_hidden = hidden.matmul(dynamic_embeddings._embedding_projection.weight)
+            noise = torch.zeros_like(hidden)
+            entity_ids = batch['entity_ids']
+            entity_types = batch['entity_types']
+            dynamic_embeddings.reset_states(batch_size)
+            initial_state = (dynamic_embeddings.embeddings,
+                             dynamic_embeddings.num_embeddings,
+                             dynamic_embeddings.last_seen,
+                             dynamic_embeddings.slot_ids,
+                             dynamic_embeddings._last_used)
+            timesteps = torch.arange(sequence_length, dtype=torch.int64)
+
+            def inputs(state, timestep):
+                return (*state,
+                        hidden[:, timestep],
+                        projected_hidden[:, timestep],
+                        noise[:, timestep],
+                        dynamic_embeddings._initial_embedding,
+                        dynamic_embeddings._delta_projection.weight,
+                        dynamic_embeddings._distance_scalar,
+                        entity_types[:, timestep],
+                        entity_ids[:, timestep],
+                        entity_ids[:, timestep + 1],
+                        timesteps[timestep],
+                        timesteps[timestep] + 10)
+
+            # The trace is made at the first timestep, and reused at every other timestep.
+            traced_step = torch.jit.trace(fused_entity_step, inputs(initial_state, 0))
+            eager_state = traced_state = initial_state
+            for timestep in range(sequence_length - 1):
+                eager_outputs = fused_entity_step(*inputs(eager_state, timestep))
+                traced_outputs = traced_step(*inputs(traced_state, timestep))
+                for eager_output, traced_output in zip(eager_outputs, traced_outputs):
+                    np.testing.assert_allclose(traced_output.numpy(), eager_output.numpy(), rtol=1e-5)
+                eager_state = eager_outputs[:5]
+                traced_state = traced_outputs[:5]
+
+    def test_encoded_inputs_match(self):
+        batch = self.dataset.as_tensor_dict()
+        self.model.eval()
+        with torch.no_grad():
+            torch.manual_seed(0)
+            output = self.model(**batch, reset=True)
+            encoded = self.model.encode(batch['tokens'])
+            torch.manual_seed(0)
+            encoded_output = self.model(**batch, reset=True, encoded=encoded)
+        np.testing.assert_allclose(encoded_output['logp'].numpy(), output['logp'].numpy(), rtol=1e-5)
+
+
+class EntityNLMFusedStepTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.fused.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_model_can_train_save_and_load(self):
+        assert self.model._fused_step
+        gradients_to_ignore = [
+                '_dummy_context_embedding',
+                '_dynamic_embeddings._distance_scalar',
+                '_dynamic_embeddings._embedding_projection.weight'
+        ]
+        self.ensure_model_can_train_save_and_load(self.param_file,
+                                                  gradients_to_ignore=gradients_to_ignore)
@@ -1,11 +1,19 @@
 # pylint: disable=protected-access,not-callable,unused-import
+from unittest import mock
+
+from allennlp.common import Params
+from allennlp.common.checks import ConfigurationError
+from allennlp.models import Model
 import numpy as np
+import pytest
 import torch
 
 from kglm.common.testing import KglmModelTestCase
 from kglm.data.dataset_readers.enhanced_wikitext import EnhancedWikitextKglmReader
 from kglm.models.kglm import Kglm
 from kglm.models.kglm_disc import KglmDisc
+from kglm.modules import EntityIndex
+from kglm.modules.entity_index import entity_logit_vectors
 
 
 class KglmTest(KglmModelTestCase):
@@ -18,6 +26,7 @@ class KglmTest(KglmModelTestCase):
     def test_model_can_train_save_and_load(self):
         self.ensure_model_can_train_save_and_load(self.param_file)
 
+
 class KglmNoShortlistTest(KglmModelTestCase):
 
     def setUp(self):
@@ -28,6 +37,153 @@ class KglmNoShortlistTest(KglmModelTestCase):
     def test_model_can_train_save_and_load(self):
         self.ensure_model_can_train_save_and_load(self.param_file)
 
+    def test_generate(self):
+        self.model.eval()
+        alias_database = self.dataset.instances[0]['metadata'].metadata['alias_database']
+        output = self.model.generate(alias_database, max_length=5, batch_size=2)
+        assert output['tokens'].shape == (2, 5)
+        # Only mentions of entities related to recent entities have parents.
+        assert output['parent_ids'][output['mention_type'].ne(2)].eq(0).all()
+        # Only mentions can copy alias tokens.
+        assert output['alias_copy_inds'][output['mention_type'].eq(0)].eq(0).all()
+
+        # Generation can also continue from a prefix.
+        prefix = output['tokens'][:, :3]
+        output = self.model.generate(alias_database, max_length=2, prefix=prefix)
+        assert output['tokens'].shape == (2, 2)
+
+    def _add_entity_index(self, num_clusters):
+        # pylint: disable=protected-access
+        fc_new_entity = self.model._fc_new_entity
+        vectors = entity_logit_vectors(fc_new_entity.weight.detach(), fc_new_entity.bias.detach())
+        path = str(self.TEST_DIR / 'entity_index.npz')
+        EntityIndex.build(vectors, num_clusters=num_clusters).save(path)
+        self.model._entity_index = EntityIndex.load(path)
+
+    def test_new_entity_candidates(self):
+        self.model.eval()
+        encoded = torch.randn(2, 3, self.model.entity_embedding_dim)
+        expected_logits, expected_ids = self.model.new_entity_candidates(encoded, k=4)
+        assert expected_ids.shape == (2, 3, 4)
+        assert expected_ids.ne(0).all()
+
+        # Searching every cluster of the index is exact.
+        self._add_entity_index(num_clusters=3)
+        logits, entity_ids = self.model.new_entity_candidates(encoded, k=4, num_probes=3)
+        assert entity_ids.equal(expected_ids)
+        np.testing.assert_allclose(logits.numpy(), expected_logits.numpy(), rtol=1e-5)
+
+    def test_generate_with_entity_index(self):
+        self.model.eval()
+        self._add_entity_index(num_clusters=3)
+        alias_database = self.dataset.instances[0]['metadata'].metadata['alias_database']
+        output = self.model.generate(alias_database, max_length=5, batch_size=2, top_k_entities=2)
+        assert output['tokens'].shape == (2, 5)
+        new_entities = output['entity_ids'][output['mention_type'].eq(1)]
+        assert new_entities.ne(0).all()
+
+    def test_entity_index_requires_tied_weights(self):
+        params = Params.from_file(self.param_file)['model']
+        params['tie_weights'] = False
+        params['entity_index_path'] = str(self.TEST_DIR / 'entity_index.npz')
+        with pytest.raises(ConfigurationError):
+            Model.from_params(vocab=self.vocab, params=params)
+
+
+class KglmSampledNoShortlistTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.no-shortlist.sampled.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_model_can_train_save_and_load(self):
+        self.ensure_model_can_train_save_and_load(self.param_file)
+
+    def test_sampled_new_entity_log_probs(self):
+        num_entities = self.model._fc_new_entity.out_features
+        num_samples = self.model._num_sampled_entities
+        log_range = np.log(num_entities + 1)
+        sampled_ids = np.array([1, 2, 3, 2, 7])
+        assert sampled_ids.shape == (num_samples,)
+        # The uniform samples which are mapped to ``sampled_ids`` by the inverse transform.
+        uniform = torch.tensor(np.log(sampled_ids + 1.5) / log_range, dtype=torch.float32)
+
+        encoded = torch.randn(2, self.model.entity_embedding_dim)
+        target_inds = torch.tensor([2, 5])
+        with mock.patch.object(torch, 'rand', return_value=uniform):
+            log_probs = self.model._sampled_new_entity_log_probs(encoded, target_inds)
+
+        def log_expected_count(i):
+            return np.log(num_samples * np.log((i + 2) / (i + 1)) / log_range)
+
+        weight = self.model._fc_new_entity.weight.detach().numpy()
+        bias = self.model._fc_new_entity.bias.detach().numpy()
+        logits = encoded.numpy().dot(weight.T) + bias
+        for i, target in enumerate(target_inds.tolist()):
+            # Samples which are the target (the two samples of entity 2) are not negatives.
+            negatives = [j for j in sampled_ids if j != target]
+            scores = np.array([logits[i, j] - log_expected_count(j) for j in [target] + negatives])
+            expected = scores[0] - np.log(np.exp(scores).sum())
+            np.testing.assert_allclose(log_probs[i].item(), expected, rtol=1e-5)
+
+    def test_cannot_be_combined_with_entity_splits(self):
+        params = Params.from_file(self.param_file)['model']
+        params['entity_splits'] = [10]
+        with pytest.raises(ConfigurationError):
+            Model.from_params(vocab=self.vocab, params=params)
+
+
+class KglmHierarchicalNoShortlistTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.no-shortlist.hierarchical.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_model_can_train_save_and_load(self):
+        self.ensure_model_can_train_save_and_load(self.param_file)
+
+    def test_new_entity_log_probs_are_normalized(self):
+        split_cross_entropy = self.model._entity_split_cross_entropy
+        with torch.no_grad():
+            split_cross_entropy.tail_vectors.normal_()
+            split_cross_entropy.tail_bias.normal_()
+        num_entities = self.model._fc_new_entity.out_features
+        assert num_entities > split_cross_entropy.splits[1]
+
+        encoded = torch.randn(1, self.model.entity_embedding_dim).expand(num_entities, -1)
+        target_inds = torch.arange(num_entities)
+        target_log_probs, _ = split_cross_entropy.mixture_log_probs(self.model._fc_new_entity.weight,
+                                                                    self.model._fc_new_entity.bias,
+                                                                    encoded,
+                                                                    target_inds,
+                                                                    encoded.new_zeros(num_entities, 0),
+                                                                    target_inds.new_zeros(num_entities, 0).byte())
+        np.testing.assert_allclose(target_log_probs.exp().sum().item(), 1.0, rtol=1e-5)
+
+    def test_cluster_scores_are_trained(self):
+        self.model.train()
+        num_entities = self.model._fc_new_entity.out_features
+        encoded = torch.randn(1, 3, self.model.entity_embedding_dim)
+        # The last entity is outside of the head cluster.
+        target_inds = torch.tensor([[0, 1, num_entities - 1]])
+        loss, _ = self.model._new_entity_loss(encoded, target_inds, None, torch.ones(1, 3))
+        loss.backward()
+        assert self.model._entity_split_cross_entropy.tail_vectors.grad.ne(0).any()
+
+
+class KglmSplitsTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.splits.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_model_can_train_save_and_load(self):
+        self.ensure_model_can_train_save_and_load(self.param_file)
+
+
 class KglmDiscTest(KglmModelTestCase):
 
     def setUp(self):
@@ -38,6 +194,7 @@ class KglmDiscTest(KglmModelTestCase):
     def test_model_can_train_save_and_load(self):
         self.ensure_model_can_train_save_and_load(self.param_file)
 
+
 class KglmDiscNoShortlistTest(KglmModelTestCase):
 
     def setUp(self):
@@ -0,0 +1,62 @@
+from allennlp.common.testing import AllenNlpTestCase
+import torch
+
+from kglm.modules import AliasEncodingCache
+
+
+class AliasEncodingCacheTest(AllenNlpTestCase):
+    # pylint: disable=protected-access
+    def setUp(self):
+        super().setUp()
+        self.cache = AliasEncodingCache(max_size=2)
+        self.num_encoded = 0
+
+    def encode(self, aliases: torch.Tensor) -> torch.Tensor:
+        self.num_encoded += aliases.shape[0]
+        return aliases.float() * 2
+
+    def test_cache_is_not_used_during_training(self):
+        self.cache.train()
+        aliases = torch.tensor([[1, 2], [3, 0]])
+        self.cache(aliases, self.encode)
+        self.cache(aliases, self.encode)
+        assert self.num_encoded == 4
+        assert self.cache.get_metric() == 0.0
+
+    def test_cache_hits_and_eviction(self):
+        self.cache.eval()
+        aliases = torch.tensor([[1, 2], [3, 0]])
+        output = self.cache(aliases, self.encode)
+        assert output.equal(aliases.float() * 2)
+        assert self.num_encoded == 2
+
+        # Both aliases should now be cached
+        output = self.cache(aliases, self.encode)
+        assert output.equal(aliases.float() * 2)
+        assert self.num_encoded == 2
+        assert self.cache.get_metric(reset=True) == 0.5
+
+        # Adding a new alias should evict the least recently used one ([1, 2])
+        self.cache(torch.tensor([[3, 0], [4, 4]]), self.encode)
+        assert self.num_encoded == 3
+        assert sorted(tuple(key) for key in self.cache._keys.tolist()) == [(3, 0), (4, 4)]
+
+        # Cached and newly encoded aliases are combined in the original order.
+        output = self.cache(torch.tensor([[4, 4], [5, 6], [3, 0]]), self.encode)
+        assert output.equal(torch.tensor([[8., 8.], [10., 12.], [6., 0.]]))
+        assert self.num_encoded == 4
+
+    def test_cached_encodings_are_copies(self):
+        # Storing views of the encoded batch would keep the entire batch alive.
+        self.cache.eval()
+        aliases = torch.tensor([[1, 2], [3, 0], [4, 4]])
+        output = self.cache(aliases, self.encode)
+        assert self.cache._values.shape == (2, 2)
+        assert self.cache._values.data_ptr() != output.data_ptr()
+
+    def test_cache_is_cleared_on_mode_change(self):
+        self.cache.eval()
+        self.cache(torch.tensor([[1, 2]]), self.encode)
+        assert self.cache._keys.shape[0] == 1
+        self.cache.train()
+        assert self.cache._keys is None
@@ -91,6 +91,39 @@ class TestDynamicEmbedding(TestCase):
         self.assertIsNotNone(dynamic_embedding._initial_embedding.grad)
         self.assertIsNotNone(hidden.grad)
 
+    def test_eviction(self):
+        embedding_dim = 4
+        max_embeddings = 3
+        batch_size = 1
+
+        dynamic_embedding = DynamicEmbedding(embedding_dim, max_embeddings)
+        dynamic_embedding.reset_states(batch_size)
+        hidden = torch.randn((batch_size, embedding_dim))
+
+        # Fill all of the slots, using entity 1 before entity 2.
+        for entity_id in (1, 2):
+            dynamic_embedding.add_embeddings(entity_id)
+            dynamic_embedding.update_embeddings(hidden, torch.tensor([entity_id]), entity_id)  # pylint: disable=E1102
+        self.assertListEqual(dynamic_embedding.slot_ids.tolist(), [[0, 1, 2]])
+
+        # Adding a third entity evicts the least recently used one (e.g. entity 1).
+        dynamic_embedding.add_embeddings(3)
+        dynamic_embedding.update_embeddings(hidden, torch.tensor([3]), 3)  # pylint: disable=E1102
+        self.assertListEqual(dynamic_embedding.slot_ids.tolist(), [[0, 3, 2]])
+        self.assertEqual(dynamic_embedding.num_embeddings[0], 4)
+        self.assertListEqual(dynamic_embedding.slots(torch.tensor([1])).tolist(), [0])  # pylint: disable=E1102
+        self.assertListEqual(dynamic_embedding.slots(torch.tensor([3])).tolist(), [1])  # pylint: disable=E1102
+
+        # Mentioning an evicted entity re-adds it.
+        dynamic_embedding.update_embeddings(hidden, torch.tensor([1]), 4)  # pylint: disable=E1102
+        self.assertListEqual(dynamic_embedding.slot_ids.tolist(), [[0, 3, 1]])
+        self.assertEqual(dynamic_embedding.last_seen[0, 2], 4)
+
+        # All of the slots can be predicted, and targets are mapped to their slots.
+        outputs = dynamic_embedding(hidden, target=torch.tensor([3]))  # pylint: disable=E1102
+        self.assertTrue(outputs['logit_mask'].all())
+        self.assertEqual(outputs['loss'].shape, (batch_size,))
+
     # def test_forward(self):
     #     embedding_dim = 4
     #     max_embeddings = 10
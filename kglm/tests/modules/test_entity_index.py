@@ -0,0 +1,47 @@
+# pylint: disable=protected-access
+from allennlp.common.testing import AllenNlpTestCase
+import torch
+
+from kglm.modules import EntityIndex
+from kglm.modules.entity_index import benchmark_entity_index
+
+
+class EntityIndexTest(AllenNlpTestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(13370)
+        self.embeddings = torch.randn(50, 8)
+        self.queries = torch.randn(6, 8)
+        self.index = EntityIndex.build(self.embeddings, num_clusters=5)
+
+    def test_build(self):
+        # Every entity except padding should appear exactly once.
+        assert self.index.num_clusters == 5
+        assert sorted(self.index._entity_ids.tolist()) == list(range(1, 50))
+        assert self.index._offsets[-1].item() == 49
+        assert self.index._vectors.equal(self.embeddings[self.index._entity_ids])
+
+    def test_search_all_clusters_is_exact(self):
+        scores, entity_ids = self.index.search(self.queries, k=3, num_probes=5)
+        exact_scores = self.queries.mm(self.embeddings.t())
+        exact_scores[:, 0] = -float('inf')
+        expected_scores, expected_ids = exact_scores.topk(3, dim=-1)
+        assert entity_ids.equal(expected_ids)
+        assert torch.allclose(scores, expected_scores)
+
+        metrics = benchmark_entity_index(self.index, self.embeddings, self.queries, k=3, num_probes=5)
+        assert metrics['recall'] == 1.0
+
+    def test_search_pads_missing_candidates(self):
+        # A single cluster may contain fewer than ``k`` entities.
+        scores, entity_ids = self.index.search(self.queries, k=49, num_probes=1)
+        assert entity_ids.eq(0).equal(scores.eq(-float('inf')))
+
+    def test_save_and_load(self):
+        path = self.TEST_DIR / 'index.npz'
+        self.index.save(str(path))
+        loaded = EntityIndex.load(str(path))
+        expected = self.index.search(self.queries, k=3, num_probes=2)
+        actual = loaded.search(self.queries, k=3, num_probes=2)
+        assert expected[0].equal(actual[0])
+        assert expected[1].equal(actual[1])
@@ -1,4 +1,6 @@
+import os
 import pickle
+from unittest import mock
 
 from allennlp.common.testing import AllenNlpTestCase
 from allennlp.data.vocabulary import Vocabulary
@@ -32,14 +34,22 @@ class KnowledgeGraphLookupTest(AllenNlpTestCase):
         self.vocab.add_token_to_namespace('R2', 'relations')
 
         # Lastly we create the knowledge graph lookup
-        self.knowledge_graph_lookup = KnowledgeGraphLookup(self.path, self.vocab)
+        self.cache_directory = str(self.TEST_DIR / 'cache')
+        self.knowledge_graph_lookup = KnowledgeGraphLookup(self.path, self.vocab,
+                                                           cache_directory=self.cache_directory)
 
-    def test_lists_are_correct(self):
-        # The lookup converts the data in the knowledge graph into lists of tensors.
-        # Here we check that these lists contain the expected information.
+    def test_edges_are_correct(self):
+        # The lookup converts the data in the knowledge graph into a compressed sparse row format.
+        # Here we check that the offsets and flat edge tensors contain the expected information.
+        offsets = self.knowledge_graph_lookup._offsets
         relations = self.knowledge_graph_lookup._relations
         tail_ids = self.knowledge_graph_lookup._tail_ids
 
+        # There is one offset per entity (plus one), and one element per edge.
+        assert offsets.shape == (self.vocab.get_vocab_size('entity_ids') + 1,)
+        assert relations.shape == (3,)
+        assert tail_ids.shape == (3,)
+
         # We'll check that the information is correct for entity 'E1'. We'll start by building the
         # expected tensors from our inputs...
         expected_relations, expected_tail_ids = zip(*self.temp_knowledge_graph['E1'])
@@ -47,10 +57,15 @@ class KnowledgeGraphLookupTest(AllenNlpTestCase):
         expected_tail_ids = [self.vocab.get_token_index(t, 'raw_entity_ids') for t in expected_tail_ids]
         expected_relations = torch.LongTensor(expected_relations)
         expected_tail_ids = torch.LongTensor(expected_tail_ids)
-        # ...then checking whether the corresponding elements in the lists are correct.
+        # ...then checking whether the corresponding slices of the edge tensors are correct.
         index = self.vocab.get_token_index('E1', 'entity_ids')
-        assert relations[index].equal(expected_relations)
-        assert tail_ids[index].equal(expected_tail_ids)
+        start, end = offsets[index], offsets[index + 1]
+        assert relations[start:end].equal(expected_relations)
+        assert tail_ids[start:end].equal(expected_tail_ids)
+
+        # Entities which are not in the knowledge graph should not have any edges.
+        index = self.vocab.get_token_index('E3', 'entity_ids')
+        assert offsets[index] == offsets[index + 1]
 
     def test_lookup(self):
         # Check that the output of the lookup matches our expectations.
@@ -60,7 +75,7 @@ class KnowledgeGraphLookupTest(AllenNlpTestCase):
             self.vocab.get_token_index('E3', 'entity_ids')  # Should work, even though E3 not in the KG
         ]
         parent_ids = torch.LongTensor(parent_ids)
-        indices, _, relations, tail_ids = self.knowledge_graph_lookup(parent_ids)
+        relations, tail_ids, mask = self.knowledge_graph_lookup(parent_ids)
 
         # Lookup indices of tokens expected to be in the output
         e2 = self.vocab.get_token_index('E2', 'raw_entity_ids')
@@ -68,20 +83,72 @@ class KnowledgeGraphLookupTest(AllenNlpTestCase):
         r1 = self.vocab.get_token_index('R1', 'relations')
         r2 = self.vocab.get_token_index('R2', 'relations')
 
-        # Expected outputs (these are directly transcribed from the KG)
-        expected_indices = [(0,), (1,)]
-        expected_relations = [
-            torch.LongTensor([r1, r2]),
-            torch.LongTensor([r1])
-        ]
-        expected_tail_ids = [
-            torch.LongTensor([e2, e3]),
-            torch.LongTensor([e3])
-        ]
+        # Expected outputs (these are directly transcribed from the KG, and padded to the largest
+        # number of edges)
+        expected_relations = torch.LongTensor([[r1, r2], [r1, 0], [0, 0]])
+        expected_tail_ids = torch.LongTensor([[e2, e3], [e3, 0], [0, 0]])
+        expected_mask = torch.LongTensor([[1, 1], [1, 0], [0, 0]])
 
         # Check expectations are met
-        assert indices == expected_indices
-        for observed, expected in zip(relations, expected_relations):
-            assert observed.equal(expected)
-        for observed, expected in zip(tail_ids, expected_tail_ids):
-            assert observed.equal(expected)
+        assert relations.equal(expected_relations)
+        assert tail_ids.equal(expected_tail_ids)
+        assert mask.long().equal(expected_mask)
+
+    def test_lookup_preserves_shape(self):
+        # Parent ids can have an arbitrary number of dimensions, the edges are returned in an
+        # additional trailing dimension.
+        e1 = self.vocab.get_token_index('E1', 'entity_ids')
+        parent_ids = torch.LongTensor([[[e1, 0]], [[0, 0]]])
+        relations, tail_ids, mask = self.knowledge_graph_lookup(parent_ids)
+        assert relations.shape == (2, 1, 2, 2)
+        assert tail_ids.shape == (2, 1, 2, 2)
+        assert mask.shape == (2, 1, 2, 2)
+        assert mask.long().sum() == 2
+
+    def test_lookup_without_edges(self):
+        # Parents without any edges give empty outputs, with the same types as other lookups.
+        e1 = self.vocab.get_token_index('E1', 'entity_ids')
+        e3 = self.vocab.get_token_index('E3', 'entity_ids')
+        _, _, expected_mask = self.knowledge_graph_lookup(torch.LongTensor([e1]))
+        relations, tail_ids, mask = self.knowledge_graph_lookup(torch.LongTensor([[e3, 0]]))
+        assert relations.shape == tail_ids.shape == mask.shape == (1, 2, 0)
+        assert relations.dtype == tail_ids.dtype == torch.int64
+        assert mask.dtype == expected_mask.dtype
+
+    def test_cache(self):
+        # Creating the lookup should have cached the indexed edges.
+        cache_path = self.knowledge_graph_lookup.cache_path(str(self.path))
+        assert os.path.exists(cache_path)
+        assert os.path.dirname(cache_path) == self.cache_directory
+
+        # A new lookup should read the edges from the cache, and they should be the same.
+        with mock.patch.object(KnowledgeGraphLookup, 'load_edges', side_effect=AssertionError):
+            cached_lookup = KnowledgeGraphLookup(self.path, self.vocab, cache_directory=self.cache_directory)
+        assert cached_lookup._offsets.equal(self.knowledge_graph_lookup._offsets)
+        assert cached_lookup._relations.equal(self.knowledge_graph_lookup._relations)
+        assert cached_lookup._tail_ids.equal(self.knowledge_graph_lookup._tail_ids)
+
+    def test_cache_depends_on_vocab(self):
+        # Changing the vocabulary changes the indices of the edges, so the cache cannot be reused.
+        cache_path = self.knowledge_graph_lookup.cache_path(str(self.path))
+        self.vocab.add_token_to_namespace('E4', 'raw_entity_ids')
+        assert self.knowledge_graph_lookup.cache_path(str(self.path)) != cache_path
+
+    def test_cache_depends_on_knowledge_graph(self):
+        # A different knowledge graph with the same filename does not reuse the cache.
+        other_directory = self.TEST_DIR / 'other'
+        other_directory.mkdir()
+        other_path = other_directory / 'relation.pkl'
+        with open(other_path, 'wb') as f:
+            pickle.dump({'E3': [['R2', 'E1']]}, f)
+        other_lookup = KnowledgeGraphLookup(other_path, self.vocab, cache_directory=self.cache_directory)
+        assert (other_lookup.cache_path(str(other_path)) !=
+                self.knowledge_graph_lookup.cache_path(str(self.path)))
+        assert other_lookup._relations.shape == (1,)
+        index = self.vocab.get_token_index('E3', 'entity_ids')
+        assert other_lookup._offsets[index + 1] - other_lookup._offsets[index] == 1
+
+    def test_cache_is_opt_in(self):
+        # Without a cache directory nothing is written next to the knowledge graph.
+        KnowledgeGraphLookup(self.path, self.vocab)
+        assert sorted(os.listdir(str(self.TEST_DIR))) == ['cache', 'relation.pkl']
@@ -53,13 +53,20 @@ class RecentEntitiesTest(AllenNlpTestCase):
         # Let's check that the remainders are correct
         # Entity 3 should have a remainder of 1, Entity 4 should have a remainder of 2, and
         # everything else should be filtered out.
-        assert self.recent_entities._remaining[0] == {3: 1, 4: 2}
+        remaining_ids = self.recent_entities._remaining_ids[0].tolist()
+        remainders = (self.recent_entities._last_seen[0] + self.cutoff + 1).tolist()
+        remaining = {k: v for k, v in zip(remaining_ids, remainders) if k != 0}
+        assert remaining == {3: 1, 4: 2}
 
         # If we run on the same data again, the remainder for entity 4 should activate the mask for
         # the first and second timestep.
         candidate_ids, candidate_mask = self.recent_entities(entity_ids_t0)
         expected_4 = torch.tensor([1, 1, 0], dtype=torch.uint8)
         assert candidate_mask[0, :, 4].equal(expected_4)
+        # Entity 3 is now mentioned again at the 2nd timestep, so its mask should be the same as in
+        # the first split, except that the remainder from the last split covers the 1st timestep.
+        expected_3 = torch.tensor([1, 0, 1], dtype=torch.uint8)
+        assert candidate_mask[0, :, 3].equal(expected_3)
 
         # But this should not happen if we reset the first sequence
         reset = torch.tensor([1, 0], dtype=torch.uint8)
@@ -67,3 +74,22 @@ class RecentEntitiesTest(AllenNlpTestCase):
         candidate_ids, candidate_mask = self.recent_entities(entity_ids_t0)
         expected_4 = torch.tensor([0, 0, 0], dtype=torch.uint8)
         assert candidate_mask[0, :, 4].equal(expected_4)
+
+    def test_current(self):
+        # The current candidates should be the same as the candidates of the first timestep of the
+        # next split.
+        entity_ids_t0 = torch.tensor([
+            [[1, 2], [3, 0], [4, 0]],
+            [[1, 0], [0, 0], [2, 0]]
+        ])
+        reset = torch.ones(entity_ids_t0.shape[0], dtype=torch.uint8)
+        self.recent_entities.reset(reset)
+        self.recent_entities(entity_ids_t0)
+
+        current_ids, current_mask = self.recent_entities.current()
+        current = [set(ids[mask].tolist()) for ids, mask in zip(current_ids, current_mask)]
+        assert current == [{3, 4}, {2}]
+
+        candidate_ids, candidate_mask = self.recent_entities(torch.zeros_like(entity_ids_t0))
+        expected = [set(ids[mask[0]].tolist()) for ids, mask in zip(candidate_ids, candidate_mask)]
+        assert current == expected
@@ -0,0 +1,85 @@
+from allennlp.common.testing import AllenNlpTestCase
+from allennlp.nn.util import masked_log_softmax
+import torch
+
+from kglm.modules.splitcross import SplitCrossEntropyLoss
+
+
+class SplitCrossEntropyLossTest(AllenNlpTestCase):
+    def setUp(self):
+        self.vocab_size = 12
+        self.hidden_size = 4
+        self.weight = torch.randn(self.vocab_size, self.hidden_size)
+        self.bias = torch.randn(self.vocab_size)
+        self.hiddens = torch.randn(5, self.hidden_size)
+        self.extra_scores = torch.randn(5, 3)
+        self.extra_mask = torch.tensor([[1, 1, 0],
+                                        [0, 0, 0],
+                                        [1, 0, 0],
+                                        [1, 1, 1],
+                                        [0, 1, 0]], dtype=torch.uint8)
+        super().setUp()
+
+    def test_mixture_log_probs_without_splits_is_full_softmax(self):
+        loss = SplitCrossEntropyLoss(self.hidden_size, [])
+        targets = torch.tensor([0, 3, 5, 11, 7])
+        target_log_probs, extra_log_probs = loss.mixture_log_probs(self.weight,
+                                                                   self.bias,
+                                                                   self.hiddens,
+                                                                   targets,
+                                                                   self.extra_scores,
+                                                                   self.extra_mask)
+        scores = torch.cat((torch.nn.functional.linear(self.hiddens, self.weight, self.bias),
+                            self.extra_scores), dim=-1)
+        mask = torch.cat((torch.ones(5, self.vocab_size, dtype=torch.uint8), self.extra_mask), dim=-1)
+        expected = masked_log_softmax(scores, mask)
+        assert torch.allclose(target_log_probs, expected.gather(1, targets.view(-1, 1)).squeeze(1))
+        assert torch.allclose(extra_log_probs, expected[:, self.vocab_size:])
+
+    def test_mixture_log_probs_are_normalized(self):
+        loss = SplitCrossEntropyLoss(self.hidden_size, [4, 8])
+        torch.nn.init.normal_(loss.tail_vectors)
+        # Score every word in the vocabulary, for every row.
+        total = torch.zeros(5)
+        for word in range(self.vocab_size):
+            targets = torch.full((5,), word, dtype=torch.int64)
+            target_log_probs, extra_log_probs = loss.mixture_log_probs(self.weight,
+                                                                       self.bias,
+                                                                       self.hiddens,
+                                                                       targets,
+                                                                       self.extra_scores,
+                                                                       self.extra_mask)
+            total += target_log_probs.exp()
+        total += (extra_log_probs.exp() * self.extra_mask.float()).sum(-1)
+        assert torch.allclose(total, torch.ones(5), atol=1e-5)
+
+        # And agree with ``logprob`` when there are no extra scores.
+        targets = torch.tensor([0, 3, 5, 11, 7])
+        target_log_probs, _ = loss.mixture_log_probs(self.weight,
+                                                     self.bias,
+                                                     self.hiddens,
+                                                     targets,
+                                                     self.extra_scores,
+                                                     torch.zeros_like(self.extra_mask))
+        expected = loss.logprob(self.weight, self.bias, self.hiddens)
+        assert torch.allclose(target_log_probs, expected.gather(1, targets.view(-1, 1)).squeeze(1),
+                              atol=1e-5)
+
+    def test_mixture_logprob_matches_mixture_log_probs(self):
+        loss = SplitCrossEntropyLoss(self.hidden_size, [4, 8])
+        torch.nn.init.normal_(loss.tail_vectors)
+        log_probs = loss.mixture_logprob(self.weight,
+                                         self.bias,
+                                         self.hiddens,
+                                         self.extra_scores,
+                                         self.extra_mask)
+        assert log_probs.shape == (5, self.vocab_size + 3)
+        targets = torch.tensor([0, 3, 5, 11, 7])
+        target_log_probs, extra_log_probs = loss.mixture_log_probs(self.weight,
+                                                                   self.bias,
+                                                                   self.hiddens,
+                                                                   targets,
+                                                                   self.extra_scores,
+                                                                   self.extra_mask)
+        assert torch.allclose(log_probs.gather(1, targets.view(-1, 1)).squeeze(1), target_log_probs)
+        assert torch.allclose(log_probs[:, self.vocab_size:], extra_log_probs)
@@ -0,0 +1,61 @@
+# pylint: disable=protected-access
+import json
+import math
+
+from allennlp.common import Params
+from allennlp.common.testing import ModelTestCase
+from allennlp.data import DatasetReader
+import numpy as np
+
+from kglm.common.testing import KglmModelTestCase
+from kglm.predictors import KglmPredictor
+
+
+def _read_documents(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f]
+
+
+class KglmPredictorTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        reader = DatasetReader.from_params(Params.from_file(self.param_file)['dataset_reader'])
+        self.model.eval()
+        self.predictor = KglmPredictor(self.model, reader)
+        self.documents = _read_documents("kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_predict_json(self):
+        output = self.predictor.predict_json(self.documents[0])
+        num_tokens = len(self.instances[0]['target'])
+        assert output['num_tokens'] == num_tokens
+        assert math.isfinite(output['joint_logp'])
+        assert np.isclose(output['joint_perplexity'], math.exp(-output['joint_logp'] / num_tokens))
+
+    def test_batches_match_single_documents(self):
+        # Padding documents to the same length does not change their scores.
+        batch_outputs = self.predictor.predict_batch_json(self.documents)
+        for document, batch_output in zip(self.documents, batch_outputs):
+            output = self.predictor.predict_json(document)
+            assert output['num_tokens'] == batch_output['num_tokens']
+            assert np.isclose(output['joint_logp'], batch_output['joint_logp'], rtol=1e-4)
+
+
+class EntityNlmPredictorTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        reader = DatasetReader.from_params(Params.from_file(self.param_file)['dataset_reader'])
+        self.model.eval()
+        self.predictor = KglmPredictor(self.model, reader)
+        self.documents = _read_documents("kglm/tests/fixtures/enhanced-wikitext.jsonl")
+
+    def test_predict_json(self):
+        # Every token but the first is scored.
+        output = self.predictor.predict_json(self.documents[0])
+        assert output['num_tokens'] == len(self.instances[0]['tokens']) - 1
+        assert math.isfinite(output['joint_logp'])
@@ -0,0 +1,105 @@
+# pylint: disable=protected-access,not-callable
+import os
+
+from allennlp.common import Params
+from allennlp.common.testing import ModelTestCase
+from allennlp.data.dataset import Batch
+from allennlp.models import Model
+import numpy as np
+import torch
+
+from kglm.sampling import CachedSampler, Sampler, SampleCache
+
+
+class CachedSamplerTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        params = Params({
+                'type': 'entitydisc',
+                'embedding_dim': 10,
+                'max_embeddings': 20,
+                'max_mention_length': 20,
+                'text_field_embedder': {
+                        'token_embedders': {'tokens': {'type': 'embedding', 'embedding_dim': 10}}
+                },
+                'encoder': {'type': 'lstm', 'input_size': 10, 'hidden_size': 10, 'stateful': True}
+        })
+        self.params = params
+        discriminator = Model.from_params(vocab=self.vocab, params=params.duplicate())
+        discriminator.eval()
+        self.sampler = Sampler.from_model(discriminator)
+        self.cache = SampleCache(str(self.TEST_DIR / 'samples'))
+
+    def test_samples_are_reused(self):
+        batch = self.dataset.as_tensor_dict()
+        cached_sampler = CachedSampler(self.sampler, self.cache, seed=1)
+        drawn = list(cached_sampler.sample(batch, num_samples=4, samples_per_chunk=3))
+
+        # Once stored, the samples are replayed without sampling.
+        def fail(*args, **kwargs):
+            raise AssertionError('Samples should have been read from the cache')
+        self.sampler._sample = fail
+        replayed = list(cached_sampler.sample(batch, num_samples=4, samples_per_chunk=2))
+        assert [chunk['num_samples'] for chunk in replayed] == [2, 2]
+
+        drawn_logp = torch.cat([chunk['logp'] for chunk in drawn]).numpy()
+        replayed_logp = torch.cat([chunk['logp'] for chunk in replayed]).numpy()
+        np.testing.assert_allclose(replayed_logp, drawn_logp)
+        for key in ('entity_types', 'entity_ids', 'mention_lengths'):
+            drawn_values = torch.cat([chunk['sample'][key] for chunk in drawn]).numpy()
+            replayed_values = torch.cat([chunk['sample'][key] for chunk in replayed]).numpy()
+            np.testing.assert_equal(replayed_values, drawn_values)
+
+        # Fewer samples can be reused, but samples keyed by another seed have not been drawn.
+        assert len(list(cached_sampler.sample(batch, num_samples=3))) == 1
+        other_seed = CachedSampler(self.sampler, self.cache, seed=2)
+        with self.assertRaises(AssertionError):
+            list(other_seed.sample(batch, num_samples=1))
+
+    def test_samples_are_keyed_by_sampler(self):
+        batch = self.dataset.as_tensor_dict()
+        list(CachedSampler(self.sampler, self.cache).sample(batch, num_samples=2))
+
+        # A sampler with different parameters does not replay the stored samples.
+        other_discriminator = Model.from_params(vocab=self.vocab, params=self.params.duplicate())
+        other_discriminator.eval()
+        other_sampler = Sampler.from_model(other_discriminator)
+        assert (SampleCache.model_fingerprint(other_discriminator) !=
+                SampleCache.model_fingerprint(self.sampler.model))
+
+        num_drawn = []
+        original_sample = other_sampler._sample
+
+        def sample(*args, **kwargs):
+            num_drawn.append(1)
+            return original_sample(*args, **kwargs)
+        other_sampler._sample = sample
+        list(CachedSampler(other_sampler, self.cache).sample(batch, num_samples=2))
+        assert num_drawn
+
+    def test_samples_do_not_depend_on_batch(self):
+        batch = self.dataset.as_tensor_dict()
+        list(CachedSampler(self.sampler, self.cache).sample(batch, num_samples=3))
+
+        # Sampling the documents one at a time (without padding) draws the same samples.
+        single_cache = SampleCache(str(self.TEST_DIR / 'single_samples'))
+        for instance in self.instances:
+            document = Batch([instance])
+            document.index_instances(self.vocab)
+            list(CachedSampler(self.sampler, single_cache).sample(document.as_tensor_dict(),
+                                                                  num_samples=3,
+                                                                  samples_per_chunk=2))
+
+        filenames = sorted(os.listdir(self.cache._directory))
+        assert filenames == sorted(os.listdir(single_cache._directory))
+        assert len(filenames) == len(self.instances)
+        for filename in filenames:
+            key, seed, _ = filename.rsplit('.', 2)
+            expected = single_cache.load(key, int(seed), 3)
+            stored = self.cache.load(key, int(seed), 3)
+            assert expected.keys() == stored.keys()
+            for name, value in expected.items():
+                np.testing.assert_allclose(stored[name], value, rtol=1e-5)
@@ -0,0 +1,99 @@
+# pylint: disable=protected-access,not-callable
+from allennlp.common import Params
+from allennlp.common.testing import ModelTestCase
+from allennlp.models import Model
+import numpy as np
+import torch
+
+from kglm.common.testing import KglmModelTestCase
+from kglm.sampling import EntityNlmSampler, KglmSampler, Sampler
+
+
+class EntityNlmSamplerTest(ModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/entity_nlm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        params = Params({
+                'type': 'entitydisc',
+                'embedding_dim': 10,
+                'max_embeddings': 20,
+                'max_mention_length': 20,
+                'text_field_embedder': {
+                        'token_embedders': {'tokens': {'type': 'embedding', 'embedding_dim': 10}}
+                },
+                'encoder': {'type': 'lstm', 'input_size': 10, 'hidden_size': 10, 'stateful': True}
+        })
+        self.discriminator = Model.from_params(vocab=self.vocab, params=params)
+        self.discriminator.eval()
+        self.model.eval()
+
+    def test_from_model(self):
+        assert isinstance(Sampler.from_model(self.discriminator), EntityNlmSampler)
+
+    def test_sample(self):
+        batch = self.dataset.as_tensor_dict()
+        batch_size, sequence_length = batch['tokens']['tokens'].shape
+        mask = batch['tokens']['tokens'].gt(0)
+        sampler = Sampler.from_model(self.discriminator)
+
+        chunks = list(sampler.sample(batch, num_samples=5, samples_per_chunk=2))
+        assert [chunk['num_samples'] for chunk in chunks] == [2, 2, 1]
+        for chunk in chunks:
+            num_lanes = chunk['num_samples'] * batch_size
+            sample = chunk['sample']
+            assert chunk['logp'].shape == (num_lanes,)
+            assert torch.isfinite(chunk['logp']).all()
+            for key in ('entity_types', 'entity_ids', 'mention_lengths'):
+                assert sample[key].shape == (num_lanes, sequence_length)
+
+            # Mentions continue until their length runs out.
+            lane_mask = mask.repeat(chunk['num_samples'], 1)
+            ongoing = sample['mention_lengths'][:, :-1].gt(1) & lane_mask[:, 1:]
+            assert sample['entity_ids'][:, 1:][ongoing].eq(sample['entity_ids'][:, :-1][ongoing]).all()
+            assert sample['entity_types'][:, 1:][ongoing].eq(1).all()
+            assert sample['entity_ids'][sample['entity_types'].eq(0)].eq(0).all()
+
+            # The samples can be scored by the generative model.
+            with torch.no_grad():
+                model_logp = self.model(**sample)['logp']
+            assert model_logp.shape == (num_lanes,)
+            assert np.isfinite(model_logp.numpy()).all()
+
+
+class KglmSamplerTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.no-shortlist.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        params = Params.from_file("kglm/tests/fixtures/training_config/kglm-disc.no-shortlist.json")
+        self.discriminator = Model.from_params(vocab=self.vocab, params=params['model'])
+        self.discriminator.eval()
+        self.model.eval()
+
+    def test_sample(self):
+        batch = self.dataset.as_tensor_dict()
+        batch_size, sequence_length = batch['target']['tokens'].shape
+        sampler = Sampler.from_model(self.discriminator)
+        assert isinstance(sampler, KglmSampler)
+
+        chunk, = sampler.sample(batch, num_samples=3)
+        num_lanes = 3 * batch_size
+        sample = chunk['sample']
+        assert chunk['logp'].shape == (num_lanes,)
+        assert torch.isfinite(chunk['logp']).all()
+        assert sample['mention_type'].shape == (num_lanes, sequence_length)
+        # Only derived mentions have parents, and only mentions can copy alias tokens.
+        assert sample['parent_ids']['entity_ids'].squeeze(-1)[sample['mention_type'].ne(2)].eq(0).all()
+        assert sample['alias_copy_inds'][sample['mention_type'].eq(0)].eq(0).all()
+
+        with torch.no_grad():
+            model_logp = self.model(**sample)['logp']
+            # Scoring the samples using the hidden states of the (unrepeated) documents gives the
+            # same result as encoding every lane.
+            encoded = self.model.encode(batch['source']).repeat(3, 1, 1)
+            encoded_logp = self.model(encoded=encoded, **sample)['logp']
+        assert model_logp.shape == (num_lanes,)
+        np.testing.assert_allclose(model_logp.numpy(), encoded_logp.numpy(), rtol=1e-4)
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from allennlp.common.testing import AllenNlpTestCase
+
+from kglm.service import MicroBatcher
+
+
+class MicroBatcherTest(AllenNlpTestCase):
+    def setUp(self):
+        super().setUp()
+        self.batches = []
+
+    def predict_batch(self, inputs):
+        self.batches.append([x['id'] for x in inputs])
+        return [{'id': x['id'], 'length': len(x['tokens'])} for x in inputs]
+
+    def submit_concurrently(self, batcher, inputs):
+        results = [None] * len(inputs)
+
+        def submit(i):
+            results[i] = batcher.submit(inputs[i])
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(inputs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_requests_are_batched(self):
+        batcher = MicroBatcher(self.predict_batch, max_batch_size=4, max_latency=0.5)
+        inputs = [{'id': i, 'tokens': ['a'] * (i + 1)} for i in range(4)]
+        results = self.submit_concurrently(batcher, inputs)
+        batcher.close()
+
+        # Every request gets its own result, and all were processed in a single batch.
+        assert [result['id'] for result in results] == [0, 1, 2, 3]
+        assert len(self.batches) == 1
+
+    def test_batches_are_grouped_by_length(self):
+        batcher = MicroBatcher(self.predict_batch, max_batch_size=4, max_tokens=4, max_latency=0.5)
+        inputs = [{'id': i, 'tokens': ['a'] * length} for i, length in enumerate([1, 3, 1, 3])]
+        self.submit_concurrently(batcher, inputs)
+        batcher.close()
+
+        assert sorted(sorted(batch) for batch in self.batches) == [[0, 2], [1], [3]]
+
+    def test_max_latency(self):
+        batcher = MicroBatcher(self.predict_batch, max_batch_size=4, max_latency=0.01)
+        start = time.perf_counter()
+        batcher.submit({'id': 0, 'tokens': ['a']})
+        assert time.perf_counter() - start < 0.5
+        batcher.close()
+
+    def test_errors_are_reraised(self):
+        def predict_batch(inputs):
+            raise ValueError('bad input')
+
+        batcher = MicroBatcher(predict_batch, max_latency=0.01)
+        with self.assertRaises(ValueError):
+            batcher.submit({'tokens': []})
+        batcher.close()
@@ -0,0 +1,71 @@
+import json
+import math
+import threading
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from allennlp.common import Params
+from allennlp.data import DatasetReader
+
+from kglm.common.testing import KglmModelTestCase
+from kglm.predictors import KglmPredictor
+from kglm.service import make_server
+
+
+class ServerTest(KglmModelTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.set_up_model("kglm/tests/fixtures/training_config/kglm.json",
+                          "kglm/tests/fixtures/enhanced-wikitext.jsonl")
+        reader = DatasetReader.from_params(Params.from_file(self.param_file)['dataset_reader'])
+        self.model.eval()
+        predictor = KglmPredictor(self.model, reader)
+        # Port 0 lets the OS pick a free port.
+        self.server = make_server(predictor, port=0, max_latency=0.01)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address
+        self.url = 'http://%s:%i' % (host, port)
+        with open("kglm/tests/fixtures/enhanced-wikitext.jsonl", 'r') as f:
+            self.documents = [json.loads(line) for line in f]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.batcher.close()
+        self.server.server_close()
+        self.thread.join()
+        super().tearDown()
+
+    def post(self, path, body):
+        request = Request(self.url + path,
+                          data=json.dumps(body).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read().decode('utf-8'))
+
+    def test_predict(self):
+        status, output = self.post('/predict', self.documents[0])
+        assert status == 200
+        assert output['num_tokens'] == len(self.instances[0]['target'])
+        assert math.isfinite(output['joint_logp'])
+
+    def test_concurrent_requests(self):
+        results = [None] * len(self.documents)
+
+        def post(i):
+            results[i] = self.post('/predict', self.documents[i])
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(self.documents))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for (status, output), instance in zip(results, self.instances):
+            assert status == 200
+            assert output['num_tokens'] == len(instance['target'])
+
+    def test_unknown_path(self):
+        with self.assertRaises(HTTPError) as context:
+            self.post('/unknown', self.documents[0])
+        assert context.exception.code == 404
@@ -0,0 +1,91 @@
+# pylint: disable=protected-access
+import json
+from unittest import mock
+
+from allennlp.commands.train import train_model_from_file
+from allennlp.common.testing import AllenNlpTestCase
+import torch
+
+from kglm.training.trainer import LmTrainer, _ShardedDataset
+
+
+class DistributedTrainingTest(AllenNlpTestCase):
+
+    def test_sharded_dataset(self):
+        instances = list(range(7))
+        shards = [list(_ShardedDataset(instances, rank, 3)) for rank in range(3)]
+        assert shards == [[0, 3, 6], [1, 4], [2, 5]]
+        # Shards can be iterated over once per epoch.
+        assert list(_ShardedDataset(instances, 1, 3)) == [1, 4]
+
+    def test_train_with_nt_asgd(self):
+        # ASGD is triggered from the start, so that every epoch updates the averaged parameters.
+        overrides = json.dumps({'trainer': {'world_size': 2,
+                                            'num_epochs': 3,
+                                            'optimizer': {'triggered': True}}})
+        serialization_dir = self.TEST_DIR / 'distributed'
+        parameters_dir = self.TEST_DIR / 'parameters'
+        parameters_dir.mkdir()
+
+        # Workers are forked, so they record the parameters they hold after every epoch on disk.
+        original_train_epoch = LmTrainer._train_epoch
+
+        def train_epoch(trainer, epoch):
+            metrics = original_train_epoch(trainer, epoch)
+            optimizer = trainer.optimizer
+            assert optimizer.triggered
+            state = {}
+            for name, parameter in trainer.model.named_parameters():
+                state[name] = parameter.data.clone()
+                if parameter in optimizer.state:
+                    state[name + '.ax'] = optimizer.state[parameter]['ax'].clone()
+            assert any(name.endswith('.ax') for name in state)
+            torch.save(state, str(parameters_dir / ('%d.%d.th' % (trainer._rank, epoch))))
+            return metrics
+
+        with mock.patch.object(LmTrainer, '_train_epoch', train_epoch):
+            model = train_model_from_file('kglm/tests/fixtures/training_config/kglm-disc.no-shortlist.json',
+                                          serialization_dir,
+                                          overrides=overrides)
+        assert model is not None
+        assert (serialization_dir / 'model.tar.gz').exists()
+        assert (serialization_dir / 'metrics_epoch_2.json').exists()
+
+        for epoch in range(3):
+            primary = torch.load(str(parameters_dir / ('0.%d.th' % epoch)))
+            worker = torch.load(str(parameters_dir / ('1.%d.th' % epoch)))
+            assert primary.keys() == worker.keys()
+            for name, value in primary.items():
+                assert torch.equal(value, worker[name]), name
+
+    def test_worker_failure_stops_training(self):
+        overrides = json.dumps({'trainer': {'world_size': 2}})
+        serialization_dir = self.TEST_DIR / 'failure'
+        original_batch_loss = LmTrainer.batch_loss
+
+        # Only the second worker encounters a nan loss.
+        def batch_loss(trainer, batch, for_training):
+            loss = original_batch_loss(trainer, batch, for_training)
+            if trainer._rank == 1:
+                loss = loss * float('nan')
+            return loss
+
+        with mock.patch.object(LmTrainer, 'batch_loss', batch_loss):
+            with self.assertRaisesRegex(RuntimeError, 'failed on 1 other worker'):
+                train_model_from_file('kglm/tests/fixtures/training_config/kglm-disc.no-shortlist.json',
+                                      serialization_dir,
+                                      overrides=overrides)
+
+    def test_primary_failure_stops_workers(self):
+        overrides = json.dumps({'trainer': {'world_size': 2}})
+        serialization_dir = self.TEST_DIR / 'primary_failure'
+
+        # The other worker waits for the validation metric of the first worker, which fails.
+        def validation_loss(trainer):
+            raise ValueError('validation failed')
+
+        with mock.patch.object(LmTrainer, '_validation_loss', validation_loss):
+            with self.assertRaisesRegex(ValueError, 'validation failed'):
+                train_model_from_file('kglm/tests/fixtures/training_config/kglm-disc.no-shortlist.json',
+                                      serialization_dir,
+                                      overrides=overrides)
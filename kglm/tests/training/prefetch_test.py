@@ -0,0 +1,39 @@
+from allennlp.common.testing import AllenNlpTestCase
+import pytest
+import torch
+
+from kglm.training.prefetch import Prefetcher
+
+
+class PrefetcherTest(AllenNlpTestCase):
+    # pylint: disable=no-self-use
+    def test_preserves_order(self):
+        batches = [({'reset': torch.tensor([i == 0], dtype=torch.uint8)}, 1.0) for i in range(10)]
+        prefetched = list(Prefetcher(batches, buffer_size=3))
+        assert len(prefetched) == len(batches)
+        for (batch, lr_mult), (expected_batch, expected_lr_mult) in zip(prefetched, batches):
+            assert batch['reset'].equal(expected_batch['reset'])
+            assert lr_mult == expected_lr_mult
+
+    def test_exceptions_are_raised(self):
+        def generator():
+            yield 1
+            raise ValueError('bad batch')
+        prefetcher = Prefetcher(generator(), buffer_size=2)
+        assert next(prefetcher) == 1
+        with pytest.raises(ValueError):
+            next(prefetcher)
+        # The prefetcher is exhausted afterwards
+        with pytest.raises(StopIteration):
+            next(prefetcher)
+
+    def test_base_exceptions_are_raised(self):
+        def generator():
+            yield 1
+            raise SystemExit(1)
+        prefetcher = Prefetcher(generator(), buffer_size=2)
+        assert next(prefetcher) == 1
+        with pytest.raises(SystemExit):
+            next(prefetcher)
+        with pytest.raises(StopIteration):
+            next(prefetcher)
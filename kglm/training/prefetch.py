@@ -0,0 +1,102 @@
+import logging
+import queue
+import threading
+from typing import Any, Iterable, Iterator
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Placed on the queue once the producer is done.
+_END = object()
+
+
+def pin_memory(obj: Any) -> Any:
+    """
+    Given a structure (possibly) containing Tensors on the CPU, pins the memory of all of them
+    (so that they can be copied to the GPU asynchronously).
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.pin_memory()
+    elif isinstance(obj, dict):
+        return {key: pin_memory(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [pin_memory(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return tuple(pin_memory(item) for item in obj)
+    else:
+        return obj
+
+
+class Prefetcher(Iterator[Any]):
+    """
+    Wraps an iterator, producing its elements ahead of time in a background thread. Elements are
+    still yielded in order, so stateful iterators (e.g. ones producing ``reset`` signals for
+    consecutive splits) behave exactly the same as without prefetching.
+
+    Parameters
+    ----------
+    iterable : ``Iterable[Any]``
+        The iterable to prefetch elements from.
+    buffer_size : ``int``
+        The maximum number of elements produced ahead of time.
+    pin_memory : ``bool``, optional (default=False)
+        Whether to pin the memory of the tensors in each element. Has no effect if CUDA is not
+        available.
+    """
+    def __init__(self,
+                 iterable: Iterable[Any],
+                 buffer_size: int,
+                 pin_memory: bool = False) -> None:
+        self._iterator = iter(iterable)
+        self._pin_memory = pin_memory and torch.cuda.is_available()
+        self._queue: queue.Queue = queue.Queue(maxsize=buffer_size)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _produce(self) -> None:
+        end: Any = _END
+        try:
+            for element in self._iterator:
+                if self._pin_memory:
+                    element = pin_memory(element)
+                if not self._put(element):
+                    return
+        except BaseException as error:  # pylint: disable=broad-except
+            # Exceptions (including e.g. ``SystemExit``) are re-raised in the consuming thread.
+            end = error
+        finally:
+            # The end of the stream is always signalled, so the consumer never blocks forever.
+            self._put(end)
+
+    def _put(self, element: Any) -> bool:
+        # Periodically check whether the consumer has stopped, so the thread does not block
+        # forever on a full queue.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(element, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __next__(self) -> Any:
+        if self._done:
+            raise StopIteration
+        element = self._queue.get()
+        if element is _END:
+            self.close()
+            raise StopIteration
+        if isinstance(element, BaseException):
+            self.close()
+            raise element
+        return element
+
+    def close(self) -> None:
+        self._done = True
+        self._stop.set()
+
+    def __del__(self) -> None:
+        self.close()
@@ -1,15 +1,21 @@
 
 import logging
 import math
+import multiprocessing
 import os
+import random
+import socket
 import time
 import re
 import datetime
 import traceback
-from typing import Dict, Optional, List, Tuple, Union, Iterable, Any, NamedTuple
+from typing import Dict, Optional, List, Tuple, Union, Iterable, Iterator, Any, NamedTuple
 
+import numpy as np
 import torch
+import torch.distributed as dist
 import torch.optim.lr_scheduler
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from allennlp.common import Params
 from allennlp.common.checks import ConfigurationError
@@ -31,10 +37,30 @@ from allennlp.training import util as training_util
 from allennlp.training.moving_average import MovingAverage
 
 from kglm.training.nt_asgd import NTASGDOptimizer
+from kglm.training.prefetch import Prefetcher
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+class _ShardedDataset(Iterable[Instance]):
+    """
+    The subset of a (possibly lazy) dataset processed by one worker in distributed training:
+    every ``world_size``-th instance, starting from the ``rank``-th one.
+    """
+    def __init__(self,
+                 instances: Iterable[Instance],
+                 rank: int,
+                 world_size: int) -> None:
+        self._instances = instances
+        self._rank = rank
+        self._world_size = world_size
+
+    def __iter__(self) -> Iterator[Instance]:
+        for i, instance in enumerate(self._instances):
+            if i % self._world_size == self._rank:
+                yield instance
+
+
 @TrainerBase.register("lm")
 class LmTrainer(TrainerBase):
     def __init__(self,
@@ -61,7 +87,12 @@ class LmTrainer(TrainerBase):
                  should_log_parameter_statistics: bool = True,
                  should_log_learning_rate: bool = False,
                  log_batch_size_period: Optional[int] = None,
-                 moving_average: Optional[MovingAverage] = None) -> None:
+                 moving_average: Optional[MovingAverage] = None,
+                 prefetch_batches: int = 0,
+                 pin_memory: bool = False,
+                 world_size: int = 1,
+                 distributed_address: str = '127.0.0.1',
+                 distributed_port: int = 0) -> None:
         """
         A trainer for doing supervised learning. It just takes a labeled dataset
         and a ``DataIterator``, and uses the supplied ``Optimizer`` to learn the weights
@@ -164,9 +195,41 @@ class LmTrainer(TrainerBase):
             parameters. Be careful that when saving the checkpoint, we will save the moving averages of
             parameters. This is necessary because we want the saved model to perform as well as the validated
             model if we load it later. But this may cause problems if you restart the training from checkpoint.
+        prefetch_batches : ``int``, optional, (default = 0)
+            If greater than 0, batches are produced by the iterator in a background thread, up to
+            this many batches ahead of the model. Batches are still processed in order.
+        pin_memory : ``bool``, optional, (default = False)
+            Whether to pin the memory of prefetched batches (only used when prefetching on a
+            machine with a GPU).
+        world_size : ``int``, optional, (default = 1)
+            If greater than 1, then training is data-parallel across this many worker processes
+            on the CPU (communicating using the ``gloo`` backend of ``torch.distributed``). The
+            training documents are sharded across the workers, each of which processes its shard
+            with its own copy of the model (and its own recurrent state), and the gradients are
+            averaged after every batch so that the copies stay identical. Validation,
+            checkpointing and logging are done by the first worker (which runs in the current
+            process, so that the trained model is available once training is done).
+        distributed_address : ``str``, optional, (default = '127.0.0.1')
+            The address the workers use to connect to each other.
+        distributed_port : ``int``, optional, (default = 0)
+            The port the workers use to connect to each other. If 0, a free port is chosen.
         """
         super().__init__(serialization_dir, cuda_device)
 
+        if world_size > 1 and self._cuda_devices[0] >= 0:
+            raise ConfigurationError('Distributed training is only supported on the CPU')
+        if world_size > 1 and histogram_interval is not None:
+            raise ConfigurationError('Histograms cannot be logged during distributed training')
+        self._world_size = world_size
+        self._distributed_address = distributed_address
+        self._distributed_port = distributed_port
+        self._rank = 0
+        # The number of workers which processed a batch at the current step.
+        self._num_active_workers = 1
+        # An exception raised by this worker during the current step, which is reported to the
+        # other workers at the next step (see ``_lockstep``).
+        self._worker_error: Optional[Exception] = None
+
         # I am not calling move_to_gpu here, because if the model is
         # not already on the GPU then the optimizer is going to be wrong.
         self.model = model
@@ -220,12 +283,80 @@ class LmTrainer(TrainerBase):
 
         self._log_batch_size_period = log_batch_size_period
 
+        self._prefetch_batches = prefetch_batches
+        self._pin_memory = pin_memory
+
         self._last_log = 0.0  # time of last logging
 
         # Enable activation logging.
         if histogram_interval is not None:
             self._tensorboard.enable_activation_logging(self.model)
 
+    @property
+    def _is_primary(self) -> bool:
+        return self._rank == 0
+
+    def _lockstep(self,
+                  generator: Iterable[Tuple[TensorDict, float]]) -> Iterator[Tuple[Optional[TensorDict], float]]:
+        """
+        Keeps distributed workers in lockstep, since each step requires every worker to take part
+        in the gradient all-reduce. Workers whose shard has run out yield ``None`` batches until
+        every shard has run out. The learning rate multipliers are averaged across the workers,
+        so that every copy of the model receives the same update.
+
+        The number of failed workers is communicated alongside, so that if any worker fails every
+        worker raises an error instead of waiting for it in the next all-reduce.
+        """
+        iterator = iter(generator)
+        while True:
+            item = None
+            if self._worker_error is None:
+                try:
+                    item = next(iterator, None)
+                except Exception as error:  # pylint: disable=broad-except
+                    self._worker_error = error
+            status = torch.zeros(3)
+            if item is not None:
+                status[0] = 1.0
+                status[1] = item[1]
+            if self._worker_error is not None:
+                status[2] = 1.0
+            dist.all_reduce(status)
+            if status[2].item() > 0:
+                if self._worker_error is not None:
+                    raise self._worker_error
+                raise RuntimeError('Distributed training failed on %d other worker(s)' % int(status[2].item()))
+            self._num_active_workers = int(status[0].item())
+            if self._num_active_workers == 0:
+                return
+            yield (None if item is None else item[0]), status[1].item() / self._num_active_workers
+
+    def _all_reduce_gradients(self) -> None:
+        """
+        Averages the gradients over the workers which processed a batch at the current step.
+        """
+        parameters = [parameter for parameter in self.model.parameters() if parameter.requires_grad]
+        gradients = [parameter.grad.data if parameter.grad is not None else torch.zeros_like(parameter.data)
+                     for parameter in parameters]
+        # Communicating a single flattened buffer is much cheaper than one tensor at a time.
+        flattened = _flatten_dense_tensors(gradients)
+        dist.all_reduce(flattened)
+        flattened /= self._num_active_workers
+        for parameter, gradient in zip(parameters, _unflatten_dense_tensors(flattened, gradients)):
+            if parameter.grad is None:
+                parameter.grad = gradient
+            else:
+                parameter.grad.data.copy_(gradient)
+
+    def _broadcast_metric(self, metric: Optional[float]) -> float:
+        """
+        Sends the validation metric computed by the first worker to every worker, so that they
+        make the same decisions about early stopping and learning rate scheduling.
+        """
+        tensor = torch.tensor([metric if metric is not None else 0.0], dtype=torch.float64)  # pylint: disable=not-callable
+        dist.broadcast(tensor, 0)
+        return tensor.item()
+
     def rescale_gradients(self) -> Optional[float]:
         return training_util.rescale_gradients(self.model, self._grad_norm)
 
@@ -249,6 +380,11 @@ class LmTrainer(TrainerBase):
 
         return loss
 
+    def _maybe_prefetch(self, generator: Iterable[Any]) -> Iterable[Any]:
+        if self._prefetch_batches > 0:
+            return Prefetcher(generator, self._prefetch_batches, pin_memory=self._pin_memory)
+        return generator
+
     def _train_epoch(self, epoch: int) -> Dict[str, float]:
         """
         Trains one epoch and returns metrics.
@@ -271,6 +407,9 @@ class LmTrainer(TrainerBase):
         raw_train_generator = self.iterator(self.train_data,
                                             num_epochs=1,
                                             shuffle=self.shuffle)
+        raw_train_generator = self._maybe_prefetch(raw_train_generator)
+        if self._world_size > 1:
+            raw_train_generator = self._lockstep(raw_train_generator)
         #train_generator = lazy_groups_of(raw_train_generator, num_gpus)
         #num_training_batches = math.ceil(self.iterator.get_num_batches(self.train_data)/num_gpus)
         num_training_batches = 1
@@ -289,20 +428,36 @@ class LmTrainer(TrainerBase):
                                          total=num_training_batches)
         cumulative_batch_size = 0
         for batch, lr_mult in train_generator_tqdm:
-            batches_this_epoch += 1
             self._batch_num_total += 1
             batch_num_total = self._batch_num_total
 
             self.optimizer.zero_grad()
 
-            loss = self.batch_loss(batch, for_training=True)
+            # When training in parallel, a worker whose shard has run out only takes part in the
+            # gradient all-reduce.
+            if batch is not None:
+                batches_this_epoch += 1
 
-            if torch.isnan(loss):
-                raise ValueError("nan loss encountered")
+                try:
+                    loss = self.batch_loss(batch, for_training=True)
 
-            loss.backward()
+                    if torch.isnan(loss):
+                        raise ValueError("nan loss encountered")
 
-            train_loss += loss.item()
+                    loss.backward()
+
+                    train_loss += loss.item()
+                except Exception as error:  # pylint: disable=broad-except
+                    if self._world_size == 1:
+                        raise
+                    # The other workers are waiting for this one in the gradient all-reduce, so
+                    # the step is completed without gradients and the error is raised by every
+                    # worker at the next step.
+                    self._worker_error = error
+                    self.optimizer.zero_grad()
+
+            if self._world_size > 1:
+                self._all_reduce_gradients()
 
             # batch_grad_norm = self.rescale_gradients()
             if self._grad_clipping:
@@ -395,6 +550,7 @@ class LmTrainer(TrainerBase):
         raw_val_generator = val_iterator(self._validation_data,
                                          num_epochs=1,
                                          shuffle=False)
+        raw_val_generator = self._maybe_prefetch(raw_val_generator)
         # val_generator = lazy_groups_of(raw_val_generator, num_gpus)
         num_validation_batches = 1
         val_generator_tqdm = Tqdm.tqdm(raw_val_generator,
@@ -428,6 +584,69 @@ class LmTrainer(TrainerBase):
         """
         Trains the supplied model with the supplied parameters.
         """
+        if self._world_size > 1:
+            return self._train_distributed()
+        return self._train()
+
+    def _train_distributed(self) -> Dict[str, Any]:
+        # Workers are forked, so that they start from identical copies of the model and
+        # optimizer. The current process becomes the first worker.
+        if self._distributed_port == 0:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind((self._distributed_address, 0))
+                self._distributed_port = sock.getsockname()[1]
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=self._run_worker, args=(rank,))
+                   for rank in range(1, self._world_size)]
+        for worker in workers:
+            worker.start()
+        try:
+            self._init_worker(0)
+            metrics = self._train()
+        except BaseException:
+            # The other workers may be waiting for this one in a collective operation (e.g. the
+            # broadcast of the validation metric), which would only time out much later.
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            if dist.is_initialized():
+                dist.destroy_process_group()
+        failed = [rank for rank, worker in enumerate(workers, 1) if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError('Distributed training failed on workers: %s' % failed)
+        return metrics
+
+    def _run_worker(self, rank: int) -> None:
+        exitcode = 0
+        try:
+            self._init_worker(rank)
+            self._train()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Distributed training failed on worker %d', rank)
+            exitcode = 1
+        finally:
+            # Exit without running the cleanup handlers inherited from the parent process.
+            os._exit(exitcode)  # pylint: disable=protected-access
+
+    def _init_worker(self, rank: int) -> None:
+        self._rank = rank
+        dist.init_process_group('gloo',
+                                init_method='tcp://%s:%d' % (self._distributed_address, self._distributed_port),
+                                rank=rank,
+                                world_size=self._world_size)
+        # Every worker would otherwise inherit the same random state (e.g. for dropout).
+        seed = torch.initial_seed() % 2**31 + rank
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        self.train_data = _ShardedDataset(self.train_data, rank, self._world_size)
+        if not self._is_primary:
+            self._tensorboard = TensorboardWriter(get_batch_num_total=lambda: self._batch_num_total)
+
+    def _train(self) -> Dict[str, Any]:
         try:
             epoch_counter = self._restore_checkpoint()
         except RuntimeError:
@@ -477,19 +696,23 @@ class LmTrainer(TrainerBase):
 
             if self._validation_data is not None:
                 with torch.no_grad():
-                    # We have a validation set, so compute all the metrics on it.
-                    val_loss, num_batches = self._validation_loss()
-                    val_metrics = training_util.get_metrics(self.model, val_loss, num_batches, reset=True)
+                    # We have a validation set, so compute all the metrics on it. When training in
+                    # parallel only the first worker validates, and shares the validation metric.
+                    if self._is_primary:
+                        val_loss, num_batches = self._validation_loss()
+                        val_metrics = training_util.get_metrics(self.model, val_loss, num_batches, reset=True)
+                        this_epoch_val_metric = val_metrics[self._validation_metric]
+                    if self._world_size > 1:
+                        this_epoch_val_metric = self._broadcast_metric(this_epoch_val_metric)
 
                     # Check validation metric for early stopping
-                    this_epoch_val_metric = val_metrics[self._validation_metric]
                     self._metric_tracker.add_metric(this_epoch_val_metric)
 
                     if self._metric_tracker.should_stop_early():
                         logger.info("Ran out of patience.  Stopping training.")
                         break
 
-            self._tensorboard.log_metrics(train_metrics, val_metrics=val_metrics, log_to_console=True)
+            self._tensorboard.log_metrics(train_metrics, val_metrics=val_metrics, log_to_console=self._is_primary)
 
             # Create overall metrics dict
             training_elapsed_time = time.time() - training_start_time
@@ -512,7 +735,7 @@ class LmTrainer(TrainerBase):
 
                 self._metric_tracker.best_epoch_metrics = val_metrics
 
-            if self._serialization_dir:
+            if self._serialization_dir and self._is_primary:
                 dump_metrics(os.path.join(self._serialization_dir, f'metrics_epoch_{epoch}.json'), metrics)
 
             if self._learning_rate_scheduler:
@@ -561,6 +784,9 @@ class LmTrainer(TrainerBase):
             The epoch of training.  If the checkpoint is saved in the middle
             of an epoch, the parameter is a string with the epoch and timestamp.
         """
+        if not self._is_primary:
+            return
+
         # If moving averages are used for parameters, we save
         # the moving average values into checkpoint, instead of the current values.
         if self._moving_average is not None:
@@ -698,6 +924,11 @@ class LmTrainer(TrainerBase):
         should_log_parameter_statistics = params.pop_bool("should_log_parameter_statistics", True)
         should_log_learning_rate = params.pop_bool("should_log_learning_rate", False)
         log_batch_size_period = params.pop_int("log_batch_size_period", None)
+        prefetch_batches = params.pop_int("prefetch_batches", 0)
+        pin_memory = params.pop_bool("pin_memory", False)
+        world_size = params.pop_int("world_size", 1)
+        distributed_address = params.pop("distributed_address", "127.0.0.1")
+        distributed_port = params.pop_int("distributed_port", 0)
 
         params.assert_empty(cls.__name__)
         return cls(model, optimizer, iterator,
@@ -720,7 +951,12 @@ class LmTrainer(TrainerBase):
                    should_log_parameter_statistics=should_log_parameter_statistics,
                    should_log_learning_rate=should_log_learning_rate,
                    log_batch_size_period=log_batch_size_period,
-                   moving_average=moving_average)
+                   moving_average=moving_average,
+                   prefetch_batches=prefetch_batches,
+                   pin_memory=pin_memory,
+                   world_size=world_size,
+                   distributed_address=distributed_address,
+                   distributed_port=distributed_port)
 
 
 class TrainerPieces(NamedTuple):